@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Reports characters per second for each output strategy.
+
+Runs headless against quikey.fakes.FakeController. --latency adds a fixed
+cost to every synthetic key event to approximate a real X server round trip.
+
+    PYNPUT_BACKEND=dummy python benchmarks/bench_output.py --latency 0.0001
+"""
+
+import argparse
+import json
+import time
+
+from quikey.fakes import FakeController, FakeClipboard
+from quikey.output import OutputEngine, MODES
+
+
+def bench(mode, length, latency, repeat):
+    text = ("lorem ipsum dolor sit amet " * (length // 27 + 1))[:length]
+    keyboard = FakeController(latency)
+    engine = OutputEngine(keyboard, FakeClipboard())
+    start = time.perf_counter()
+    for _ in range(repeat):
+        engine.emit(text, mode)
+    elapsed = time.perf_counter() - start
+    return {
+        "strategy": mode,
+        "chars": length,
+        "events": len(keyboard.events) // repeat,
+        "seconds": elapsed / repeat,
+        "chars_per_second": length * repeat / elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[16, 256, 4096])
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    results = [
+        bench(mode, length, args.latency, args.repeat)
+        for length in args.lengths
+        for mode in MODES
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
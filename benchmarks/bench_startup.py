@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Measures how long `qk version` takes to start, as editor integrations run qk
+many times a day.
+
+    python benchmarks/bench_startup.py --budget 150
+
+Each run is a fresh interpreter. The time of an interpreter that does nothing
+is subtracted, and the script exits with status 1 when the median is over
+the budget in milliseconds.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from shutil import rmtree
+
+QK = "from quikey.quikey import cli; cli()"
+
+# Modules that only some commands need; `qk version` must not import them.
+HEAVY = [
+    "tinydb",
+    "filelock",
+    "sqlite3",
+    "terminaltables",
+    "humanize",
+    "pick",
+    "quikey.importer",
+]
+
+
+def timed(args, env, runs):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def imported(env):
+    code = (
+        "import sys; sys.argv = ['qk', 'version']\n"
+        "try:\n"
+        "    %s\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print(' '.join(x for x in %r if x in sys.modules))" % (QK, HEAVY)
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    # The last line, after what qk version printed.
+    return result.stdout.decode().splitlines()[-1].split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=150,
+        help="Most milliseconds qk version may take on top of the interpreter.",
+    )
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    env = dict(
+        os.environ,
+        XDG_DATA_HOME=os.path.join(directory, "data"),
+        XDG_CONFIG_HOME=os.path.join(directory, "config"),
+        XDG_CACHE_HOME=os.path.join(directory, "cache"),
+    )
+    try:
+        baseline = timed([sys.executable, "-c", "pass"], env, args.runs)
+        qk = timed([sys.executable, "-c", QK, "version"], env, args.runs)
+        heavy = imported(env)
+    finally:
+        rmtree(directory)
+    overhead = statistics.median(qk) - statistics.median(baseline)
+    print("interpreter: median %.1fms" % statistics.median(baseline))
+    print(
+        "qk version:  median %.1fms, min %.1fms, max %.1fms"
+        % (statistics.median(qk), min(qk), max(qk))
+    )
+    print("overhead:    %.1fms (budget %.0fms)" % (overhead, args.budget))
+    failed = False
+    if heavy:
+        print("qk version imported %s" % ", ".join(heavy))
+        failed = True
+    if overhead > args.budget:
+        print("qk version is over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
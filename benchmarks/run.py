@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""
+Headless benchmark suite for the matchers, key buffer, storage backends,
+daemon reloads and the AutoKey importer.
+
+Everything runs against quikey.fakes, so no X server is needed:
+
+    PYNPUT_BACKEND=dummy python benchmarks/run.py --output new.json
+    PYNPUT_BACKEND=dummy python benchmarks/run.py --compare old.json
+
+Results are written as JSON so runs can be compared for regressions.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+import time
+from shutil import rmtree
+from threading import Lock
+
+from pynput.keyboard import Key, KeyCode
+
+from quikey.cache import MatcherCache
+from quikey.directories import AppDirectories
+from quikey.fakes import FakeController, FakeListener
+from quikey.importer import iter_phrases
+from quikey.matcher import PatternMatcher
+from quikey.input import (
+    InputHandler,
+    Notifier,
+    PhraseHandler,
+    AlphaNumHandler,
+    DeleteHandler,
+    SpaceHandler,
+)
+from quikey.models import open_database, Phrase, PhraseSnapshot
+from quikey.output import OutputEngine
+from quikey.qkdaemon import DatabaseChangeHandler
+from quikey.stats import Histogram
+
+SIZES = [10, 1000, 10000, 100000]
+BACKENDS = ["tinydb", "sqlite", "journal"]
+
+# Upper limit on the wall time spent repeating one operation.
+BUDGET = 1.0
+
+# Finer than the daemon's buckets since most operations take microseconds.
+BUCKETS = tuple(m * 10**e for e in range(0, 6) for m in (1, 2, 5))
+
+
+def make_phrases(count, seed=0):
+    rng = random.Random(seed)
+    phrases = {}
+    while len(phrases) < count:
+        key = "".join(
+            rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10))
+        )
+        phrases[key] = "Expansion of %s. " % key * rng.randint(1, 4)
+    return phrases
+
+
+def keystrokes(phrases, count, seed=0):
+    """
+    Synthetic typing: random words with a phrase key roughly every tenth
+    word, each word followed by the enter trigger.
+    """
+    rng = random.Random(seed)
+    keys = list(phrases)
+    stream = []
+    while len(stream) < count:
+        if rng.random() < 0.1:
+            word = rng.choice(keys)
+        else:
+            word = "".join(
+                rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 8))
+            )
+        stream.extend(KeyCode.from_char(c) for c in word)
+        stream.append(Key.enter)
+    return stream[:count]
+
+
+def latency(histogram):
+    return {
+        "mean_us": histogram.mean(),
+        "p50_us": histogram.percentile(50),
+        "p99_us": histogram.percentile(99),
+        "max_us": histogram.max,
+    }
+
+
+def repeat(func, items):
+    """
+    Call func on items in turn until they run out or BUDGET seconds pass.
+    Returns (operations, seconds).
+    """
+    start = time.perf_counter()
+    ops = 0
+    for item in items:
+        func(item)
+        ops += 1
+        if time.perf_counter() - start > BUDGET:
+            break
+    return ops, time.perf_counter() - start
+
+
+def notifier_for(phrases, options=None):
+    options = options or {}
+    snapshot = PhraseSnapshot({k: Phrase(v, options) for k, v in phrases.items()})
+    output = OutputEngine(FakeController())
+    notifier = Notifier(Lock())
+    notifier.replace(PhraseHandler(k, snapshot, output) for k in phrases)
+    return notifier
+
+
+def bench_hook(phrases, events=20000, options=None):
+    notifier = notifier_for(phrases, options)
+    handler = InputHandler(notifier, 32, ["enter"])
+    handler.add_handler(DeleteHandler())
+    handler.add_handler(AlphaNumHandler())
+    handler.add_handler(SpaceHandler())
+    histogram = Histogram(BUCKETS)
+
+    def on_press(key):
+        start = time.perf_counter()
+        handler(key)
+        histogram.record(time.perf_counter() - start)
+
+    with FakeListener(on_press=on_press) as listener:
+        for key in keystrokes(phrases, events):
+            listener.press(key)
+    return latency(histogram)
+
+
+def bench_match(phrases, lookups=20000):
+    notifier = notifier_for(phrases)
+    rng = random.Random(1)
+    keys = list(phrases)
+    buffers = [
+        "lorem ipsum " + (rng.choice(keys) if i % 2 else "nomatch")
+        for i in range(lookups)
+    ]
+    histogram = Histogram(BUCKETS)
+    matcher = notifier.matcher
+    for buffer in buffers:
+        start = time.perf_counter()
+        matcher.match(buffer)
+        histogram.record(time.perf_counter() - start)
+    return latency(histogram)
+
+
+def bench_patterns(phrases, lookups=20000):
+    # Every key as a pattern ending in a number, like "addr\d{1,3}".
+    matcher = PatternMatcher(r"%s\d{1,3}" % k for k in phrases)
+    rng = random.Random(1)
+    keys = list(phrases)
+    buffers = [
+        "lorem ipsum " + (rng.choice(keys) + "42" if i % 2 else "nomatch")
+        for i in range(lookups)
+    ]
+    histogram = Histogram(BUCKETS)
+    for buffer in buffers:
+        start = time.perf_counter()
+        matcher.match(buffer)
+        histogram.record(time.perf_counter() - start)
+    return latency(histogram)
+
+
+def bench_storage(phrases, backend, directory):
+    appDirs = AppDirectories(directory, directory, directory)
+    db = open_database(appDirs, backend)
+    start = time.perf_counter()
+    db.put_many(phrases)
+    load = time.perf_counter() - start
+    keys = list(phrases)
+    random.Random(2).shuffle(keys)
+    get_ops, get_time = repeat(db.get, keys)
+    put_ops, put_time = repeat(
+        lambda i: db.put("bench%d" % i, "value %d" % i), range(len(keys))
+    )
+    all_ops, all_time = repeat(lambda i: db.all(), range(100))
+    return db, {
+        "put_many_seconds": load,
+        "get_per_second": get_ops / get_time,
+        "put_per_second": put_ops / put_time,
+        "all_per_second": all_ops / all_time,
+    }
+
+
+def bench_reload(db):
+    handler = DatabaseChangeHandler(
+        Notifier(Lock()), db, OutputEngine(FakeController())
+    )
+    initial = handler.last_reload.duration
+    cache = MatcherCache(db.appDirs)
+    DatabaseChangeHandler(Notifier(Lock()), db, OutputEngine(FakeController()), cache)
+    cached = DatabaseChangeHandler(
+        Notifier(Lock()), db, OutputEngine(FakeController()), cache
+    ).last_reload.duration
+    reloads = []
+    for i in range(5):
+        db.put("reload%d" % i, "value")
+        reloads.append(handler.reload().duration)
+    return {
+        "initial_seconds": initial,
+        "cached_seconds": cached,
+        "reload_seconds": min(reloads),
+    }
+
+
+def bench_import(phrases, directory, limit=10000):
+    phrases = dict(list(phrases.items())[:limit])
+    for i, (key, value) in enumerate(phrases.items()):
+        folder = os.path.join(directory, "folder%d" % (i // 100))
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, key + ".txt"), "w") as f:
+            f.write(value)
+        with open(os.path.join(folder, "." + key + ".json"), "w") as f:
+            json.dump(
+                {
+                    "type": "phrase",
+                    "modes": [1],
+                    "abbreviation": {"abbreviations": [key]},
+                },
+                f,
+            )
+    start = time.perf_counter()
+    count = sum(1 for _ in iter_phrases(directory))
+    elapsed = time.perf_counter() - start
+    return {"files": count, "files_per_second": count / elapsed}
+
+
+def run(sizes, backends):
+    results = []
+
+    def add(benchmark, size, metrics, backend=None):
+        results.append(
+            {"benchmark": benchmark, "size": size, "backend": backend, **metrics}
+        )
+        print(benchmark, size, backend or "", metrics, file=sys.stderr)
+
+    for size in sizes:
+        phrases = make_phrases(size)
+        add("keystroke_hook", size, bench_hook(phrases))
+        instant = bench_hook(phrases, options={"instant": True})
+        add("keystroke_hook_instant", size, instant)
+        add("trigger_match", size, bench_match(phrases))
+        add("pattern_match", size, bench_patterns(phrases))
+        for backend in backends:
+            directory = tempfile.mkdtemp()
+            try:
+                db, metrics = bench_storage(phrases, backend, directory)
+                add("storage", size, metrics, backend)
+                add("reload", size, bench_reload(db), backend)
+            finally:
+                rmtree(directory)
+        directory = tempfile.mkdtemp()
+        try:
+            add("import", size, bench_import(phrases, directory))
+        finally:
+            rmtree(directory)
+    return results
+
+
+def compare(old, new):
+    """
+    Print new/old ratios for every metric present in both runs.
+    """
+    index = {(x["benchmark"], x["size"], x["backend"]): x for x in old["results"]}
+    for result in new["results"]:
+        previous = index.get((result["benchmark"], result["size"], result["backend"]))
+        if previous is None:
+            continue
+        for metric, value in result.items():
+            if metric in ("benchmark", "size", "backend") or not previous.get(metric):
+                continue
+            print(
+                "%-15s %7s %-8s %-18s %12.3f -> %12.3f (x%.2f)"
+                % (
+                    result["benchmark"],
+                    result["size"],
+                    result["backend"] or "",
+                    metric,
+                    previous[metric],
+                    value,
+                    value / previous[metric],
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--output", help="Write results to this JSON file.")
+    parser.add_argument("--compare", help="Compare against a previous results file.")
+    args = parser.parse_args()
+    report = {
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": run(args.sizes, args.backends),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+from contextlib import contextmanager
+from types import MappingProxyType
+import gc
+import logging
+import marshal
+import os
+import sys
+
+from quikey.matcher import SuffixMatcher
+from quikey.models import Phrase, PhraseSnapshot
+
+CACHE_FILE = "matcher.cache"
+CACHE_VERSION = 1
+
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the cyclic garbage collector while building many small containers,
+    such as trie nodes. It would otherwise walk the whole heap several times
+    over while they are allocated.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class MatcherCache:
+    """
+    Compiled phrase index in the XDG cache folder: the SuffixMatcher trie of
+    every phrase-key plus the phrase values and options. The daemon loads it
+    on startup instead of reading the whole database and rebuilding the
+    trie.
+
+    The cache is keyed on the mtime and size of the database's files and is
+    ignored as soon as any of them changed. It is written with marshal, so
+    it is also ignored when read by a different Python version.
+
+    It holds every phrase and is unmarshalled as is, so it is created
+    readable by the user only and not loaded when someone else could have
+    written it.
+    """
+
+    def __init__(self, appDirs, cacheFile=CACHE_FILE):
+        self.path = os.path.join(appDirs.cache, cacheFile)
+
+    @staticmethod
+    def signature(database):
+        signature = []
+        for path in database.watchFiles:
+            try:
+                st = os.stat(path)
+                signature.append((os.path.basename(path), st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                signature.append((os.path.basename(path), None, None))
+        return tuple(signature)
+
+    def load(self, database, entry=Phrase):
+        """
+        Return (phrases, matcher) from the cache, or None when there is no
+        cache for the current state of database. Phrases map to instances of
+        entry, Phrase or PhraseRef, which must match what was saved.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                st = os.fstat(f.fileno())
+                if st.st_uid != os.getuid() or st.st_mode & 0o022:
+                    logging.warning(
+                        "Ignoring matcher cache %s, other users can write to it",
+                        self.path,
+                    )
+                    return None
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            with gc_paused():
+                header, signature, phrases, root, size = marshal.loads(data)
+                if header != self.header(entry):
+                    return None
+                if signature != self.signature(database):
+                    return None
+                no_options = PhraseSnapshot.NO_OPTIONS
+                phrases = {
+                    k: entry(v, MappingProxyType(o) if o else no_options)
+                    for k, (v, o) in phrases.items()
+                }
+                return phrases, SuffixMatcher.from_trie(root, size)
+        except (EOFError, ValueError, TypeError):
+            logging.warning("Ignoring unreadable matcher cache %s", self.path)
+            return None
+
+    @staticmethod
+    def header(entry):
+        return (CACHE_VERSION, tuple(sys.version_info[:2]), entry.__name__)
+
+    def save(self, signature, phrases, matcher, entry=Phrase):
+        """
+        Store phrases and matcher as compiled from the database files with
+        the given signature, taken before the database was read.
+        """
+        tmp = self.path + ".tmp"
+        try:
+            data = marshal.dumps(
+                (
+                    self.header(entry),
+                    signature,
+                    {k: (p[0], dict(p.options)) for k, p in phrases.items()},
+                    matcher.root,
+                    len(matcher),
+                )
+            )
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # A leftover temporary file keeps its mode when it is opened.
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.path)
+        except (OSError, ValueError):
+            logging.exception("Failed to write %s", self.path)
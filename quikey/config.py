@@ -0,0 +1,50 @@
+from configparser import ConfigParser
+from os.path import join
+
+CONFIG_FILE = "config.ini"
+
+BACKENDS = ("tinydb", "sqlite", "journal")
+
+
+class Config:
+    """
+    Settings read from config.ini in the XDG config folder, for example:
+
+        [storage]
+        backend = sqlite
+
+        [daemon]
+        buffer_size = 64
+        trigger_keys = enter, space, tab
+
+    The daemon rereads the [daemon] settings on SIGHUP. Settings that are not
+    in the file are None, and the daemon keeps its command line options.
+    """
+
+    def __init__(self, appDirs, configFile=CONFIG_FILE):
+        self.configFile = join(appDirs.config, configFile)
+        self.parser = ConfigParser()
+        self.parser.read(self.configFile)
+
+    @property
+    def backend(self):
+        backend = self.parser.get("storage", "backend", fallback="tinydb")
+        if backend not in BACKENDS:
+            raise ValueError(
+                "Unknown storage backend %s in %s" % (backend, self.configFile)
+            )
+        return backend
+
+    @property
+    def buffer_size(self):
+        size = self.parser.getint("daemon", "buffer_size", fallback=None)
+        if size is not None and size < 0:
+            raise ValueError("Negative buffer_size in %s" % self.configFile)
+        return size
+
+    @property
+    def trigger_keys(self):
+        keys = self.parser.get("daemon", "trigger_keys", fallback=None)
+        if keys is None:
+            return None
+        return keys.replace(",", " ").split()
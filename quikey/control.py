@@ -0,0 +1,116 @@
+from threading import Thread
+import json
+import logging
+import os
+import socket
+import socketserver
+
+SOCKET_FILE = "quikey.sock"
+
+
+class ControlError(Exception):
+    """
+    The daemon could not carry out a control request.
+    """
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """
+    Reads one JSON request per line and answers each with one JSON line:
+    {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                command = self.server.commands[request.pop("command")]
+                response = {"ok": True, "result": command(**request)}
+            except ControlError as e:
+                response = {"ok": False, "error": str(e)}
+            except (ValueError, KeyError, TypeError) as e:
+                response = {"ok": False, "error": "Bad request: %s" % e}
+            except Exception as e:
+                logging.exception("Control request failed")
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class ControlServer(Thread):
+    """
+    Serves control requests from qk on a Unix domain socket in the XDG cache
+    folder. commands maps each command name to a function called with the
+    request's other fields as keyword arguments.
+    """
+
+    def __init__(self, appDirs, commands, socketFile=SOCKET_FILE):
+        super().__init__(daemon=True)
+        self.path = os.path.join(appDirs.cache, socketFile)
+        if os.path.exists(self.path):
+            # Left behind by a daemon that did not shut down cleanly.
+            os.unlink(self.path)
+        # Only the user may connect.
+        umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(
+                self.path, ControlHandler
+            )
+        finally:
+            os.umask(umask)
+        self.server.daemon_threads = True
+        self.server.commands = commands
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ControlClient:
+    """
+    Sends requests to the daemon's ControlServer. Raises OSError when no
+    daemon is listening and ControlError when the daemon refused a request.
+    """
+
+    def __init__(self, appDirs, socketFile=SOCKET_FILE, timeout=10):
+        self.path = os.path.join(appDirs.cache, socketFile)
+        self.timeout = timeout
+
+    def request(self, command, **args):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(self.timeout)
+            s.connect(self.path)
+            s.sendall(json.dumps(dict(args, command=command)).encode("utf-8") + b"\n")
+            with s.makefile("rb") as f:
+                line = f.readline()
+        if not line:
+            raise ConnectionResetError("Quikey daemon closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise ControlError(response["error"])
+        return response["result"]
+
+
+def request(appDirs, command, **args):
+    """
+    Send a request to the running daemon. Returns None, rather than raising,
+    when no daemon is listening. Raises ControlError when the daemon refused
+    the request or could not be asked, such as when it did not answer in
+    time.
+    """
+    try:
+        return ControlClient(appDirs).request(command, **args)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    except OSError as e:
+        # A daemon is there but hung or out of reach. It may still carry out
+        # the request, so callers must not fall back to the database.
+        raise ControlError(
+            "Quikey daemon did not answer on its control socket: %s" % (e.strerror or e)
+        )
@@ -0,0 +1,125 @@
+from pynput.keyboard import Key, KeyCode
+from contextlib import contextmanager
+import inspect
+import time
+
+
+class FakeController:
+    """
+    Records press/release events like pynput.keyboard.Controller so tests and
+    benchmarks can run headless. An optional per-event latency (in seconds)
+    simulates the cost of a real backend.
+
+    When echo is set, it is called with every pressed key, the way a
+    listener sees the keys a real controller types.
+    """
+
+    def __init__(self, latency=0, echo=None):
+        self.events = []
+        self.latency = latency
+        self.echo = echo
+
+    def press(self, key):
+        self._send(("press", key))
+        if self.echo is not None:
+            self.echo(KeyCode.from_char(key) if isinstance(key, str) else key)
+
+    def release(self, key):
+        self._send(("release", key))
+
+    def type(self, text):
+        for char in text:
+            self.press(char)
+            self.release(char)
+
+    @contextmanager
+    def pressed(self, *keys):
+        for key in keys:
+            self.press(key)
+        try:
+            yield
+        finally:
+            for key in reversed(keys):
+                self.release(key)
+
+    def typed(self):
+        """
+        Return the text produced by the recorded events, applying backspaces.
+        """
+        text = []
+        for action, key in self.events:
+            if action != "press":
+                continue
+            if key == Key.backspace:
+                if text:
+                    text.pop()
+            elif isinstance(key, str):
+                text.append(key)
+        return "".join(text)
+
+    def _send(self, event):
+        self.events.append(event)
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeClipboard:
+    """
+    In-memory clipboard.
+    """
+
+    available = True
+
+    def __init__(self, text=""):
+        self.text = text
+        self.writes = 0
+        self.history = []
+
+    def get(self):
+        return self.text
+
+    def set(self, text):
+        self.text = text
+        self.writes = self.writes + 1
+        self.history.append(text)
+
+
+class FakeListener:
+    """
+    Stand-in for pynput.keyboard.Listener. Keys passed to press() are handed
+    straight to the on_press callback on the calling thread.
+    """
+
+    def __init__(self, on_press=None, on_release=None):
+        self.on_press = self._wrap(on_press)
+        self.on_release = self._wrap(on_release)
+        self.running = False
+
+    @staticmethod
+    def _wrap(callback):
+        # Like pynput, only pass the injected flag to callbacks that take it.
+        if callback is None or len(inspect.signature(callback).parameters) > 1:
+            return callback
+        return lambda key, injected: callback(key)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def join(self, timeout=None):
+        pass
+
+    def press(self, key, injected=False):
+        if self.running and self.on_press is not None:
+            self.on_press(key, injected)
+        if self.running and self.on_release is not None:
+            self.on_release(key, injected)
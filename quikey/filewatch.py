@@ -1,29 +1,70 @@
 from threading import Thread
 from inotify_simple import INotify, flags
+import os
+import time
 
 
 class InotifyWatch(Thread):
     """
     Watches for inotify notifications when the databsae file changes. This
     sends notification to any observers added to this monitor.
+
+    The parent directory is watched rather than the file itself so that a
+    database replaced by an atomic rename keeps being watched. Bursts of
+    events that arrive within the debounce window (in seconds) are coalesced
+    into a single notification.
+
+    dbfile may also be a list of files in the same directory, such as an
+    SQLite database and its write-ahead log.
     """
 
-    def __init__(self, dbfile):
+    # Not CLOSE_WRITE: TinyDB opens its file for writing even to read it,
+    # so every qk command would look like a change.
+    WATCH_FLAGS = flags.MODIFY | flags.MOVED_TO | flags.CREATE
+
+    def __init__(self, dbfile, debounce=0.1, poll_interval=0.5):
         super().__init__()
+        if isinstance(dbfile, str):
+            dbfile = [dbfile]
+        self.files = dbfile
+        paths = [os.path.split(os.path.abspath(x)) for x in dbfile]
+        directory = paths[0][0]
+        self.names = {name for _, name in paths}
+        self.debounce = debounce
+        self.poll_interval = poll_interval
         self.inotify = INotify()
-        self.watch = self.inotify.add_watch(dbfile, flags.MODIFY)
+        self.watch = self.inotify.add_watch(directory, self.WATCH_FLAGS)
         self.running = True
         self.observers = []
 
     def stop(self):
-        self.inotify.rm_watch(self.watch)
+        # run() notices within poll_interval and releases the inotify fd.
         self.running = False
 
     def run(self):
-        while self.running:
-            for event in self.inotify.read():
+        try:
+            while self.running:
+                if not self.changed(self.inotify.read(self.poll_interval * 1000)):
+                    continue
+                # Wait until the writer has been quiet for a whole debounce
+                # window before notifying. Other files in the directory, such
+                # as the daemon log, don't count.
+                deadline = time.monotonic() + self.debounce
+                while self.running:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if self.changed(self.inotify.read(remaining * 1000)):
+                        deadline = time.monotonic() + self.debounce
+                if not self.running:
+                    break
                 for observer in self.observers:
                     observer.notify()
+        finally:
+            self.inotify.close()
+
+    def changed(self, events):
+        return any(event.name in self.names for event in events)
 
     def add_observer(self, observer):
         self.observers.append(observer)
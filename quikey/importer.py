@@ -1,97 +1,311 @@
 import os
 import logging
 import json
+from collections import deque, namedtuple
 
+from quikey.policy import ASK, FIRST, ALL, SKIP, MULTIPLE_POLICIES  # noqa: F401
 
-def PhraseFind(location):
+# hashlib and concurrent.futures are imported where they are used, to keep
+# keyimport quick to start.
+
+AutoKeyPhrase = namedtuple("AutoKeyPhrase", ["path", "abbreviations", "value"])
+
+SyncResult = namedtuple("SyncResult", ["added", "updated", "removed", "skipped"])
+
+MANIFEST_FILE = "autokey-manifest.json"
+
+# Returned by check() for a file whose contents did not change.
+UNCHANGED = object()
+
+
+def scan(location):
+    """
+    Yield the path of every AutoKey phrase (.txt) file below location.
+    """
+    stack = [location]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError as e:
+            logging.error("Could not read %s: %s" % (e.filename, e.strerror))
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".txt") and entry.is_file():
+                    yield entry.path
+
+
+def parse(filepath):
+    """
+    Read a phrase file and its hidden .json config file. Returns an
+    AutoKeyPhrase, or None when the file cannot be imported.
+    """
+    filejson = config_path(filepath)
+    # if filejson doesn't exist, skip that file on import
+    try:
+        with open(filejson) as openfile:
+            filedata = json.load(openfile)
+    except FileNotFoundError:
+        logging.error(
+            "json config file does not exist for %s ... Skipping import on this key!"
+            % filepath
+        )
+        return None
+    except json.JSONDecodeError:
+        logging.error(
+            "Invalid json detected on %s. Skipping import on this key." % filejson
+        )
+        return None
+    # check if the 'type' setting is a phrase. If it isn't then skip it
+    if filedata.get("type") != "phrase":
+        logging.warning(
+            "%s is not a 'phrase' type. Skipping import on this key!" % filepath
+        )
+        return None
+    modes = filedata.get("modes") or []
+    # modes in autohotkey are 1 for abbreviation, 3 for hotkey. Use this to check what we want to message
+    if sum(modes) == 1:
+        logging.info("Importing %s." % (filepath))
+    elif sum(modes) == 4:
+        logging.warning(
+            "Modes for %s are both abbreviation and hotkey. Using abbreviation for import"
+            % filepath
+        )
+    elif sum(modes) == 3:
+        # there are too many invalid hotkeys, such as F keys. Skip these for now
+        logging.warning(
+            "Mode for %s is hotkey. Please manually add this phrase with an "
+            "abbreviation, or change from hotkey to abbreviation." % filepath
+        )
+        return None
+    else:
+        logging.error(
+            "Could not auto-detect mode for %s - please manually import this phrase."
+            % filepath
+        )
+        return None
+    abbreviations = filedata.get("abbreviation", {}).get("abbreviations") or []
+    if not abbreviations:
+        logging.error("No abbreviation found for %s. Skipping import." % filepath)
+        return None
+    with open(filepath) as phrasefile:
+        value = phrasefile.read()
+    return AutoKeyPhrase(filepath, abbreviations, value)
+
+
+def config_path(filepath):
+    directory, file = os.path.split(filepath)
+    return os.path.join(directory, "." + file[:-4] + ".json")
+
+
+def parallel(func, items, workers=None, window=64):
+    """
+    Yield func(item) for every item, in order, computed on a thread pool. At
+    most window items are in flight at any time.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def iter_phrases(location, workers=None, window=64):
+    """
+    Parse every phrase below location on a thread pool, yielding
+    AutoKeyPhrases in directory scan order.
+    """
+    for phrase in parallel(parse, scan(location), workers, window):
+        if phrase is not None:
+            yield phrase
+
+
+def choose_keys(phrase, multiple=ASK):
+    """
+    Pick the keys to import a phrase under according to the multiple
+    abbreviation policy.
+    """
+    abbreviation = phrase.abbreviations
+    if len(abbreviation) == 1 or multiple == FIRST:
+        return abbreviation[:1]
+    if multiple == ALL:
+        return list(abbreviation)
+    if multiple == SKIP:
+        logging.warning(
+            "Multiple abbreviations found for %s. Skipping import." % phrase.path
+        )
+        return []
+    print(
+        "Multiple abbreviations were found. Please select which number you would like to use and hit enter.\n"
+    )
+    for entry in abbreviation:
+        print(1 + abbreviation.index(entry), end=" ")
+        print(entry)
+    while True:
+        try:
+            abbreviationselection = int(input("Your selection: ")) - 1
+            if abbreviationselection < 0:
+                raise IndexError
+            return [abbreviation[abbreviationselection]]
+        except IndexError:
+            print(
+                "%s is not a valid selection, please pick a valid entry number."
+                % (abbreviationselection + 1)
+            )
+        except ValueError:
+            print("Selection must be a number, please try again.")
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def PhraseFind(location, multiple=ASK):
     filedict = {}
-    for r, d, f in os.walk(location):
-        for file in f:
-            if ".txt" in file:
-                filepath = os.path.join(r, file)
-                filejson = os.path.join(r, "." + file[:-4] + ".json")
-                # if filejson doesn't exist, skip that file on import
-                if not os.path.isfile(filejson):
-                    logging.error(
-                        "json config file does not exist for %s ... Skipping import on this key!"
-                        % filepath
-                    )
-                    continue
-                else:
-                    with open(filejson) as openfile:
-                        try:
-                            filedata = json.load(openfile)
-                        except json.JSONDecodeError:
-                            logging.error(
-                                "Invalid json detected on %s. Skipping import on this key."
-                                % filejson
-                            )
-                            continue
-                    # check if the 'type' setting is a phrase. If it isn't then skip it
-                    if filedata.get("type") == "phrase":
-                        modes = filedata.get("modes")
-                        # modes in autohotkey are 1 for abbreviation, 3 for hotkey. Use this to check what we want to message
-                        if sum(modes) == 1:
-                            abbreviation = filedata.get("abbreviation", {}).get(
-                                "abbreviations"
-                            )
-                            logging.info("Importing %s." % (filepath))
-                        elif sum(modes) == 4:
-                            abbreviation = filedata.get("abbreviation", {}).get(
-                                "abbreviations"
-                            )
-                            logging.warning(
-                                "Modes for %s are both abbreviation and hotkey. Using abbreviation for import"
-                                % filepath
-                            )
-                        elif sum(modes) == 3:
-                            # there are too many invalid hotkeys, such as F keys. Skip these for now
-                            logging.warning(
-                                "Mode for %s is hotkey. Please manually add this phrase with an abbreviation, or change from hotkey to abbreviation."
-                                % filepath
-                            )
-                            continue
-                        else:
-                            logging.error(
-                                "Could not auto-detect mode for %s - please manually import this phrase."
-                                % filepath
-                            )
-                            continue
-                        with open(filepath) as phrasefile:
-                            value = phrasefile.read()
-                        if len(abbreviation) > 1:
-                            print(
-                                "Multiple abbreviations were found. Please select which number you would like to use and hit enter.\n"
-                            )
-                            for entry in abbreviation:
-                                print(1 + abbreviation.index(entry), end=" ")
-                                print(entry)
-                            while True:
-                                try:
-                                    abbreviationselection = (
-                                        int(input("Your selection: ")) - 1
-                                    )
-                                    key = abbreviation[abbreviationselection]
-                                except IndexError:
-                                    print(
-                                        "%s is not a valid selection, please pick a valid entry number."
-                                        % abbreviationselection
-                                    )
-                                    continue
-                                except ValueError:
-                                    print(
-                                        "Selection must be a number, please try again."
-                                    )
-                                    continue
-                                else:
-                                    break
-                        else:
-                            key = abbreviation[0]
-                        filedict[key] = value
-                    else:
-                        print(
-                            "%s is not a 'phrase' type. Skipping import on this key!"
-                            % filepath
-                        )
-                        continue
+    for phrase in iter_phrases(location):
+        for key in choose_keys(phrase, multiple):
+            filedict[key] = phrase.value
     return filedict
+
+
+class Manifest:
+    """
+    Remembers, per AutoKey folder, the signature (mtime and size), content
+    hash and imported keys of every phrase file synced with
+    qk keyimport --sync.
+    """
+
+    def __init__(self, appDirs, manifestFile=MANIFEST_FILE):
+        self.path = os.path.join(appDirs.data, manifestFile)
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {}
+
+    def entries(self, location):
+        return self.data.setdefault(os.path.abspath(location), {})
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+
+
+def signature(filepath):
+    signature = []
+    for path in (filepath, config_path(filepath)):
+        try:
+            st = os.stat(path)
+            signature.extend([st.st_mtime_ns, st.st_size])
+        except FileNotFoundError:
+            signature.extend([None, None])
+    return signature
+
+
+def digest(filepath):
+    import hashlib
+
+    h = hashlib.sha256()
+    for path in (filepath, config_path(filepath)):
+        try:
+            with open(path, "rb") as f:
+                h.update(f.read())
+        except FileNotFoundError:
+            pass
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def check(filepath, entry):
+    """
+    Return (signature, hash, phrase) for a phrase file that changed since the
+    manifest entry was recorded, where phrase is UNCHANGED when only the
+    mtime moved. Returns None for a file that was not touched.
+    """
+    sig = signature(filepath)
+    if entry is not None and entry["signature"] == sig:
+        return None
+    h = digest(filepath)
+    if entry is not None and entry["hash"] == h:
+        return sig, h, UNCHANGED
+    return sig, h, parse(filepath)
+
+
+def sync(
+    db, location, manifest, multiple=ASK, overwrite=False, prune=False, workers=None
+):
+    """
+    Bring the phrases imported from location up to date. Only files whose
+    mtime or size changed since the last sync are read. Phrases whose source
+    file was deleted are removed when prune is set.
+
+    Keys that exist in the database but were not imported from location are
+    left alone unless overwrite is set.
+    """
+    location = os.path.abspath(location)
+    entries = manifest.entries(location)
+    owned = {key for entry in entries.values() for key in entry["keys"]}
+    seen = set()
+
+    def scanned():
+        for filepath in scan(location):
+            seen.add(filepath)
+            yield filepath
+
+    phrases = {}
+    sources = {}
+    stale = set()
+    checked = parallel(lambda x: (x, check(x, entries.get(x))), scanned(), workers)
+    for filepath, result in checked:
+        if result is None:
+            continue
+        sig, h, phrase = result
+        entry = entries.get(filepath)
+        if phrase is UNCHANGED:
+            entry["signature"] = sig
+            continue
+        keys = choose_keys(phrase, multiple) if phrase is not None else []
+        if entry is not None:
+            stale.update(set(entry["keys"]) - set(keys))
+        for key in keys:
+            phrases[key] = phrase.value
+            sources[key] = filepath
+        entries[filepath] = {"signature": sig, "hash": h, "keys": keys}
+    for filepath in set(entries) - seen:
+        if prune:
+            stale.update(entries.pop(filepath)["keys"])
+
+    existing = db.get_many(phrases.keys())
+    skipped = []
+    for key in list(phrases):
+        if key in existing and key not in owned and not overwrite:
+            skipped.append(key)
+            del phrases[key]
+            entries[sources[key]]["keys"].remove(key)
+    # A key may have moved from one file to another.
+    stale = (stale - phrases.keys()) & owned
+    db.put_many(phrases, ["autokey-imports"])
+    db.delete_many(stale)
+    manifest.save()
+    return SyncResult(
+        sorted(phrases.keys() - existing.keys()),
+        sorted(phrases.keys() & existing.keys()),
+        sorted(stale),
+        sorted(skipped),
+    )
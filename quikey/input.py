@@ -1,88 +1,338 @@
 from pynput.keyboard import Key, Controller, Listener, KeyCode
-import re
 from collections import deque
+from contextlib import contextmanager
+from threading import Thread, Event
+import logging
+import time
 
+from quikey.matcher import SuffixMatcher, PatternMatcher, InstantMatcher
+from quikey.stats import stats
+from quikey.output import send, backspace_events
 
-class PhraseHandler:
+
+class KeyBuffer:
+    """
+    Fixed-size ring buffer of recently typed characters. Appending and
+    popping are O(1) and, once full, appending overwrites the oldest
+    character.
+
+    Iterating with reversed() yields characters newest first without building
+    a string, which is how the Notifier's matcher consumes the buffer.
     """
-    Watches for notifications about new incoming phrases. A single
-    PhraseHandler is created for each phrase-key in the database.
 
-    PhraseHandler also "types out" the value matching a phrase-key.
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.chars = [None] * maxlen
+        self.start = 0
+        self.length = 0
 
-    The user input is checked with trailing characters with priority. A regular
-    expression is interanlly created like this: .*<key>. For example, if you
-    have a phrase key called "hello", the regular expression would be: .*hello
+    def __len__(self):
+        return self.length
 
-    If a user types "blahblahhello<Enter>", their phrase would be triggered.
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.chars[(self.start + i) % self.maxlen]
+
+    def __reversed__(self):
+        for i in range(self.length - 1, -1, -1):
+            yield self.chars[(self.start + i) % self.maxlen]
+
+    def __str__(self):
+        return self.suffix(self.length)
+
+    def append(self, char):
+        if self.maxlen == 0:
+            return
+        if self.length == self.maxlen:
+            self.chars[self.start] = char
+            self.start = (self.start + 1) % self.maxlen
+        else:
+            self.chars[(self.start + self.length) % self.maxlen] = char
+            self.length = self.length + 1
+
+    def pop(self):
+        if self.length == 0:
+            raise IndexError("pop from an empty KeyBuffer")
+        self.length = self.length - 1
+        return self.chars[(self.start + self.length) % self.maxlen]
+
+    def clear(self):
+        self.start = 0
+        self.length = 0
+
+    def resized(self, maxlen):
+        """
+        Return a KeyBuffer of maxlen holding the newest characters of this
+        one.
+        """
+        buffer = KeyBuffer(maxlen)
+        for char in self:
+            buffer.append(char)
+        return buffer
+
+    def suffix(self, count):
+        """
+        Return the last count characters as a string.
+        """
+        count = min(count, self.length)
+        return "".join(
+            self.chars[(self.start + i) % self.maxlen]
+            for i in range(self.length - count, self.length)
+        )
+
+
+class PhraseHandler:
+    """
+    Types out the value matching a phrase-key through an OutputEngine. A
+    single PhraseHandler is created for each phrase-key in the database.
+
+    The Notifier decides which PhraseHandler should fire. A PhraseHandler
+    still answers notify() on its own: if a user types
+    "blahblahhello<Enter>" and the phrase key is "hello", the phrase is
+    triggered.
+
+    With the "pattern" option the key is a regular expression, and groups
+    it captured are substituted into the value wherever it has \\1 or
+    \\g<name>, as in re.Match.expand(). With the "instant" option a literal
+    key expands as soon as its last character is typed.
     """
 
-    def __init__(self, key, database, keyboard):
+    def __init__(self, key, database, output):
         self.key = key
-        escaped = re.escape(key)
         self.db = database
-        self.regex = re.compile("^.*" + escaped + "$")
-        self.keyboard = keyboard
+        self.output = output
+        options = database.options(key)
+        self.pattern = options.get("pattern") is True
+        self.instant = options.get("instant") is True and not self.pattern
 
     def notify(self, incomingkey):
-        if self.regex.match(incomingkey):
-            phrase = self.db.get(self.key)
-            self.backspace(len(self.key) + 1)
-            self.keyboard.type(phrase)
-            return True
+        if self.pattern:
+            found = PatternMatcher([self.key]).match(incomingkey)
+            return found is not None and self.expand(found[1])
+        if incomingkey.endswith(self.key):
+            return self.expand()
         return False
 
-    def backspace(self, count):
-        i = 0
-        while i < count:
-            self.keyboard.press(Key.backspace)
-            self.keyboard.release(Key.backspace)
-            i = i + 1
+    def expand(self, match=None, trailing=1):
+        phrase = self.db.get(self.key)
+        if phrase is None:
+            # Phrase was removed by a reload that is still in progress.
+            return False
+        typed = self.key
+        if match is not None:
+            phrase = match.expand(phrase)
+            typed = match.group(0)
+        mode = self.db.options(self.key).get("output")
+        self.output.expand(typed, phrase, mode, trailing)
+        return True
 
 
 class Notifier:
     """
-    Class composed of PhraseHandlers. Each observer called when new key input
-    is ready to be checked against phrase database.
-
-    Notifier acquires a global lock while iterating observers. This prevents
-    infinite loops when a value being "typed out" contains a phrase-key.
-    i.e. we don't want the automated keyboard typing to be picked up by this app.
+    Class composed of PhraseHandlers. All phrase-keys are compiled into a
+    single SuffixMatcher so that new key input is checked against the whole
+    phrase database in one pass. The PhraseHandler of the longest matching
+    key is the one that gets called.
+
+    The matcher only holds the keys, so a compiled matcher can be cached
+    and handed to replace() as is. Pattern keys are kept apart in a
+    PatternMatcher, which is only asked when no literal key matched. Keys
+    of instant phrases are also compiled into an InstantMatcher, which
+    InstantState steps through as keys are typed. The automaton is rebuilt
+    whenever an instant key is added or removed, so changes to many keys
+    should be made inside batch(), which rebuilds it once at the end.
+
+    Notifier holds its lock while expanding a phrase so only one expansion
+    types at a time. Keeping the typed out value from being picked up by
+    this app again is InputWorker's job.
     """
 
     def __init__(self, lock):
-        self.observers = []
+        self.handlers = {}
+        self.matcher = SuffixMatcher()
+        self.patterns = PatternMatcher()
+        self.instant = InstantMatcher()
+        self.instant_keys = None  # Pending instant keys inside batch()
         self.lock = lock
 
+    @property
+    def observers(self):
+        return list(self.handlers.values())
+
     def clear(self):
-        self.observers = []
+        self.handlers = {}
+        self.matcher = SuffixMatcher()
+        self.patterns = PatternMatcher()
+        self.instant = InstantMatcher()
+
+    @staticmethod
+    def is_pattern(observer):
+        return getattr(observer, "pattern", False) is True
+
+    @staticmethod
+    def is_instant(observer):
+        return getattr(observer, "instant", False) is True
 
     def add(self, observer):
-        self.observers.append(observer)
+        self.handlers[observer.key] = observer
+        if self.is_pattern(observer):
+            self.patterns.add(observer.key)
+        else:
+            self.matcher.add(observer.key, None)
+        if self.is_instant(observer):
+            self.set_instant(self.get_instant() | {observer.key})
+
+    def remove(self, key):
+        self.handlers.pop(key, None)
+        keys = self.get_instant()
+        if key in keys:
+            self.set_instant(keys - {key})
+        return self.matcher.remove(key) or self.patterns.remove(key)
+
+    def get_instant(self):
+        if self.instant_keys is not None:
+            return self.instant_keys
+        return self.instant.keys
+
+    def set_instant(self, keys):
+        if self.instant_keys is not None:
+            self.instant_keys = keys
+        else:
+            self.instant = InstantMatcher(keys)
+
+    @contextmanager
+    def batch(self):
+        """
+        Rebuild the InstantMatcher once for all the add() and remove() calls
+        made inside. Until then instant keys added meanwhile don't expand.
+        """
+        self.instant_keys = self.instant.keys
+        try:
+            yield
+        finally:
+            keys, self.instant_keys = self.instant_keys, None
+            if keys != self.instant.keys:
+                self.instant = InstantMatcher(keys)
+
+    def replace(self, observers, matcher=None):
+        # Build the new matchers completely before swapping them in so a
+        # concurrent notify() never sees a half-populated matcher.
+        handlers = {x.key: x for x in observers}
+        patterns = PatternMatcher(k for k, x in handlers.items() if self.is_pattern(x))
+        if matcher is None:
+            matcher = SuffixMatcher(
+                (k, None) for k, x in handlers.items() if not self.is_pattern(x)
+            )
+        instant = InstantMatcher(k for k, x in handlers.items() if self.is_instant(x))
+        self.handlers = handlers
+        self.patterns = patterns
+        self.matcher = matcher
+        self.instant = instant
 
     def notify(self, key):
-        # Acquire lock to that any output from an observer hanlding the
-        # phrase-key do not get piped back into this app.
+        start = time.perf_counter() if stats.enabled else 0
+        match = self.matcher.match(key)
+        groups = None
+        if match is None and len(self.patterns):
+            match = self.patterns.match(str(key))
+            if match is not None:
+                groups = match[1]
+        if stats.enabled:
+            stats.record("match", time.perf_counter() - start)
+        if match is None:
+            return False
+        observer = self.handlers.get(match[0])
+        if observer is None:
+            # Removed by a reload that is still in progress.
+            return False
         self.lock.acquire()
-        for observer in self.observers:
-            try:
-                if observer.notify(key):
-                    # Release lock since one of observers handled the phrase-key.
-                    self.lock.release()
-                    return True
-            except:
-                # TODO: What types of exceptions would be raised here?
-                pass
-        # No observers hanlded the phrase-key so go head and release lock.
-        self.lock.release()
-        return False
+        try:
+            if groups is not None:
+                return observer.expand(groups)
+            return observer.expand()
+        except Exception:
+            logging.exception("Failed to expand phrase %s", observer.key)
+            return False
+        finally:
+            self.lock.release()
+            if stats.enabled:
+                stats.record("expansion", time.perf_counter() - start)
+
+    def notify_instant(self, key):
+        """
+        Expand the instant phrase whose key was just typed. Nothing follows
+        the key, so only the key itself is erased.
+        """
+        start = time.perf_counter() if stats.enabled else 0
+        observer = self.handlers.get(key)
+        if observer is None:
+            return False
+        self.lock.acquire()
+        try:
+            return observer.expand(trailing=0)
+        except Exception:
+            logging.exception("Failed to expand phrase %s", observer.key)
+            return False
+        finally:
+            self.lock.release()
+            if stats.enabled:
+                stats.record("expansion", time.perf_counter() - start)
+
+
+class InstantState:
+    """
+    Position in the Notifier's InstantMatcher after each character in the
+    key buffer, newest last, so a backspace can go back one step. Holds at
+    most as many states as the buffer holds characters.
+
+    When the Notifier swaps in a new InstantMatcher the states no longer
+    apply, and matching starts over from the next character typed.
+    """
+
+    def __init__(self, notifier, maxlen):
+        self.notifier = notifier
+        self.matcher = notifier.instant
+        self.states = deque(maxlen=maxlen)
+
+    def advance(self, char):
+        """
+        Step over char and expand an instant phrase whose key it completes.
+        Returns True when a phrase was expanded.
+        """
+        matcher = self.notifier.instant
+        if matcher is not self.matcher:
+            self.matcher = matcher
+            self.states.clear()
+        if not len(matcher):
+            return False
+        state = self.states[-1] if self.states else matcher.ROOT
+        state = matcher.step(state, char)
+        self.states.append(state)
+        key = matcher.match(state)
+        return key is not None and self.notifier.notify_instant(key)
+
+    def rollback(self):
+        if self.states:
+            self.states.pop()
+
+    def clear(self):
+        self.states.clear()
+
+    def resize(self, maxlen):
+        self.states = deque(self.states, maxlen=maxlen)
 
 
 class AlphaNumHandler:
     """
     Handles alphanumeric input, appending to key input buffer.
+
+    The InputHandler sets instant to its InstantState, which is advanced
+    over every character appended.
     """
 
+    def __init__(self):
+        self.instant = None
+
     def verify(self, key):
         return type(key) == KeyCode
 
@@ -90,20 +340,25 @@ class AlphaNumHandler:
         if not self.verify(key):
             return False
 
-        if len(keybuff) == keybuff.maxlen:
-            # Pop off front of queue if at max length.
-            keybuff.popleft()
-        # Push new input onto end of queue.
+        # Push new input onto end of buffer. Oldest input falls off the front
+        # once the buffer is at max length.
         if key.char is not None:
             keybuff.append(key.char)
+            if self.instant is not None and self.instant.advance(key.char):
+                keybuff.clear()
+                self.instant.clear()
         return True
 
 
 class DeleteHandler:
     """
-    Handles delete/backspace input, adjusting key input buffer.
+    Handles delete/backspace input, adjusting key input buffer and rolling
+    back the InstantState with it.
     """
 
+    def __init__(self):
+        self.instant = None
+
     def verify(self, key):
         return key == Key.backspace
 
@@ -113,6 +368,8 @@ class DeleteHandler:
         if len(keybuff) > 0:
             # Pop off end of queue as long as there is an item in queue.
             keybuff.pop()
+            if self.instant is not None:
+                self.instant.rollback()
         return True
 
 
@@ -121,12 +378,16 @@ class SpaceHandler:
     Special handling for space.
     """
 
+    def __init__(self):
+        self.instant = None
+
     def onkey(self, key, keybuff):
         if key != Key.space:
             return False
-        if len(keybuff) == keybuff.maxlen:
-            keybuff.popleft()
         keybuff.append(" ")
+        if self.instant is not None and self.instant.advance(" "):
+            keybuff.clear()
+            self.instant.clear()
         return True
 
 
@@ -137,11 +398,15 @@ class TriggerPhraseHandler:
     """
 
     def __init__(self, trigger_keys):
-        self.triggerkeys = []
+        self.set_keys(trigger_keys)
+
+    def set_keys(self, trigger_keys):
+        triggerkeys = []
         for key in trigger_keys:
             key = key.strip()
             if len(key) > 0 and key in Key.__members__:
-                self.triggerkeys.append(Key[key])
+                triggerkeys.append(Key[key])
+        self.triggerkeys = triggerkeys
 
     def verify(self, key):
         return key in self.triggerkeys
@@ -155,28 +420,28 @@ class InputHandler:
     Handles keyboard input, calling each key-specific handler.
     """
 
-    def __init__(self, lock, notifier, buffer_size, trigger_keys):
-        self.keybuff = deque(maxlen=buffer_size)
-        self.lock = lock
+    def __init__(self, notifier, buffer_size, trigger_keys):
+        self.keybuff = KeyBuffer(buffer_size)
         self.notifier = notifier
         self.subhandlers = []
         self.triggerhandler = TriggerPhraseHandler(trigger_keys)
-
-    def dequetostr(self):
-        ret = u""
-        for x in self.keybuff:
-            ret = ret + x
-        return ret
+        self.instant = InstantState(notifier, buffer_size)
 
     def __call__(self, key):
-        if self.lock.locked():
-            # Skip. Something else has acquired lock.
+        if not stats.enabled:
+            self.onkey(key)
             return
+        start = time.perf_counter()
+        self.onkey(key)
+        stats.record("keystroke", time.perf_counter() - start)
+
+    def onkey(self, key):
         # Check if trigger key pressed
         if self.triggerhandler.onkey(key):
-            if self.notifier.notify(self.dequetostr()):
+            if self.notifier.notify(self.keybuff):
                 # A phrase was found and typed out. Clear queue and return.
                 self.keybuff.clear()
+                self.instant.clear()
                 return
         for handler in self.subhandlers:
             result = handler.onkey(key, self.keybuff)
@@ -184,14 +449,89 @@ class InputHandler:
                 return
 
     def add_handler(self, handler):
+        if hasattr(handler, "instant"):
+            handler.instant = self.instant
         self.subhandlers.append(handler)
 
+    def configure(self, buffer_size=None, trigger_keys=None):
+        """
+        Change the buffer size or trigger keys while keys are being handled.
+        The resized buffer keeps the newest characters. Each change is a
+        single attribute assignment, so a key handled meanwhile sees either
+        the old setting or the new one.
+        """
+        if buffer_size is not None and buffer_size != self.keybuff.maxlen:
+            self.keybuff = self.keybuff.resized(buffer_size)
+            self.instant.resize(buffer_size)
+        if trigger_keys is not None:
+            self.triggerhandler.set_keys(trigger_keys)
+
+
+class InputWorker(Thread):
+    """
+    Runs an InputHandler on its own thread so the pynput listener callback
+    only has to queue the key and return. Matching, database reads and
+    typing out phrases no longer hold up the OS input hook.
+
+    The queue is a deque, whose append and popleft are atomic, holding at
+    most capacity keys. Keys arriving while it is full are dropped and
+    counted.
+
+    Keys the daemon typed itself are recognised by the listener's injected
+    flag or by the OutputEngine's InjectedKeys and never queued, so an
+    expanded value can't trigger another expansion. Real keys pressed while
+    a phrase is being typed wait in the queue and are handled right after.
+    """
+
+    def __init__(self, handler, injected=None, capacity=1024):
+        super().__init__(daemon=True)
+        self.handler = handler
+        self.injected = injected
+        self.capacity = capacity
+        self.events = deque()
+        self.ready = Event()
+        self.running = True
+        self.dropped = 0
+
+    def __call__(self, key, injected=False):
+        if injected or (self.injected is not None and self.injected.match(key)):
+            return
+        depth = len(self.events)
+        if depth >= self.capacity:
+            self.dropped += 1
+            stats.increment("queue_dropped")
+            return
+        self.events.append((time.perf_counter(), key))
+        self.ready.set()
+        stats.maximum("queue_depth_max", depth + 1)
+
+    def run(self):
+        while self.running:
+            self.ready.wait()
+            # Cleared before draining so a key queued meanwhile sets it again.
+            self.ready.clear()
+            self.drain()
+
+    def drain(self):
+        while self.running and self.events:
+            queued, key = self.events.popleft()
+            if stats.enabled:
+                stats.record("queue", time.perf_counter() - queued)
+            try:
+                self.handler(key)
+            except Exception:
+                logging.exception("Failed to handle key %s", key)
+
+    def stop(self):
+        self.running = False
+        self.ready.set()
 
-def backspace(count):
-    keyboard = Controller()
 
-    i = 0
-    while i < count:
-        keyboard.press(Key.backspace)
-        keyboard.release(Key.backspace)
-        i = i + 1
+keyboard = None
+
+
+def backspace(count):
+    global keyboard
+    if keyboard is None:
+        keyboard = Controller()
+    send(keyboard, backspace_events(count))
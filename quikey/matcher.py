@@ -0,0 +1,486 @@
+from collections import deque
+import logging
+import re
+
+
+class SuffixMatcher:
+    """
+    Matches the end of the key input buffer against every phrase-key at once.
+
+    Keys are stored in a trie built from the reversed key strings. Matching
+    walks backwards from the last character typed, so the cost of a lookup is
+    proportional to the length of the longest key rather than the number of
+    phrases in the database.
+
+    When one key is a suffix of another (e.g. "lo" and "hello"), the longest
+    key that matches the end of the input wins.
+    """
+
+    # Marks a trie node that terminates a key. Never a valid character since
+    # buffer entries are always strings.
+    TERMINAL = None
+
+    def __init__(self, items=None):
+        self.root = {}
+        self.size = 0
+        if items is not None:
+            for key, value in items:
+                self.add(key, value)
+
+    @classmethod
+    def from_trie(cls, root, size):
+        """
+        Wrap a trie taken from another SuffixMatcher's root, such as one read
+        back from the matcher cache.
+        """
+        matcher = cls()
+        matcher.root = root
+        matcher.size = size
+        return matcher
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        node = self._find(key)
+        return node is not None and self.TERMINAL in node
+
+    def add(self, key, value):
+        if not key:
+            return
+        node = self.root
+        for char in reversed(key):
+            node = node.setdefault(char, {})
+        if self.TERMINAL not in node:
+            self.size = self.size + 1
+        node[self.TERMINAL] = (key, value)
+
+    def remove(self, key):
+        if not key:
+            return False
+        path = []
+        node = self.root
+        for char in reversed(key):
+            path.append((node, char))
+            node = node.get(char)
+            if node is None:
+                return False
+        if self.TERMINAL not in node:
+            return False
+        del node[self.TERMINAL]
+        self.size = self.size - 1
+        # Prune nodes that no longer lead to any key.
+        for parent, char in reversed(path):
+            if parent[char]:
+                break
+            del parent[char]
+        return True
+
+    def clear(self):
+        self.root = {}
+        self.size = 0
+
+    def match(self, text):
+        """
+        Return the (key, value) pair of the longest key that ends ``text``, or
+        None when no key matches.
+        """
+        return self.match_reversed(reversed(text))
+
+    def match_reversed(self, chars):
+        """
+        Same as match() but takes the input one character at a time, starting
+        with the most recently typed character.
+        """
+        node = self.root
+        found = None
+        for char in chars:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get(self.TERMINAL, found)
+        return found
+
+    def _find(self, key):
+        node = self.root
+        for char in reversed(key):
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+
+def uncaptured(pattern):
+    """
+    Rewrite the capturing groups of a regular expression as non-capturing
+    ones, so several patterns can be joined without their group numbers or
+    names clashing.
+    """
+    out = []
+    i = 0
+    in_class = False
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            out.append(pattern[i : i + 2])
+            i = i + 2
+            continue
+        if in_class:
+            if char == "]":
+                in_class = False
+        elif char == "[":
+            in_class = True
+            # A ] straight after [ or [^ is part of the class.
+            end = i + 1
+            if pattern.startswith("^", end):
+                end = end + 1
+            if pattern.startswith("]", end):
+                end = end + 1
+            out.append(pattern[i:end])
+            i = end
+            continue
+        elif char == "(":
+            if not pattern.startswith("?", i + 1):
+                out.append("(?:")
+                i = i + 1
+                continue
+            if pattern.startswith("?P<", i + 1):
+                out.append("(?:")
+                i = pattern.index(">", i) + 1
+                continue
+        out.append(char)
+        i = i + 1
+    return "".join(out)
+
+
+def alternates(pattern):
+    """
+    Return True when a regular expression has alternatives at the top level,
+    such as "ab|cd", which each start and end with text of their own.
+    """
+    depth = 0
+    in_class = False
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth = depth + 1
+        elif char == ")":
+            depth = depth - 1
+        elif char == "|" and depth == 0:
+            return True
+    return False
+
+
+SPECIAL = ".^$*+?{}[]\\|()"
+
+
+def literal_prefix(pattern):
+    """
+    Return the plain text every match of a regular expression starts with,
+    such as "addr" for "addr\\d+", or "" when there is none.
+    """
+    if alternates(pattern):
+        return ""
+    prefix = []
+    for char in pattern:
+        if char in SPECIAL:
+            if char in "*+?{" and prefix:
+                # The quantifier makes the character before it optional.
+                prefix.pop()
+            break
+        prefix.append(char)
+    return "".join(prefix)
+
+
+def literal_suffix(pattern):
+    """
+    Return the plain text every match of a regular expression ends with,
+    such as "km" for "\\d+km", or "" when there is none.
+    """
+    if alternates(pattern):
+        return ""
+    end = len(pattern)
+    # A character after a backslash may be part of an escape like \\d.
+    while end > 0 and pattern[end - 1] not in SPECIAL:
+        if end > 1 and pattern[end - 2] == "\\":
+            break
+        end = end - 1
+    return pattern[end:]
+
+
+class PatternMatcher:
+    """
+    Matches the end of the key input buffer against every pattern key, a
+    regular expression such as "addr\\d", at once.
+
+    Python's re has no DFA, so one regex joining every pattern costs time in
+    proportion to the number of patterns. Instead patterns are indexed in a
+    trie by the plain text they start with. For each position in the buffer
+    the trie yields the few patterns that can start there, and only those are
+    tried. Patterns without such a prefix but that end in plain text, like
+    "\\d+km", are indexed in a second trie by that text reversed, walked back
+    from the end of the buffer. Either way the cost of a match doesn't
+    depend on how many patterns there are.
+
+    The rest are tried on every match: those that can be joined into one
+    regex of the form ".*?(?:(p0)|(p1)|...)", whose lazy prefix finds the
+    earliest start, and those that can't, such as ones with inline flags
+    like "(?i)" or backreferences, one at a time.
+
+    The pattern matching the longest end of the buffer wins, and among
+    matches of the same length the pattern added first. Patterns that are
+    not valid or that match an empty string are logged and left out.
+    """
+
+    TERMINAL = None
+
+    def __init__(self, keys=None):
+        self.patterns = {}
+        self.order = 0
+        self.prefixes = {}
+        self.suffixes = {}
+        self.compiled = None
+        if keys is not None:
+            for key in keys:
+                self.add(key)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __contains__(self, key):
+        return key in self.patterns
+
+    @staticmethod
+    def validate(key):
+        """
+        Compile key, raising ValueError with the reason when it can't be
+        used as a pattern key.
+        """
+        try:
+            pattern = re.compile(key)
+        except re.error as e:
+            raise ValueError(str(e))
+        if pattern.fullmatch(""):
+            raise ValueError("it matches nothing typed")
+        return pattern
+
+    def add(self, key):
+        if key in self.patterns:
+            self.remove(key)
+        try:
+            pattern = self.validate(key)
+        except ValueError as e:
+            logging.warning("Ignoring pattern key %s: %s", key, e)
+            return False
+        prefix = suffix = ""
+        wrapped = None
+        # Flags like (?i) change what the plain text in the pattern matches,
+        # and only apply to a whole regex.
+        if not pattern.flags & ~re.UNICODE:
+            prefix = literal_prefix(key)
+            suffix = "" if prefix else literal_suffix(key)
+            if not prefix and not suffix:
+                try:
+                    wrapped = re.compile("(%s)" % uncaptured(key)).pattern
+                except re.error:
+                    # Such as a backreference, tried on its own instead.
+                    pass
+        self.order = self.order + 1
+        self.patterns[key] = (pattern, prefix, suffix, wrapped, self.order)
+        if prefix:
+            self.index(self.prefixes, prefix, key)
+        elif suffix:
+            self.index(self.suffixes, suffix[::-1], key)
+        else:
+            self.compiled = None
+        return True
+
+    def index(self, trie, text, key):
+        node = trie
+        for char in text:
+            node = node.setdefault(char, {})
+        node.setdefault(self.TERMINAL, []).append(key)
+
+    def unindex(self, trie, text, key):
+        path = []
+        node = trie
+        for char in text:
+            path.append((node, char))
+            node = node[char]
+        node[self.TERMINAL].remove(key)
+        if not node[self.TERMINAL]:
+            del node[self.TERMINAL]
+        for parent, char in reversed(path):
+            if parent[char]:
+                break
+            del parent[char]
+
+    def remove(self, key):
+        entry = self.patterns.pop(key, None)
+        if entry is None:
+            return False
+        _, prefix, suffix, _, _ = entry
+        if prefix:
+            self.unindex(self.prefixes, prefix, key)
+        elif suffix:
+            self.unindex(self.suffixes, suffix[::-1], key)
+        else:
+            self.compiled = None
+        return True
+
+    def compile(self):
+        joined = []
+        separate = []
+        for key, (_, prefix, suffix, wrapped, _) in self.patterns.items():
+            if wrapped is not None:
+                joined.append(key)
+            elif not prefix and not suffix:
+                separate.append(key)
+        combined = None
+        if joined:
+            combined = re.compile(
+                ".*?(?:%s)" % "|".join(self.patterns[k][3] for k in joined), re.DOTALL
+            )
+        # Built fully before it's assigned, for a concurrent match().
+        self.compiled = (combined, joined, separate)
+        return self.compiled
+
+    def earliest(self, key, text, best):
+        """
+        Return (start, order, key) for the earliest start at which key
+        matches the rest of text, when that beats best.
+        """
+        pattern, _, _, _, order = self.patterns[key]
+        for start in range(len(text)):
+            candidate = (start, order, key)
+            if best is not None and best <= candidate:
+                break
+            if pattern.fullmatch(text, start):
+                return candidate
+        return best
+
+    def match(self, text):
+        """
+        Return (key, match) for the pattern that matches the longest end of
+        text, where match is the re.Match of that pattern alone, or None
+        when no pattern matches.
+        """
+        if not self.patterns:
+            return None
+        best = None
+        combined, joined, separate = self.compiled or self.compile()
+        if combined is not None:
+            found = combined.fullmatch(text)
+            if found is not None:
+                key = joined[found.lastindex - 1]
+                best = (found.start(found.lastindex), self.patterns[key][4], key)
+        for key in separate:
+            best = self.earliest(key, text, best)
+        node = self.suffixes
+        for char in reversed(text):
+            node = node.get(char)
+            if node is None:
+                break
+            for key in node.get(self.TERMINAL, ()):
+                best = self.earliest(key, text, best)
+        for start in range(len(text)):
+            if best is not None and best[0] < start:
+                break
+            node = self.prefixes
+            for char in text[start:]:
+                node = node.get(char)
+                if node is None:
+                    break
+                for key in node.get(self.TERMINAL, ()):
+                    pattern, _, _, _, order = self.patterns[key]
+                    candidate = (start, order, key)
+                    if best is not None and best <= candidate:
+                        continue
+                    if pattern.fullmatch(text, start):
+                        best = candidate
+        if best is None:
+            return None
+        start, _, key = best
+        return key, self.patterns[key][0].fullmatch(text, start)
+
+
+class InstantMatcher:
+    """
+    Aho-Corasick automaton over the keys of phrases that expand as soon as
+    their last character is typed, without a trigger key.
+
+    The key input is fed in one character at a time with step(), which
+    returns the next state, and match() tells which key, if any, ends at a
+    state. A state is a plain int, so the caller can keep a stack of them
+    and go back a step on backspace.
+
+    Transitions that follow failure links are remembered the first time
+    they are taken, so a step costs the same no matter how many keys there
+    are. The automaton is never changed once built; adding or removing a key
+    builds a new one.
+
+    When a key is a suffix of the text typed so far it matches, and the
+    longest such key wins. A key that begins with a shorter key can
+    therefore never match, as the shorter key fires first.
+    """
+
+    ROOT = 0
+
+    def __init__(self, keys=()):
+        self.keys = frozenset(k for k in keys if k)
+        self.goto = [{}]
+        self.fail = [self.ROOT]
+        self.output = [None]
+        for key in self.keys:
+            state = self.ROOT
+            for char in key:
+                nxt = self.goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(self.ROOT)
+                    self.output.append(None)
+                    self.goto[state][char] = nxt
+                state = nxt
+            self.output[state] = key
+        # Breadth first, so a state's failure link is done before its
+        # children need it.
+        queue = deque(self.goto[self.ROOT].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self.goto[state].items():
+                queue.append(nxt)
+                self.fail[nxt] = self.step(self.fail[state], char, remember=False)
+                if self.output[nxt] is None:
+                    self.output[nxt] = self.output[self.fail[nxt]]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def step(self, state, char, remember=True):
+        nxt = self.goto[state].get(char)
+        if nxt is None:
+            if state == self.ROOT:
+                nxt = self.ROOT
+            else:
+                nxt = self.step(self.fail[state], char, remember)
+            if remember:
+                self.goto[state][char] = nxt
+        return nxt
+
+    def match(self, state):
+        """
+        Return the longest key ending at state, or None.
+        """
+        return self.output[state]
@@ -1,7 +1,33 @@
-from os.path import join
+from os.path import join, exists
+from threading import Thread, Event
 from tinydb import TinyDB, Query
 from datetime import datetime
 from filelock import FileLock
+from types import MappingProxyType
+from collections import namedtuple, OrderedDict
+from threading import Lock
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from quikey.config import Config
+from quikey.stats import stats
+
+
+def open_database(appDirs, backend=None, lazy=False):
+    """
+    Open the phrase database using the storage backend chosen in config.ini
+    unless one is passed in. With lazy set, a backend that would keep every
+    value in memory reads them from disk when asked for instead.
+    """
+    backend = backend or Config(appDirs).backend
+    if backend == "sqlite":
+        return SQLiteDatabase(appDirs)
+    if backend == "journal":
+        return JournalDatabase(appDirs, lazy=lazy)
+    return Database(appDirs)
 
 
 class Database:
@@ -9,6 +35,8 @@ class Database:
         self.lock = FileLock(join(appDirs.data, dbFile + ".lock"))
         self.appDirs = appDirs
         self.dbFile = join(self.appDirs.data, dbFile)
+        # Files whose changes mean the database changed.
+        self.watchFiles = [self.dbFile]
         self.db = TinyDB(self.dbFile)
 
     def get(self, key):
@@ -19,25 +47,740 @@ class Database:
                 return None
             return phraseDict.get("value")
 
-    def put(self, key, value, tags=None):
+    def put(self, key, value, tags=None, options=None):
         now = datetime.utcnow().isoformat()
-        phrase = {"key": key, "value": value, "tags": tags, "updated": now}
+        phrase = {
+            "key": key,
+            "value": value,
+            "tags": tags,
+            "options": options,
+            "updated": now,
+        }
         with self.lock:
             self.db.insert(phrase)
 
-    def update(self, key, value, tags=None):
+    def update(self, key, value, tags=None, options=None):
         now = datetime.utcnow().isoformat()
         phrase = Query()
+        fields = {"key": key, "value": value, "updated": now}
+        if options is not None:
+            fields["options"] = options
         with self.lock:
-            self.db.update(
-                {"key": key, "value": value, "updated": now}, phrase.key == key
-            )
+            self.db.update(fields, phrase.key == key)
+
+    def get_many(self, keys):
+        """
+        Return {key: value} for those of keys that exist.
+        """
+        phrase = Query()
+        with self.lock:
+            docs = self.db.search(phrase.key.one_of(frozenset(keys)))
+        return {x.get("key"): x.get("value") for x in docs}
+
+    def put_many(self, phrases, tags=None, options=None):
+        """
+        Add every key and value in the phrases dict under one lock and write.
+        Keys that already exist are replaced.
+        """
+        if not phrases:
+            return
+        now = datetime.utcnow().isoformat()
+        docs = [
+            {"key": k, "value": v, "tags": tags, "options": options, "updated": now}
+            for k, v in phrases.items()
+        ]
+        table = self.db.table(self.db.default_table_name)
+
+        def updater(stored):
+            replaced = [i for i, x in stored.items() if x.get("key") in phrases]
+            for doc_id in replaced:
+                del stored[doc_id]
+            for doc in docs:
+                stored[table._get_next_id()] = doc
+
+        with self.lock:
+            # TinyDB's own insert_multiple() goes through _update_table(),
+            # which reads the file once and writes it once.
+            table._update_table(updater)
 
     def delete(self, key):
         phrase = Query()
         with self.lock:
             return self.db.remove(phrase.key == key)
 
+    def delete_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return []
+        phrase = Query()
+        with self.lock:
+            return self.db.remove(phrase.key.one_of(frozenset(keys)))
+
     def all(self):
         with self.lock:
             return self.db.all()
+
+    def index(self):
+        """
+        Return every document without its value.
+        """
+        return [{k: v for k, v in x.items() if k != "value"} for x in self.all()]
+
+
+class SQLiteDatabase:
+    """
+    Same API as Database but stored in SQLite with the phrase key as the
+    primary key, so lookups use an index and writes only touch the changed
+    rows. The database runs in WAL mode and SQLite handles locking between
+    processes.
+
+    The first time it is opened, phrases from an existing TinyDB phrases.json
+    are copied in.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS phrases (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            tags TEXT,
+            options TEXT,
+            updated TEXT
+        )
+    """
+
+    def __init__(self, appDirs, dbFile="phrases.db", migrateFrom="phrases.json"):
+        self.appDirs = appDirs
+        self.dbFile = join(self.appDirs.data, dbFile)
+        # Committed writes land in the WAL file until it is checkpointed.
+        self.watchFiles = [self.dbFile, self.dbFile + "-wal"]
+        # The daemon reloads from the file watcher thread.
+        self.lock = Lock()
+        created = not exists(self.dbFile)
+        self.db = sqlite3.connect(self.dbFile, timeout=10, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute(self.SCHEMA)
+        source = join(self.appDirs.data, migrateFrom)
+        if created and exists(source):
+            self.migrate(Database(appDirs, migrateFrom))
+
+    def migrate(self, source):
+        phrases = source.all()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO phrases VALUES (?, ?, ?, ?, ?)",
+                [
+                    self.row(
+                        x.get("key"),
+                        x.get("value"),
+                        x.get("tags"),
+                        x.get("options"),
+                        x.get("updated"),
+                    )
+                    for x in phrases
+                ],
+            )
+        logging.info("Migrated %d phrases from %s", len(phrases), source.dbFile)
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM phrases WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, value, tags=None, options=None):
+        now = datetime.utcnow().isoformat()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO phrases VALUES (?, ?, ?, ?, ?)",
+                self.row(key, value, tags, options, now),
+            )
+
+    def update(self, key, value, tags=None, options=None):
+        now = datetime.utcnow().isoformat()
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE phrases SET value = ?, updated = ? WHERE key = ?",
+                (value, now, key),
+            )
+            if options is not None:
+                self.db.execute(
+                    "UPDATE phrases SET options = ? WHERE key = ?",
+                    (json.dumps(options), key),
+                )
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        with self.lock:
+            # Stay below SQLite's limit on the number of query parameters.
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                found.update(
+                    self.db.execute(
+                        "SELECT key, value FROM phrases WHERE key IN (%s)"
+                        % ",".join("?" * len(chunk)),
+                        chunk,
+                    )
+                )
+        return found
+
+    def put_many(self, phrases, tags=None, options=None):
+        if not phrases:
+            return
+        now = datetime.utcnow().isoformat()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO phrases VALUES (?, ?, ?, ?, ?)",
+                [self.row(k, v, tags, options, now) for k, v in phrases.items()],
+            )
+
+    def delete(self, key):
+        with self.lock, self.db:
+            cursor = self.db.execute("DELETE FROM phrases WHERE key = ?", (key,))
+        return cursor.rowcount > 0
+
+    def delete_many(self, keys):
+        with self.lock, self.db:
+            cursor = self.db.executemany(
+                "DELETE FROM phrases WHERE key = ?", [(k,) for k in keys]
+            )
+        return cursor.rowcount > 0
+
+    def all(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, value, tags, options, updated FROM phrases"
+            ).fetchall()
+        return [
+            {
+                "key": key,
+                "value": value,
+                "tags": json.loads(tags) if tags else [],
+                "options": json.loads(options) if options else None,
+                "updated": updated,
+            }
+            for key, value, tags, options, updated in rows
+        ]
+
+    def index(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT key, tags, options, updated FROM phrases"
+            ).fetchall()
+        return [
+            {
+                "key": key,
+                "tags": json.loads(tags) if tags else [],
+                "options": json.loads(options) if options else None,
+                "updated": updated,
+            }
+            for key, tags, options, updated in rows
+        ]
+
+    @staticmethod
+    def row(key, value, tags, options, updated):
+        return (
+            key,
+            value,
+            json.dumps(list(tags or [])),
+            json.dumps(options) if options else None,
+            updated,
+        )
+
+
+class JournalDatabase:
+    """
+    Same API as Database but every write is a single record appended to a
+    journal file, so the cost of a write does not grow with the number of
+    phrases. A Compactor periodically folds the journal into a snapshot file.
+
+    Both files are JSON lines whose first line holds a generation number. The
+    journal only applies on top of the snapshot with the same generation;
+    compaction writes the next generation of the snapshot and then starts a
+    new, empty journal, each by an atomic rename.
+
+    Readers keep the phrases in memory and only read journal records appended
+    since their last read. tail() reports which keys those records changed.
+
+    When lazy is set, values are left out of the in-memory documents. An
+    index of the file, offset and length of each key's latest record is
+    kept instead, and get() reads the value back from there.
+    """
+
+    def __init__(
+        self,
+        appDirs,
+        dbFile="phrases.journal",
+        snapshotFile="phrases.snapshot",
+        migrateFrom="phrases.json",
+        lazy=False,
+    ):
+        self.lock = FileLock(join(appDirs.data, dbFile + ".lock"))
+        self.appDirs = appDirs
+        self.dbFile = join(self.appDirs.data, dbFile)
+        self.snapshotFile = join(self.appDirs.data, snapshotFile)
+        self.watchFiles = [self.dbFile, self.snapshotFile]
+        # Guards the in-memory state, which the daemon shares across threads.
+        self.mutex = Lock()
+        self.lazy = lazy
+        self.phrases = {}
+        self.offsets = {}
+        self.generation = None
+        self.offset = 0
+        self.records = 0
+        self.pending = None
+        with self.lock:
+            if not exists(self.dbFile):
+                source = join(self.appDirs.data, migrateFrom)
+                docs = Database(appDirs, migrateFrom).all() if exists(source) else []
+                self.write_generation(1, docs)
+
+    def get(self, key):
+        self.refresh()
+        if self.lazy:
+            return self.read(key)
+        doc = self.phrases.get(key)
+        return None if doc is None else doc.get("value")
+
+    def read(self, key):
+        """
+        Read the value of key through the offsets index. When another
+        process compacted the files since they were indexed, reload and try
+        again.
+        """
+        for attempt in range(2):
+            with self.mutex:
+                where = self.offsets.get(key)
+                generation = self.generation
+            if where is None:
+                return None
+            doc = self.read_record(where, generation)
+            if doc is not None and doc.get("key") == key:
+                return doc.get("value")
+            with self.mutex:
+                self.load()
+        return None
+
+    @staticmethod
+    def with_values(docs, offsets):
+        """
+        Copy docs with their values read back through offsets, opening each
+        file once.
+        """
+        files = {}
+        try:
+            result = []
+            for doc in docs:
+                path, offset, length = offsets[doc["key"]]
+                if path not in files:
+                    files[path] = open(path, "rb")
+                record = json.loads(os.pread(files[path].fileno(), length, offset))
+                result.append(dict(doc, value=record["value"]))
+            return result
+        finally:
+            for f in files.values():
+                f.close()
+
+    def read_record(self, where, generation):
+        path, offset, length = where
+        try:
+            with open(path, "rb") as f:
+                if self.read_generation(f) != generation:
+                    return None
+                return json.loads(os.pread(f.fileno(), length, offset))
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key, value, tags=None, options=None):
+        now = datetime.utcnow().isoformat()
+        self.append(
+            {
+                "key": key,
+                "value": value,
+                "tags": tags,
+                "options": options,
+                "updated": now,
+            }
+        )
+
+    def get_many(self, keys):
+        self.refresh()
+        phrases = self.phrases
+        if self.lazy:
+            found = {k: self.read(k) for k in keys if k in phrases}
+            return {k: v for k, v in found.items() if v is not None}
+        return {k: phrases[k]["value"] for k in keys if k in phrases}
+
+    def put_many(self, phrases, tags=None, options=None):
+        if not phrases:
+            return
+        now = datetime.utcnow().isoformat()
+        self.append(
+            *[
+                {"key": k, "value": v, "tags": tags, "options": options, "updated": now}
+                for k, v in phrases.items()
+            ]
+        )
+
+    def update(self, key, value, tags=None, options=None):
+        self.refresh()
+        doc = self.phrases.get(key)
+        if doc is None:
+            return
+        doc = dict(doc, value=value, updated=datetime.utcnow().isoformat())
+        if options is not None:
+            doc["options"] = options
+        self.append(doc)
+
+    def delete(self, key):
+        self.refresh()
+        if key not in self.phrases:
+            return False
+        self.append({"key": key, "deleted": True})
+        return True
+
+    def delete_many(self, keys):
+        self.refresh()
+        keys = [k for k in keys if k in self.phrases]
+        if not keys:
+            return False
+        self.append(*[{"key": k, "deleted": True} for k in keys])
+        return True
+
+    def all(self):
+        self.refresh()
+        if self.lazy:
+            with self.mutex:
+                docs = list(self.phrases.values())
+                offsets = dict(self.offsets)
+            return self.with_values(docs, offsets)
+        return [dict(x) for x in self.phrases.values()]
+
+    def index(self):
+        self.refresh()
+        return [
+            {k: v for k, v in x.items() if k != "value"}
+            for x in list(self.phrases.values())
+        ]
+
+    def tail(self):
+        """
+        Return {key: doc} for every key written since the previous call, with
+        None for deleted keys. Returns None when the whole database was
+        reloaded instead, such as on the first call or after another process
+        compacted it.
+        """
+        self.refresh()
+        with self.mutex:
+            pending = self.pending
+            self.pending = {}
+        return pending
+
+    def refresh(self):
+        with self.mutex:
+            if self.generation is None:
+                self.load()
+                return
+            with open(self.dbFile, "rb") as f:
+                if self.read_generation(f) != self.generation:
+                    self.load()
+                    return
+                f.seek(self.offset)
+                lines, self.offset = self.read_lines(f)
+            for offset, line in lines:
+                self.apply(json.loads(line), offset, len(line))
+
+    def load(self):
+        with open(self.snapshotFile, "rb") as f:
+            generation = self.read_generation(f)
+            self.phrases = {}
+            self.offsets = {}
+            lines, _ = self.read_lines(f)
+            for offset, line in lines:
+                doc = json.loads(line)
+                if self.lazy:
+                    del doc["value"]
+                    self.offsets[doc["key"]] = (self.snapshotFile, offset, len(line))
+                self.phrases[doc["key"]] = doc
+        self.pending = None
+        self.records = 0
+        with open(self.dbFile, "rb") as f:
+            if self.read_generation(f) == generation:
+                lines, self.offset = self.read_lines(f)
+                for offset, line in lines:
+                    self.apply(json.loads(line), offset, len(line))
+            else:
+                # The files are from different compactions; one is part way
+                # through. Leave the generation unset so the next refresh
+                # loads both again rather than reading the new journal from
+                # an offset that belongs to neither.
+                self.generation = None
+                return
+        self.generation = generation
+
+    def apply(self, doc, offset=None, length=None):
+        key = doc["key"]
+        if doc.get("deleted"):
+            self.phrases.pop(key, None)
+            self.offsets.pop(key, None)
+            doc = None
+        else:
+            if self.lazy:
+                doc.pop("value", None)
+                self.offsets[key] = (self.dbFile, offset, length)
+            self.phrases[key] = doc
+        self.records = self.records + 1
+        if self.pending is not None:
+            self.pending[key] = doc
+
+    def append(self, *docs):
+        data = b"".join(json.dumps(x).encode("utf-8") + b"\n" for x in docs)
+        with self.lock:
+            with open(self.dbFile, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def compact(self):
+        """
+        Fold the journal into a new snapshot generation.
+        """
+        with self.lock:
+            self.refresh()
+            with self.mutex:
+                generation = self.generation + 1
+                docs = self.phrases.values()
+                if self.lazy:
+                    docs = self.with_values(docs, self.offsets)
+                self.write_generation(generation, docs)
+                compacted = self.records
+                if self.lazy:
+                    # Index the records at their new offsets.
+                    pending = self.pending
+                    self.load()
+                    self.pending = pending
+                else:
+                    self.generation = generation
+                    self.offset = os.path.getsize(self.dbFile)
+                    self.records = 0
+        logging.info("Compacted %d journal records", compacted)
+
+    def write_generation(self, generation, docs):
+        header = json.dumps({"generation": generation}).encode("utf-8") + b"\n"
+        self.replace(
+            self.snapshotFile,
+            [header] + [json.dumps(x).encode("utf-8") + b"\n" for x in docs],
+        )
+        self.replace(self.dbFile, [header])
+
+    @staticmethod
+    def replace(path, lines):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @staticmethod
+    def read_lines(f):
+        """
+        Return the (offset, line) pairs of the complete lines from the
+        current position of f, and the offset following the last of them. A
+        writer may be part way through the line after that.
+        """
+        start = f.tell()
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        lines = []
+        pos = 0
+        while pos < end:
+            nl = data.index(b"\n", pos) + 1
+            lines.append((start + pos, data[pos:nl]))
+            pos = nl
+        return lines, start + end
+
+    @staticmethod
+    def read_generation(f):
+        line = f.readline()
+        if not line.endswith(b"\n"):
+            return None
+        return json.loads(line)["generation"]
+
+
+class Compactor(Thread):
+    """
+    Compacts a JournalDatabase every interval seconds once its journal holds
+    at least threshold records.
+    """
+
+    def __init__(self, database, interval=300, threshold=500):
+        super().__init__(daemon=True)
+        self.db = database
+        self.interval = interval
+        self.threshold = threshold
+        self.stopped = Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.db.refresh()
+                if self.db.records >= self.threshold:
+                    self.db.compact()
+            except Exception:
+                logging.exception("Failed to compact %s", self.db.dbFile)
+
+
+class Phrase(namedtuple("Phrase", ["value", "options"])):
+    """
+    Value of a phrase plus its options, such as the "output" mode.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_doc(cls, doc):
+        return cls(doc.get("value"), MappingProxyType(doc.get("options") or {}))
+
+
+class PhraseRef(namedtuple("PhraseRef", ["revision", "options"])):
+    """
+    Stands in for a Phrase whose value stays on disk. The revision is the
+    phrase's last update time, so a changed value gets a new PhraseRef.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_doc(cls, doc):
+        return cls(doc.get("updated"), MappingProxyType(doc.get("options") or {}))
+
+
+class PhraseSnapshot:
+    """
+    Read-only, in-memory copy of every phrase key, value and options. Lookups
+    are plain dict reads that never touch the database file or its lock.
+
+    load() builds a complete new mapping before swapping it in with a single
+    attribute assignment, so a concurrent get() sees either the old snapshot
+    or the new one, never a partially loaded one.
+    """
+
+    NO_OPTIONS = MappingProxyType({})
+
+    # What each key maps to in phrases.
+    entry = Phrase
+
+    def __init__(self, phrases=None):
+        self.phrases = MappingProxyType(dict(phrases or {}))
+
+    def __len__(self):
+        return len(self.phrases)
+
+    def get(self, key):
+        phrase = self.phrases.get(key)
+        return None if phrase is None else phrase.value
+
+    def options(self, key):
+        phrase = self.phrases.get(key)
+        return self.NO_OPTIONS if phrase is None else phrase.options
+
+    def keys(self):
+        return self.phrases.keys()
+
+    def replace(self, phrases):
+        self.phrases = MappingProxyType(dict(phrases))
+
+    def documents(self, database):
+        return database.all()
+
+    def load(self, database):
+        self.replace(
+            (x.get("key"), self.entry.from_doc(x)) for x in self.documents(database)
+        )
+
+
+class ValueCache:
+    """
+    Least recently used phrase values, bounded by their total length in
+    characters. Values longer than the whole cache are not kept.
+    """
+
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self.values = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def get(self, key):
+        value = self.values.get(key)
+        if value is None:
+            self.misses = self.misses + 1
+            stats.increment("value_cache_misses")
+            return None
+        self.values.move_to_end(key)
+        self.hits = self.hits + 1
+        stats.increment("value_cache_hits")
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.capacity:
+            return
+        old = self.values.pop(key, None)
+        if old is not None:
+            self.size = self.size - len(old)
+        self.values[key] = value
+        self.size = self.size + len(value)
+        while self.size > self.capacity:
+            _, evicted = self.values.popitem(last=False)
+            self.size = self.size - len(evicted)
+
+
+class LazyPhraseSnapshot(PhraseSnapshot):
+    """
+    PhraseSnapshot that only keeps keys and options in memory. A value is
+    read from the database the first time its phrase fires and then kept in
+    a ValueCache.
+
+    Values are cached under the key and its revision, so a value that changed
+    in the database is never served from the cache.
+    """
+
+    entry = PhraseRef
+
+    def __init__(self, database, values, phrases=None):
+        super().__init__(phrases)
+        self.db = database
+        self.values = values
+
+    def get(self, key):
+        ref = self.phrases.get(key)
+        if ref is None:
+            return None
+        value = self.values.get((key, ref.revision))
+        if value is None:
+            start = time.perf_counter() if stats.enabled else 0
+            value = self.db.get(key)
+            if stats.enabled:
+                stats.record("value_fetch", time.perf_counter() - start)
+            if value is not None:
+                self.values.put((key, ref.revision), value)
+        return value
+
+    def documents(self, database):
+        return database.index()
@@ -0,0 +1,315 @@
+from pynput.keyboard import Key
+from collections import deque
+from itertools import islice
+from threading import Lock, Timer
+import logging
+import shutil
+import subprocess
+import time
+
+# Output modes a phrase can ask for with its "output" option.
+TYPE = "type"
+PASTE = "paste"
+MODES = (TYPE, PASTE)
+
+# Characters that have to be sent as a special key, as pynput's type() does.
+CONTROL_CODES = {"\n": Key.enter, "\r": Key.enter, "\t": Key.tab}
+
+
+def plan(key, phrase, trailing=1):
+    """
+    Work out how to turn the typed phrase-key, followed by ``trailing``
+    trigger characters, into the phrase. Characters the key shares with the
+    start of the phrase are left in place.
+
+    Returns the number of backspaces to send and the text to output after
+    them.
+    """
+    shared = 0
+    for a, b in zip(key, phrase):
+        if a != b:
+            break
+        shared = shared + 1
+    return len(key) + trailing - shared, phrase[shared:]
+
+
+def backspace_events(count):
+    return [(True, Key.backspace), (False, Key.backspace)] * count
+
+
+def key_events(text):
+    events = []
+    for char in text:
+        key = CONTROL_CODES.get(char, char)
+        events.append((True, key))
+        events.append((False, key))
+    return events
+
+
+def send(keyboard, events):
+    """
+    Emit a list of (pressed, key) events back to back.
+    """
+    press = keyboard.press
+    release = keyboard.release
+    for pressed, key in events:
+        if pressed:
+            press(key)
+        else:
+            release(key)
+
+
+class InjectedKeys:
+    """
+    Key presses the OutputEngine has sent and the listener has not seen come
+    back yet. Most backends, X11's XTest included, don't flag injected
+    events, so this is how the daemon tells its own output apart from what
+    the user types.
+
+    Expected keys are matched in order. A few are looked ahead at in case a
+    backend reports one differently, and when none has come back within
+    timeout seconds the rest are forgotten.
+
+    expect() is called from the thread that types phrases and match() from
+    the listener's, so both hold a lock.
+    """
+
+    LOOKAHEAD = 8
+
+    def __init__(self, timeout=1.0):
+        self.pending = deque()
+        self.timeout = timeout
+        self.seen = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def expect(self, events):
+        keys = [key for pressed, key in events if pressed]
+        with self.lock:
+            self.seen = time.monotonic()
+            self.pending.extend(keys)
+
+    def match(self, key):
+        """
+        Return True, and stop expecting it, when key is one the daemon sent.
+        """
+        if not self.pending:
+            return False
+        char = getattr(key, "char", None)
+        with self.lock:
+            now = time.monotonic()
+            if now - self.seen > self.timeout:
+                self.pending.clear()
+                return False
+            for i, expected in enumerate(islice(self.pending, self.LOOKAHEAD)):
+                if expected == key or (char is not None and expected == char):
+                    for _ in range(i + 1):
+                        self.pending.popleft()
+                    self.seen = now
+                    return True
+        return False
+
+
+class Clipboard:
+    """
+    Reads and writes the desktop clipboard through whichever command line
+    tool is installed (wl-clipboard, xclip or xsel).
+    """
+
+    COMMANDS = [
+        (["wl-copy"], ["wl-paste", "--no-newline"]),
+        (
+            ["xclip", "-selection", "clipboard"],
+            ["xclip", "-selection", "clipboard", "-o"],
+        ),
+        (["xsel", "--clipboard", "--input"], ["xsel", "--clipboard", "--output"]),
+    ]
+
+    def __init__(self):
+        self.copy = None
+        self.paste = None
+        for copy, paste in self.COMMANDS:
+            if shutil.which(copy[0]):
+                self.copy = copy
+                self.paste = paste
+                break
+
+    @property
+    def available(self):
+        return self.copy is not None
+
+    def get(self):
+        """
+        Return the clipboard's text, or None when it holds none.
+        """
+        result = subprocess.run(
+            self.paste, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=2
+        )
+        if result.returncode != 0:
+            return None
+        return result.stdout.decode("utf-8", "replace")
+
+    def set(self, text):
+        subprocess.run(self.copy, input=text.encode("utf-8"), timeout=2, check=True)
+
+
+class TypeStrategy:
+    """
+    Types a phrase one synthetic key press at a time.
+    """
+
+    name = TYPE
+
+    def __init__(self, keyboard):
+        self.keyboard = keyboard
+
+    def events(self, text):
+        return key_events(text)
+
+    def delivered(self):
+        pass
+
+    def emit(self, text):
+        send(self.keyboard, self.events(text))
+
+
+class PasteStrategy:
+    """
+    Puts a phrase on the clipboard and pastes it with Ctrl+V, which costs the
+    same handful of events no matter how long the phrase is.
+
+    Whatever the clipboard held before is put back restore_delay seconds after
+    the paste was sent, which gives the focused window time to read the
+    phrase. Pastes that follow each other within that time restore the text
+    saved by the first.
+    """
+
+    name = PASTE
+    RESTORE_DELAY = 0.5
+
+    def __init__(self, keyboard, clipboard, restore_delay=RESTORE_DELAY):
+        self.keyboard = keyboard
+        self.clipboard = clipboard
+        self.restore_delay = restore_delay
+        self.lock = Lock()
+        self.saved = None
+        # Counts pastes so a restore scheduled by an earlier one can tell
+        # that a later paste has taken over the clipboard.
+        self.pastes = 0
+
+    def events(self, text):
+        with self.lock:
+            self.pastes = self.pastes + 1
+            if self.saved is None:
+                self.saved = self.save()
+            # The clipboard has to hold the text before Ctrl+V is sent.
+            try:
+                self.clipboard.set(text)
+            except (OSError, subprocess.SubprocessError):
+                # The clipboard is unchanged, so there is nothing to restore.
+                self.saved = None
+                raise
+        return [(True, Key.ctrl), (True, "v"), (False, "v"), (False, Key.ctrl)]
+
+    def save(self):
+        try:
+            return self.clipboard.get()
+        except (OSError, subprocess.SubprocessError):
+            logging.exception("Failed to read the clipboard, it won't be restored")
+            return None
+
+    def delivered(self):
+        """
+        Called once the Ctrl+V events were sent.
+        """
+        if self.restore_delay > 0:
+            timer = Timer(self.restore_delay, self.restore, [self.pastes])
+            timer.daemon = True
+            timer.start()
+        else:
+            self.restore(self.pastes)
+
+    def restore(self, paste):
+        with self.lock:
+            if paste != self.pastes or self.saved is None:
+                return
+            saved, self.saved = self.saved, None
+            try:
+                self.clipboard.set(saved)
+            except (OSError, subprocess.SubprocessError):
+                logging.exception("Failed to restore the clipboard")
+
+    def emit(self, text):
+        send(self.keyboard, self.events(text))
+        self.delivered()
+
+
+class OutputEngine:
+    """
+    Delivers expanded phrases to the focused window.
+
+    Phrases shorter than paste_threshold characters are typed; longer ones
+    are pasted when a clipboard tool is available. A phrase can override the
+    choice with its "output" option. A paste_threshold of 0 always types.
+    """
+
+    def __init__(self, keyboard, clipboard=None, paste_threshold=0):
+        self.keyboard = keyboard
+        self.paste_threshold = paste_threshold
+        self.injected = InjectedKeys()
+        self.strategies = {TYPE: TypeStrategy(keyboard)}
+        if clipboard is not None and clipboard.available:
+            self.strategies[PASTE] = PasteStrategy(keyboard, clipboard)
+
+    def strategy(self, text, mode=None):
+        if mode is None and self.paste_threshold > 0:
+            mode = PASTE if len(text) >= self.paste_threshold else TYPE
+        return self.strategies.get(mode, self.strategies[TYPE])
+
+    def erase(self, count):
+        self.send(backspace_events(count))
+
+    def emit(self, text, mode=None):
+        strategy, events = self.events(text, mode)
+        self.send(events)
+        strategy.delivered()
+        return strategy.name
+
+    def send(self, events):
+        self.injected.expect(events)
+        send(self.keyboard, events)
+
+    def expand(self, key, phrase, mode=None, trailing=1):
+        """
+        Replace the typed phrase-key and its trigger with the phrase. The
+        backspaces and the output are planned up front and sent as a single
+        run of events.
+        """
+        start = time.perf_counter()
+        erase, text = plan(key, phrase, trailing)
+        # Pick the strategy from the whole phrase, not the part left to output.
+        strategy, events = self.events(text, self.strategy(phrase, mode).name)
+        events = backspace_events(erase) + events
+        self.send(events)
+        strategy.delivered()
+        logging.debug(
+            "Expanded %s with %d events (%s) in %.2fms",
+            key,
+            len(events),
+            strategy.name,
+            (time.perf_counter() - start) * 1000,
+        )
+        return strategy.name
+
+    def events(self, text, mode=None):
+        strategy = self.strategy(text, mode)
+        try:
+            return strategy, strategy.events(text)
+        except (OSError, subprocess.SubprocessError):
+            if strategy.name == TYPE:
+                raise
+            logging.exception("Failed to %s phrase, typing it instead", strategy.name)
+            strategy = self.strategies[TYPE]
+            return strategy, strategy.events(text)
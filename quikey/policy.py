@@ -0,0 +1,9 @@
+# What keyimport does with an AutoKey phrase that has several abbreviations.
+# Kept free of imports so qk can offer the choices without loading the
+# importer.
+
+ASK = "ask"
+FIRST = "first"
+ALL = "all"
+SKIP = "skip"
+MULTIPLE_POLICIES = (ASK, FIRST, ALL, SKIP)
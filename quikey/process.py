@@ -0,0 +1,147 @@
+from collections import namedtuple
+import os
+import select
+import signal
+import time
+
+# Kept free of pynput and the daemon's other dependencies so qk can check on
+# the daemon without loading them.
+
+PID_FILE = "quikey.pid"
+
+ProcessInfo = namedtuple("ProcessInfo", ["uptime", "rss"])
+
+
+class StopTimeout(Exception):
+    """
+    The daemon was sent SIGTERM but is still running.
+    """
+
+    def __init__(self, pid, timeout):
+        super().__init__(
+            "Quikey daemon (pid: %d) is still running %g seconds after it was "
+            "asked to stop." % (pid, timeout)
+        )
+        self.pid = pid
+
+
+def write_pid(appDirs):
+    pidfile = appDirs.cache + PID_FILE
+    with open(pidfile, "w") as f:
+        f.write(str(os.getpid()))
+
+
+def read_pid(appDirs):
+    pidfile = appDirs.cache + PID_FILE
+    try:
+        with open(pidfile, "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def delete_pid(appDirs):
+    pidfile = appDirs.cache + PID_FILE
+    os.remove(pidfile)
+
+
+def running_pid(appDirs):
+    """
+    Return the pid of the running daemon, or None when there is none.
+    """
+    pid = read_pid(appDirs)
+    if not pid:
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except (OSError, ValueError):
+        return None
+    return int(pid)
+
+
+def process_info(pid, proc="/proc"):
+    """
+    Return the uptime in seconds and resident memory in bytes of pid, or None
+    when /proc has no such process.
+    """
+    try:
+        with open(os.path.join(proc, "uptime")) as f:
+            since_boot = float(f.read().split()[0])
+        with open(os.path.join(proc, str(pid), "stat")) as f:
+            # The command name may contain spaces, so count fields from the
+            # parenthesis that ends it. starttime is field 22.
+            fields = f.read().rsplit(")", 1)[1].split()
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        rss = None
+        with open(os.path.join(proc, str(pid), "status")) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                    break
+    except (OSError, IndexError, ValueError):
+        return None
+    return ProcessInfo(max(since_boot - started, 0), rss)
+
+
+def stop_daemon(appDirs, timeout=5):
+    """
+    Send SIGTERM to the running daemon and wait up to timeout seconds for it
+    to exit. Returns the pid that was stopped, or None when no daemon was
+    running, removing a stale pidfile. Raises StopTimeout when the daemon is
+    still running after timeout.
+    """
+    pid = read_pid(appDirs)
+    if pid is None:
+        return None
+    try:
+        os.kill(int(pid), signal.SIGTERM)
+    except (ProcessLookupError, ValueError):
+        delete_pid(appDirs)
+        return None
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return int(pid)
+        time.sleep(0.05)
+    raise StopTimeout(int(pid), timeout)
+
+
+def signal_ready(fd):
+    """
+    Tell the process waiting in wait_ready() that the daemon is up.
+    """
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+
+
+def wait_ready(fd, timeout=10):
+    """
+    Wait for signal_ready() on the other end of the pipe. Returns the
+    daemon's pid, or None when it exited or timed out before it was ready.
+    """
+    try:
+        readable, _, _ = select.select([fd], [], [], timeout)
+        data = os.read(fd, 32) if readable else b""
+    finally:
+        os.close(fd)
+    return int(data) if data else None
+
+
+def describe(pid, phrases=None):
+    """
+    Lines describing the running daemon for 'status'. phrases is the count
+    reported over the control socket, when it answered.
+    """
+    import humanize
+
+    lines = ["Quikey daemon running (PID: %d)" % pid]
+    info = process_info(pid)
+    if info is not None:
+        lines.append("Uptime: %s" % humanize.naturaldelta(info.uptime))
+    if phrases is not None:
+        lines.append("Phrases: %d" % phrases)
+    if info is not None and info.rss is not None:
+        lines.append("Memory (RSS): %s" % humanize.naturalsize(info.rss))
+    return lines
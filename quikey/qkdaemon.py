@@ -1,19 +1,50 @@
 #!/usr/bin/env python
-from pynput.keyboard import Key, Listener, KeyCode, Controller
-from threading import Lock
+from pynput.keyboard import Listener, Controller
+from threading import Lock, RLock
+from collections import namedtuple
+from datetime import datetime
 import daemon
 import click
+import configparser
+import json
+import logging
 import os
 import signal
 import sys
+import time
 
-from quikey.models import Database
+from quikey.models import (
+    open_database,
+    JournalDatabase,
+    Compactor,
+    PhraseSnapshot,
+    LazyPhraseSnapshot,
+    ValueCache,
+)
 from quikey.directories import AppDirectories
+from quikey.cache import MatcherCache, gc_paused
+from quikey.config import Config, BACKENDS
+from quikey.control import ControlServer, ControlError, request
 from quikey.filewatch import InotifyWatch
+from quikey.process import (
+    write_pid,
+    read_pid,
+    delete_pid,
+    running_pid,
+    stop_daemon,
+    StopTimeout,
+    signal_ready,
+    wait_ready,
+    describe,
+)
+from quikey.output import OutputEngine, Clipboard
+from quikey.stats import stats, StatsReporter, STATS_FILE
+from quikey.trace import TraceRecorder, RecordingOutput, replay as replay_trace
 from quikey.input import (
     PhraseHandler,
     Notifier,
     InputHandler,
+    InputWorker,
     AlphaNumHandler,
     DeleteHandler,
     SpaceHandler,
@@ -22,79 +53,375 @@ from quikey.input import (
 typelock = Lock()
 
 
+ReloadStats = namedtuple(
+    "ReloadStats", ["duration", "added", "removed", "changed", "total"]
+)
+
+
 class DatabaseChangeHandler:
-    def __init__(self, notifier, database):
+    """
+    Keeps the notifier and the in-memory phrase snapshot in sync with the
+    database. PhraseHandlers read values from the snapshot so expanding a
+    phrase never reads the database file.
+
+    Reloads are incremental: only keys that were added or removed since the
+    previous reload touch the notifier, and changed values are picked up by
+    swapping the snapshot. With a JournalDatabase only the journal records
+    written since the previous reload are read. Timing and change counts of
+    the most recent reload are kept in last_reload.
+
+    With a MatcherCache the initial load comes from the cache when the
+    database has not changed since it was written. Passing a
+    LazyPhraseSnapshot keeps only the keys in memory.
+
+    put(), update() and delete() write to the database and apply the change
+    straight away, for requests made over the control socket. The reload the
+    write triggers then finds nothing left to do.
+    """
+
+    def __init__(self, notifier, database, output=None, cache=None, snapshot=None):
         self.notifier = notifier
         self.db = database
+        self.snapshot = snapshot if snapshot is not None else PhraseSnapshot()
+        self.output = output or OutputEngine(Controller())
+        self.cache = cache
+        self.last_reload = None
+        # Reloads and writes come from the watch and control threads.
+        self.lock = RLock()
         self.init_phrase_handlers()
 
     def init_phrase_handlers(self):
-        self.notifier.clear()
-        phrases = self.db.all()
-        keyboard = Controller()
-        for phrase in phrases:
-            self.notifier.add(PhraseHandler(phrase.get("key"), self.db, keyboard))
+        start = time.perf_counter()
+        with gc_paused():  # Allocates a few objects per phrase
+            cached = None
+            if self.cache is not None:
+                cached = self.cache.load(self.db, self.snapshot.entry)
+            if cached is not None:
+                # A JournalDatabase isn't read yet, so its first tail() returns
+                # None and the first reload compares the whole database.
+                phrases, matcher = cached
+                self.snapshot.replace(phrases)
+                self.notifier.replace(
+                    (PhraseHandler(key, self.snapshot, self.output) for key in phrases),
+                    matcher,
+                )
+            else:
+                if self.cache is not None:
+                    signature = self.cache.signature(self.db)
+                if isinstance(self.db, JournalDatabase):
+                    # Start tracking journal records from this load onwards.
+                    self.db.tail()
+                self.snapshot.load(self.db)
+                self.notifier.replace(
+                    PhraseHandler(key, self.snapshot, self.output)
+                    for key in self.snapshot.keys()
+                )
+                if self.cache is not None:
+                    self.cache.save(
+                        signature,
+                        self.snapshot.phrases,
+                        self.notifier.matcher,
+                        self.snapshot.entry,
+                    )
+        total = len(self.snapshot)
+        self.last_reload = ReloadStats(time.perf_counter() - start, total, 0, 0, total)
+        logging.info(
+            "Loaded %d phrases in %.2fms%s",
+            total,
+            self.last_reload.duration * 1000,
+            " from the matcher cache" if cached is not None else "",
+        )
+        return self.last_reload
+
+    def rebuild(self):
+        """
+        Load every phrase and swap in a freshly built matcher, as on startup.
+        """
+        with self.lock:
+            return self.init_phrase_handlers()
+
+    def reload(self):
+        with self.lock:
+            return self._reload()
+
+    def _reload(self):
+        start = time.perf_counter()
+        tail = self.db.tail() if isinstance(self.db, JournalDatabase) else None
+        if tail is None:
+            old = self.snapshot.phrases
+            entry = self.snapshot.entry
+            new = {
+                x.get("key"): entry.from_doc(x)
+                for x in self.snapshot.documents(self.db)
+            }
+            changes = {k: None for k in old.keys() - new.keys()}
+            changes.update((k, v) for k, v in new.items() if old.get(k) != v)
+        else:
+            # Only apply the journal records written since the last reload.
+            entry = self.snapshot.entry
+            changes = {
+                k: None if v is None else entry.from_doc(v) for k, v in tail.items()
+            }
+        return self.apply(changes, start)
+
+    def apply(self, changes, start=None):
+        """
+        Apply {key: Phrase} changes, where None removes the key, to the
+        snapshot and the notifier.
+        """
+        with self.lock:
+            return self._apply(changes, start)
+
+    def _apply(self, changes, start=None):
+        start = start or time.perf_counter()
+        old = self.snapshot.phrases
+        new = dict(old)
+        added = []
+        removed = []
+        moved = []  # Into or out of the pattern or instant matcher
+        changed = 0
+        for key, phrase in changes.items():
+            if phrase is None:
+                if new.pop(key, None) is not None:
+                    removed.append(key)
+            elif key not in old:
+                new[key] = phrase
+                added.append(key)
+            elif old[key] != phrase:
+                new[key] = phrase
+                changed = changed + 1
+                if any(
+                    old[key].options.get(x) != phrase.options.get(x)
+                    for x in ("pattern", "instant")
+                ):
+                    moved.append(key)
+        # Drop removed keys before their values disappear and only add new
+        # keys once their values are in the snapshot.
+        with self.notifier.batch():
+            for key in removed:
+                self.notifier.remove(key)
+            self.snapshot.replace(new)
+            for key in moved:
+                self.notifier.remove(key)
+            for key in added + moved:
+                self.notifier.add(PhraseHandler(key, self.snapshot, self.output))
+        duration = time.perf_counter() - start
+        stats.record("reload", duration)
+        self.last_reload = ReloadStats(
+            duration,
+            len(added),
+            len(removed),
+            changed,
+            len(new),
+        )
+        logging.info(
+            "Reloaded %d phrases in %.2fms (%d added, %d removed, %d changed)",
+            self.last_reload.total,
+            self.last_reload.duration * 1000,
+            self.last_reload.added,
+            self.last_reload.removed,
+            self.last_reload.changed,
+        )
+        return self.last_reload
+
+    def put(self, key, value, tags=None, options=None):
+        with self.lock:
+            self.db.put(key, value, tags, options)
+            return self.written(key, value, options)
+
+    def update(self, key, value, options=None):
+        with self.lock:
+            self.db.update(key, value, options=options)
+            if options is None:
+                options = dict(self.snapshot.options(key))
+            return self.written(key, value, options)
+
+    def delete(self, key):
+        with self.lock:
+            deleted = bool(self.db.delete(key))
+            self.apply({key: None})
+            return deleted
+
+    def written(self, key, value, options):
+        # With a LazyPhraseSnapshot the revision differs a little from the one
+        # the database stored, so the next reload swaps in one more PhraseRef.
+        doc = {
+            "key": key,
+            "value": value,
+            "options": options,
+            "updated": datetime.utcnow().isoformat(),
+        }
+        return self.apply({key: self.snapshot.entry.from_doc(doc)})
 
     def notify(self, event=None):
-        self.init_phrase_handlers()
+        self.reload()
+
+
+def control_commands(dbchange):
+    """
+    Commands the daemon accepts over the control socket, used by qk.
+    """
+
+    def status():
+        return {"pid": os.getpid(), "phrases": len(dbchange.snapshot)}
+
+    def reload():
+        return dbchange.reload()._asdict()
+
+    def daemon_stats():
+        return stats.to_dict()
+
+    def add(key, value, tags=None, options=None):
+        with dbchange.lock:
+            if dbchange.db.get(key) is not None:
+                raise ControlError("quikey phrase with key of %s already exists" % key)
+            return dbchange.put(key, value, tags, options)._asdict()
+
+    def update(key, value, options=None):
+        with dbchange.lock:
+            if dbchange.db.get(key) is None:
+                raise ControlError("quikey phrase with key of %s does not exist." % key)
+            return dbchange.update(key, value, options)._asdict()
+
+    def delete(key):
+        return {"deleted": dbchange.delete(key)}
+
+    return {
+        "status": status,
+        "reload": reload,
+        "stats": daemon_stats,
+        "add": add,
+        "update": update,
+        "delete": delete,
+    }
 
 
 class ShutdownHook:
-    def __init__(self, listener, watch, appDirs):
+    def __init__(
+        self, listener, watch, appDirs, reporter=None, worker=None, control=None
+    ):
         self.appDirs = appDirs
         self.watch = watch
         self.listener = listener
+        self.reporter = reporter
+        self.worker = worker
+        self.control = control
 
     def __call__(self, signal, frame):
         self.watch.stop()
         self.listener.stop()
+        if self.worker is not None:
+            self.worker.stop()
+        if self.control is not None:
+            self.control.stop()
+        if self.reporter is not None:
+            self.reporter.stop()
         delete_pid(self.appDirs)
 
 
-def write_pid(appDirs):
-    pidfile = appDirs.cache + "quikey.pid"
-    with open(pidfile, "w") as f:
-        f.write(str(os.getpid()))
+class ReloadHook:
+    """
+    SIGHUP handler: applies the [daemon] settings of config.ini to the
+    running InputHandler, swaps in a freshly built matcher and replaces the
+    inotify watch, in case it stopped working, without touching the
+    keyboard listener.
+    """
 
+    def __init__(self, appDirs, handler, dbchange, watch, shutdown):
+        self.appDirs = appDirs
+        self.handler = handler
+        self.dbchange = dbchange
+        self.watch = watch
+        self.shutdown = shutdown
 
-def read_pid(appDirs):
-    pidfile = appDirs.cache + "quikey.pid"
-    try:
-        with open(pidfile, "r") as f:
-            return f.read()
-    except FileNotFoundError:
-        print(pidfile)
-        return None
-
+    def __call__(self, signal, frame):
+        logging.info("Reloading configuration")
+        try:
+            config = Config(self.appDirs)
+            self.handler.configure(config.buffer_size, config.trigger_keys)
+        except (ValueError, configparser.Error):
+            logging.exception("Keeping the current settings")
+        self.dbchange.rebuild()
+        self.restart_watch()
 
-def delete_pid(appDirs):
-    pidfile = appDirs.cache + "quikey.pid"
-    os.remove(pidfile)
+    def restart_watch(self):
+        old = self.watch
+        old.stop()
+        watch = InotifyWatch(old.files, old.debounce, old.poll_interval)
+        for observer in old.observers:
+            watch.add_observer(observer)
+        watch.start()
+        self.watch = watch
+        self.shutdown.watch = watch
 
 
-def main(foreground, buffer_size, trigger_keys):
+def main(foreground, buffer_size, trigger_keys, ready=None, **options):
+    logging.basicConfig(
+        level=logging.DEBUG if options["verbose"] else logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
     # Initialize all components and hook them up.
     appDirs = AppDirectories()  # XDG folders
+    config = Config(appDirs)  # Its [daemon] settings win over the options
+    if config.buffer_size is not None:
+        buffer_size = config.buffer_size
+    trigger_keys = config.trigger_keys or trigger_keys
     notifier = Notifier(
         typelock
     )  # Create the notifier that calls to each phrase handler
-    database = Database(appDirs)  # Read database in
-    dbchange = DatabaseChangeHandler(notifier, database)
-    watch = InotifyWatch(database.dbFile)
+    database = open_database(appDirs, lazy=options["lazy"])  # Read database in
+    output = OutputEngine(Controller(), Clipboard(), options["paste_threshold"])
+    if options["record"]:
+        output = RecordingOutput(output)  # Tells the trace what each key expanded
+    cache = MatcherCache(appDirs) if options["cache"] else None
+    snapshot = None
+    if options["lazy"]:
+        values = ValueCache(options["value_cache_size"] * 1024)
+        snapshot = LazyPhraseSnapshot(database, values)
+    dbchange = DatabaseChangeHandler(notifier, database, output, cache, snapshot)
+    watch = InotifyWatch(database.watchFiles, options["debounce"] / 1000.0)
     watch.add_observer(dbchange)  # Watch for changes in database outside this process
-    i = InputHandler(
-        typelock, notifier, buffer_size, trigger_keys
-    )  # Accepts keyboard inputs
+    i = InputHandler(notifier, buffer_size, trigger_keys)  # Accepts keyboard inputs
     watch.start()
+    if isinstance(database, JournalDatabase):
+        Compactor(database).start()  # Fold the journal into the snapshot
     i.add_handler(DeleteHandler())  # Special behavior for deletes
     i.add_handler(AlphaNumHandler())  # Standard behavior for everything else
     i.add_handler(SpaceHandler())
+    stats.enabled = options["stats"]
+    reporter = None
+    if stats.enabled:
+        reporter = StatsReporter(
+            os.path.join(appDirs.cache, STATS_FILE),
+            options["stats_interval"],
+            options["log_stats"],
+        )
+        reporter.start()  # Periodically publish latency histograms
+    recorder = None
+    if options["record"]:
+        recorder = TraceRecorder(
+            options["record"], i, output, buffer_size, trigger_keys
+        )  # Opt-in trace of key events for 'quikey-daemon replay'
+    worker = InputWorker(recorder or i, output.injected, options["queue_size"])
+    worker.start()  # Handles keys off the listener thread
+    try:
+        control = ControlServer(appDirs, control_commands(dbchange))
+        control.start()  # Serves qk requests on a Unix socket
+    except OSError:
+        logging.exception("Failed to open the control socket")
+        control = None
     write_pid(appDirs)  # Store the current pid
-    listener = Listener(on_press=i)
-    with Listener(on_press=i) as listener:  # Continue listening until SIGTERM
-        signal.signal(signal.SIGTERM, ShutdownHook(listener, watch, appDirs))
-        signal.signal(signal.SIGINT, ShutdownHook(listener, watch, appDirs))
+    with Listener(on_press=worker) as listener:  # Continue listening until SIGTERM
+        hook = ShutdownHook(listener, watch, appDirs, reporter, worker, control)
+        signal.signal(signal.SIGTERM, hook)
+        signal.signal(signal.SIGINT, hook)
+        signal.signal(signal.SIGHUP, ReloadHook(appDirs, i, dbchange, watch, hook))
+        if ready is not None:
+            signal_ready(ready)  # The keyboard hook is in place, 'start' returns
         listener.join()
+    worker.join()
+    if recorder is not None:
+        recorder.close()
 
 
 @click.group()
@@ -125,59 +452,208 @@ def cli(obj):
     multiple=True,
     required=False,
     default=["enter", "space"],
-    help="Trigger keys that indicate the end of a key phrase. The key name should match one from https://pythonhosted.org/pynput/_modules/pynput/keyboard/_base.html#Key",
+    help="Trigger keys that indicate the end of a key phrase. The key name should match one from "
+    "https://pythonhosted.org/pynput/_modules/pynput/keyboard/_base.html#Key",
+)
+@click.option(
+    "--debounce",
+    "-d",
+    required=False,
+    default=100,
+    help="Milliseconds to wait for database writes to settle before reloading phrases.",
+)
+@click.option(
+    "--paste-threshold",
+    "-p",
+    required=False,
+    default=256,
+    help="Phrases at least this many characters long are pasted through the clipboard instead of typed. Use 0 to always type.",
+)
+@click.option(
+    "--verbose",
+    "-v",
+    is_flag=True,
+    required=False,
+    default=False,
+    help="Log debug details, such as the events sent for each expansion.",
+)
+@click.option(
+    "--stats/--no-stats",
+    default=True,
+    help="Record keystroke, matching and expansion latency histograms.",
+)
+@click.option(
+    "--stats-interval",
+    default=30,
+    help="Seconds between writes of the latency histograms read by 'qk stats'.",
+)
+@click.option(
+    "--log-stats",
+    is_flag=True,
+    default=False,
+    help="Also write the latency histograms to the daemon log.",
 )
-def start(foreground, buffer_size, trigger_keys):
+@click.option(
+    "--cache/--no-cache",
+    default=True,
+    help="Load the compiled phrase-keys from the cache folder at startup when the database has not changed.",
+)
+@click.option(
+    "--lazy",
+    is_flag=True,
+    default=False,
+    help="Only keep phrase-keys in memory and read a value from the database when its phrase fires.",
+)
+@click.option(
+    "--value-cache-size",
+    default=1024,
+    help="With --lazy, thousands of characters of recently used values to keep in memory.",
+)
+@click.option(
+    "--queue-size",
+    required=False,
+    default=1024,
+    help="Most key events waiting to be handled. Keys pressed while the queue is full are dropped.",
+)
+@click.option(
+    "--record",
+    required=False,
+    default=None,
+    type=click.Path(dir_okay=False, writable=True),
+    help="Write a trace of key events to this file for 'quikey-daemon replay'. "
+    "Characters that were not part of an expanded phrase key are masked.",
+)
+def start(foreground, buffer_size, trigger_keys, **options):
     appDirs = AppDirectories()  # XDG folders
-    pid = read_pid(appDirs)
+    pid = running_pid(appDirs)
     daemon_log = appDirs.data + "/qkdaemon.log"
 
-    if pid:
-        try:
-            os.kill(int(pid), 0)
-            print("Quikey daemon is already running (pid: %s)." % pid)
-            return
-        except OSError:
-            pass
+    if pid is not None:
+        print("Quikey daemon is already running (pid: %s)." % pid)
+        return
     if foreground:
-        main(foreground, buffer_size, trigger_keys)
-    else:
+        main(foreground, buffer_size, trigger_keys, **options)
+        return
+    # The daemon writes its pid to the pipe once its keyboard listener is up.
+    # Fork first since DaemonContext exits the process that opens it.
+    ready_r, ready_w = os.pipe()
+    if os.fork() == 0:
+        os.close(ready_r)
         daemon_log_f = open(daemon_log, "w+")
-        with daemon.DaemonContext(stdout=daemon_log_f, stderr=daemon_log_f):
-            main(foreground, buffer_size, trigger_keys)
+        with daemon.DaemonContext(
+            stdout=daemon_log_f, stderr=daemon_log_f, files_preserve=[ready_w]
+        ):
+            main(foreground, buffer_size, trigger_keys, ready_w, **options)
+        return
+    os.close(ready_w)
+    pid = wait_ready(ready_r)
+    if pid is None:
+        print("Quikey daemon did not start, see %s" % daemon_log)
+        sys.exit(1)
+    print("Quikey daemon started (pid: %d)." % pid)
 
 
 @cli.command()
 def stop():
-    # Send SIGTERM signal
     appDirs = AppDirectories()  # XDG folders
     pid = read_pid(appDirs)
     if pid is None:
         print("No Quikey daemon currently running.")
         return
     try:
-        os.kill(int(pid), signal.SIGTERM)
-    except ProcessLookupError:
+        stopped = stop_daemon(appDirs)
+    except StopTimeout as e:
+        print(e)
+        sys.exit(1)
+    if stopped is None:
         print(
             "No Quikey daemon currently running (tried killing non-existent pid %s)."
             % pid
         )
-        delete_pid(appDirs)
+    else:
+        print("Quikey daemon stopped (pid: %d)." % stopped)
 
 
 @cli.command()
 def status():
-    # Check process existence
     appDirs = AppDirectories()  # XDG folders
-    pid = read_pid(appDirs)
+    pid = running_pid(appDirs)
     if pid is None:
         print("No Quikey daemon is currently running")
         sys.exit(1)
     try:
-        os.kill(int(pid), 0)
-    except OSError:
-        print("No Quikey daemon is currently running")
-        sys.exit(1)
+        result = request(appDirs, "status")
+    except ControlError as e:
+        print(e, file=sys.stderr)
+        result = None
+    for line in describe(pid, result and result["phrases"]):
+        print(line)
+
+
+@cli.command()
+@click.argument("trace", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--data-dir",
+    required=False,
+    default=None,
+    type=click.Path(exists=True, file_okay=False),
+    help="Replay against the phrase database in this directory, such as a copy of "
+    "a user's quikey data directory, instead of your own.",
+)
+@click.option(
+    "--backend",
+    required=False,
+    default=None,
+    type=click.Choice(BACKENDS),
+    help="Storage backend of the database in --data-dir. Defaults to the one in its config.ini.",
+)
+@click.option(
+    "--realtime",
+    is_flag=True,
+    default=False,
+    help="Keep the recorded delays between key events.",
+)
+@click.option(
+    "--paste-threshold",
+    "-p",
+    required=False,
+    default=256,
+    help="Same as for 'start'.",
+)
+@click.option(
+    "--json", "as_json", is_flag=True, default=False, help="Print the report as JSON."
+)
+def replay(trace, data_dir, backend, realtime, paste_threshold, as_json):
+    """
+    Replay a trace written by 'start --record' against a fake keyboard and
+    report every expansion with its timing.
+    """
+    if data_dir is None:
+        appDirs = AppDirectories()
     else:
-        print("Quikey daemon running (PID: " + pid + ")")
+        appDirs = AppDirectories(data_dir, data_dir, data_dir, directory="")
+    db = open_database(appDirs, backend)
+    expansions, histogram = replay_trace(
+        trace,
+        lambda notifier, output: DatabaseChangeHandler(notifier, db, output),
+        realtime,
+        paste_threshold,
+    )
+    summary = {
+        "events": histogram.count,
+        "expansions": len(expansions),
+        "mean_us": histogram.mean(),
+        "p50_us": histogram.percentile(50),
+        "p99_us": histogram.percentile(99),
+        "max_us": histogram.max,
+    }
+    if as_json:
+        print(json.dumps({"summary": summary, "expansions": expansions}, indent=2))
         return
+    for expansion in expansions:
+        print("event %(event)d: %(key)s (%(strategy)s) in %(ms).2fms" % expansion)
+    print(
+        "%(events)d events, %(expansions)d expansions, keystroke latency "
+        "mean %(mean_us).0fus p50 %(p50_us)dus p99 %(p99_us)dus max %(max_us).0fus"
+        % summary
+    )
@@ -1,20 +1,14 @@
 #!/usr/bin/env python
 
 import click
-from terminaltables import AsciiTable
-import humanize
-import signal
 import os
-import logging
 
-from quikey.models import Database
-from quikey.directories import AppDirectories
 from quikey.version import __version__
-from quikey.autostart import enableAutostart, disableAutostart
-from quikey.importer import PhraseFind
-from quikey import prompt
-from xdg import BaseDirectory
-import subprocess
+from quikey.policy import MULTIPLE_POLICIES, ASK, FIRST
+
+# Everything else is imported by the commands that need it. Editor
+# integrations run qk many times a day and most commands only need a few of
+# the modules.
 
 MARKER = """
 # Everything below this line will be ignored.
@@ -25,19 +19,36 @@ CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
 
 def get_database():
+    from quikey.directories import AppDirectories
+    from quikey.models import open_database
+
     appDirs = AppDirectories()  # XDG folders
-    d = Database(appDirs)
+    d = open_database(appDirs)
     return d
 
 
+def daemon_request(command, **args):
+    """
+    Send a request over the running daemon's control socket, so a change
+    reaches its matcher at once. Returns None when no daemon is listening,
+    in which case the caller uses the database directly. Raises
+    ClickException when the daemon refused the request or did not answer.
+    """
+    from quikey.control import request, ControlError
+    from quikey.directories import AppDirectories
+
+    try:
+        return request(AppDirectories(), command, **args)
+    except ControlError as e:
+        raise click.ClickException(str(e))
+
+
 @click.group(context_settings=CONTEXT_SETTINGS)
-@click.pass_context
-def cli(ctx):
+def cli():
     """A keyboard macro tool.
 
     Features, Feedback, and Bugs: https://github.com/bostrt/quikey
     """
-    ctx.obj = {"database": get_database()}
 
 
 @cli.command(help="Add a new phrase")
@@ -53,12 +64,38 @@ def cli(ctx):
     "-p",
     help="The full phrase to add. If this option is not specified then your default editor ($EDITOR) will be used.",
 )
-@click.pass_context
-def add(ctx, name, phrase, tag):
-    db = ctx.obj["database"]
+@click.option(
+    "--output",
+    "-o",
+    type=click.Choice(["type", "paste"]),
+    help="How the daemon should deliver the phrase. By default long phrases are pasted and short ones typed.",
+)
+@click.option(
+    "--pattern",
+    is_flag=True,
+    help="The name is a regular expression. Groups it captures replace \\1 or \\g<name> in the phrase.",
+)
+@click.option(
+    "--instant",
+    is_flag=True,
+    help="Expand as soon as the last character of the name is typed, without a trigger key.",
+)
+def add(name, phrase, tag, output, pattern, instant):
+    db = get_database()
     if not name or not name.strip():
         click.echo("quikey phrase cannot be empty")
         return
+    if pattern and instant:
+        click.echo("A pattern phrase can't be instant")
+        return
+    if pattern:
+        from quikey.matcher import PatternMatcher
+
+        try:
+            PatternMatcher.validate(name)
+        except ValueError as e:
+            click.echo("quikey phrase key %s is not a usable pattern: %s" % (name, e))
+            return
 
     contents = None
     if db.get(name) is not None:
@@ -73,16 +110,29 @@ def add(ctx, name, phrase, tag):
         else:
             click.echo("quikey phrase with key of %s not added" % name)
             return
-    db.put(name, contents, tag)
+    options = {}
+    if output:
+        options["output"] = output
+    if pattern:
+        options["pattern"] = True
+    if instant:
+        options["instant"] = True
+    options = options or None
+    if (
+        daemon_request("add", key=name, value=contents, tags=tag, options=options)
+        is None
+    ):
+        db.put(name, contents, tag, options)
     click.echo("quikey phrase with key of %s added." % name)
 
 
 @cli.command(help="Edit an existing phrase")
 @click.option("--name", "-n", help="Name of quikey phrase to edit.")
-@click.pass_context
-def edit(ctx, name):
-    db = ctx.obj["database"]
+def edit(name):
+    db = get_database()
     if name is None:
+        from quikey import prompt
+
         # Show user prompt with list of keys
         name = prompt.show(db, "edit")
         if name is None:
@@ -96,7 +146,8 @@ def edit(ctx, name):
         contents = click.edit(phrase + MARKER)
         if contents is not None:
             contents = contents.split(MARKER, 1)[0]
-            db.update(name, contents)
+            if daemon_request("update", key=name, value=contents) is None:
+                db.update(name, contents)
             click.echo("quikey phrase with key of %s updated." % name)
         else:
             click.echo("quikey phrase with key of %s not updated" % name)
@@ -106,18 +157,21 @@ def edit(ctx, name):
 
 @cli.command(help="Remove a phrase")
 @click.option("--name", "-n", help="Name of quikey phrase to remove.")
-@click.pass_context
-def rm(ctx, name):
-    db = ctx.obj["database"]
+def rm(name):
+    db = get_database()
     # TODO: Support multiple.
     if name is None:
+        from quikey import prompt
+
         # Show user prompt with list of keys
         name = prompt.show(db, "remove")
         if name is None:
             click.echo("No phrases available to remove.")
             return
 
-    if db.delete(name):
+    result = daemon_request("delete", key=name)
+    deleted = db.delete(name) if result is None else result["deleted"]
+    if deleted:
         click.echo("quikey phrase with key of %s has been deleted." % name)
     else:
         click.echo("quikey phrase with key of %s does not exist." % name)
@@ -130,9 +184,11 @@ def rm(ctx, name):
     help="Show the entire quikey phrase instead of a shortened version "
     "for long quikey phrases.",
 )
-@click.pass_context
-def ls(ctx, show_all):
-    db = ctx.obj["database"]
+def ls(show_all):
+    from terminaltables import AsciiTable
+    import humanize
+
+    db = get_database()
     table = [["Name", "Tags", "Last Modified", "Phrase"]]
     phrases = db.all()
     for phrase in phrases:
@@ -150,36 +206,88 @@ def ls(ctx, show_all):
 @click.option(
     "--location",
     "-l",
-    default=BaseDirectory.xdg_config_home + "/autokey/data/",
-    show_default=True,
+    default=lambda: os.path.join(
+        os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"),
+        "autokey/data/",
+    ),
+    show_default="$XDG_CONFIG_HOME/autokey/data/",
     help="Location of top level directory to import from autokey",
 )
-@click.pass_context
-def keyimport(ctx, location):
+@click.option(
+    "--multiple",
+    "-m",
+    type=click.Choice(MULTIPLE_POLICIES),
+    default=FIRST,
+    show_default=True,
+    help="For phrases with several abbreviations: ask which to use, use the first, use all, or skip the phrase.",
+)
+@click.option(
+    "--overwrite",
+    is_flag=True,
+    help="Replace phrases that already exist instead of skipping them.",
+)
+@click.option(
+    "--batch-size",
+    default=1000,
+    show_default=True,
+    help="Number of phrases written to the database at a time.",
+)
+@click.option(
+    "--workers",
+    type=int,
+    help="Number of threads used to read AutoKey files.",
+)
+@click.option(
+    "--sync",
+    is_flag=True,
+    help="Only import AutoKey files that changed since the last --sync, updating phrases that were imported before.",
+)
+@click.option(
+    "--prune",
+    is_flag=True,
+    help="With --sync, remove phrases whose AutoKey file was deleted.",
+)
+def keyimport(location, multiple, overwrite, batch_size, workers, sync, prune):
+    from quikey import importer
+    from quikey.importer import Manifest, iter_phrases, choose_keys, batches
+    from quikey.directories import AppDirectories
+
+    if multiple == ASK and not click.get_text_stream("stdin").isatty():
+        raise click.UsageError("--multiple ask needs a terminal to answer on.")
     tags = ["autokey-imports"]
-    db = ctx.obj["database"]
-    importfiles = PhraseFind(location)
-    for key in importfiles:
-        contents = None
-        if importfiles[key] is not None:
-            if db.get(key) is not None:
-                click.echo("quikey phrase with key of %s already exists" % key)
-                continue
-            else:
-                contents = importfiles[key]
-        else:
-            if db.get(key) is not None:
-                click.echo("quikey phrase with key of %s already exists" % key)
-                continue
-            else:
-                contents = click.edit("\n\n" + MARKER)
-                if contents is not None:
-                    contents = contents.split(MARKER, 1)[0]
-                else:
-                    click.echo("quikey phrase with key of %s not added" % key)
+    db = get_database()
+    if sync:
+        manifest = Manifest(AppDirectories())
+        result = importer.sync(
+            db, location, manifest, multiple, overwrite, prune, workers
+        )
+        for key in result.skipped:
+            click.echo("quikey phrase with key of %s already exists" % key)
+        for key in result.added:
+            click.echo("quikey phrase with key of %s added." % key)
+        for key in result.updated:
+            click.echo("quikey phrase with key of %s updated." % key)
+        for key in result.removed:
+            click.echo("quikey phrase with key of %s has been deleted." % key)
+        return
+    seen = set()
+    for batch in batches(iter_phrases(location, workers), batch_size):
+        phrases = {}
+        for phrase in batch:
+            for key in choose_keys(phrase, multiple):
+                if key in seen:
+                    click.echo("quikey phrase with key of %s imported twice" % key)
                     continue
-        db.put(key, contents, tags)
-        click.echo("quikey phrase with key of %s added." % key)
+                seen.add(key)
+                phrases[key] = phrase.value
+        if not overwrite:
+            for key in db.get_many(phrases.keys()):
+                click.echo("quikey phrase with key of %s already exists" % key)
+                del phrases[key]
+        # Write each batch at once so the daemon reloads once per batch.
+        db.put_many(phrases, tags)
+        for key in phrases:
+            click.echo("quikey phrase with key of %s added." % key)
 
 
 @cli.command(help="Display version")
@@ -195,27 +303,105 @@ def autostart():
 @autostart.command()
 def enable():
     "Enable autostart at login for quikey."
+    from quikey.autostart import enableAutostart
+
     enableAutostart()
 
 
 @autostart.command()
 def disable():
     "Disable autostart at login for quikey."
+    from quikey.autostart import disableAutostart
+
     disableAutostart()
 
 
 @cli.command(help="Display status of quikey daemon")
-@click.pass_context
-def status(ctx):
-    subprocess.run(["quikey-daemon", "status"])
-    click.echo("Database location: " + ctx.obj["database"].dbFile)
+def status():
+    from quikey.directories import AppDirectories
+    from quikey.process import running_pid, describe
+
+    pid = running_pid(AppDirectories())
+    if pid is None:
+        click.echo("No Quikey daemon is currently running")
+    else:
+        try:
+            result = daemon_request("status")
+        except click.ClickException as e:
+            click.echo(e.message, err=True)
+            result = None
+        for line in describe(pid, result and result["phrases"]):
+            click.echo(line)
+    click.echo("Database location: " + get_database().dbFile)
+
+
+@cli.command(help="Make the quikey daemon reload its phrases now")
+def reload():
+    result = daemon_request("reload")
+    if result is None:
+        click.echo("No Quikey daemon is currently running")
+        return
+    click.echo(
+        "Reloaded %(total)d phrases in %(duration).3fs "
+        "(%(added)d added, %(removed)d removed, %(changed)d changed)" % result
+    )
+
+
+@cli.command(help="Display latency statistics of the quikey daemon")
+def stats():
+    from terminaltables import AsciiTable
+    from quikey.directories import AppDirectories
+    from quikey.stats import Stats, STATS_FILE
+
+    # Ask the running daemon first for up to date numbers.
+    result = daemon_request("stats")
+    if result is not None:
+        daemon_stats = Stats.from_dict(result)
+    else:
+        path = os.path.join(AppDirectories().cache, STATS_FILE)
+        try:
+            daemon_stats = Stats.load(path)
+        except FileNotFoundError:
+            click.echo(
+                "No statistics recorded yet. Is the daemon running with --stats?"
+            )
+            return
+    table = [["Stage", "Count", "Mean (ms)", "p50 (ms)", "p99 (ms)", "Max (ms)"]]
+    table.extend(daemon_stats.rows())
+    click.echo(AsciiTable(table).table)
+    counters = daemon_stats.counter_rows()
+    if counters:
+        click.echo(AsciiTable([["Counter", "Value"]] + counters).table)
 
 
 @cli.command(help="Start quikey daemon")
-def start():
-    subprocess.run(["quikey-daemon", "start"])
+@click.pass_context
+def start(ctx):
+    from quikey import qkdaemon
+
+    # Runs 'quikey-daemon start' with its default options and returns once
+    # the daemon is listening.
+    ctx.invoke(qkdaemon.start)
 
 
 @cli.command(help="Stop quikey daemon")
 def stop():
-    subprocess.run(["quikey-daemon", "stop"])
+    from quikey.directories import AppDirectories
+    from quikey.process import read_pid, stop_daemon, StopTimeout
+
+    appDirs = AppDirectories()
+    pid = read_pid(appDirs)
+    if pid is None:
+        click.echo("No Quikey daemon currently running.")
+        return
+    try:
+        stopped = stop_daemon(appDirs)
+    except StopTimeout as e:
+        raise click.ClickException(str(e))
+    if stopped is None:
+        click.echo(
+            "No Quikey daemon currently running (tried killing non-existent pid %s)."
+            % pid
+        )
+    else:
+        click.echo("Quikey daemon stopped (pid: %d)." % stopped)
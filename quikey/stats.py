@@ -0,0 +1,204 @@
+from bisect import bisect_left
+from threading import Thread, Event
+import json
+import logging
+import os
+
+STATS_FILE = "stats.json"
+
+# Upper bounds of the histogram buckets in microseconds. Anything slower
+# than the last bound lands in an overflow bucket.
+BUCKETS = (
+    10,
+    25,
+    50,
+    100,
+    250,
+    500,
+    1000,
+    2500,
+    5000,
+    10000,
+    25000,
+    50000,
+    100000,
+    250000,
+    1000000,
+)
+
+
+class Histogram:
+    """
+    Fixed-bucket latency histogram. Recording a sample is a bisect and two
+    additions, cheap enough for the keyboard hook.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        us = seconds * 1000000
+        self.counts[bisect_left(self.bounds, us)] += 1
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+
+    def percentile(self, p):
+        """
+        Upper bound, in microseconds, of the bucket holding the p-th
+        percentile sample. Returns the maximum for the overflow bucket.
+        """
+        if self.count == 0:
+            return 0
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def to_dict(self):
+        return {
+            "bounds": list(self.bounds),
+            "counts": self.counts,
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        h = cls(tuple(d["bounds"]))
+        h.counts = d["counts"]
+        h.count = d["count"]
+        h.total = d["total"]
+        h.max = d["max"]
+        return h
+
+
+class Stats:
+    """
+    Named latency histograms and counters for the daemon. When disabled,
+    record() returns straight away, and callers check enabled before reading
+    the clock.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, Histogram())
+        histogram.record(seconds)
+
+    def increment(self, name, count=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def maximum(self, name, value):
+        """
+        Keep the highest value seen for name, such as a queue's peak depth.
+        """
+        if not self.enabled:
+            return
+        if value > self.counters.get(name, 0):
+            self.counters[name] = value
+
+    def to_dict(self):
+        return {
+            "histograms": {k: v.to_dict() for k, v in list(self.histograms.items())},
+            "counters": dict(self.counters),
+        }
+
+    def dump(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        for name, d in data["histograms"].items():
+            stats.histograms[name] = Histogram.from_dict(d)
+        stats.counters = data["counters"]
+        return stats
+
+    def rows(self):
+        """
+        Summary table rows: name, count, mean, p50, p99 and max, with
+        durations in milliseconds.
+        """
+        rows = []
+        for name, h in sorted(self.histograms.items()):
+            rows.append(
+                [
+                    name,
+                    h.count,
+                    "%.3f" % (h.mean() / 1000),
+                    "%.3f" % (h.percentile(50) / 1000),
+                    "%.3f" % (h.percentile(99) / 1000),
+                    "%.3f" % (h.max / 1000),
+                ]
+            )
+        return rows
+
+    def counter_rows(self):
+        return [[name, value] for name, value in sorted(self.counters.items())]
+
+
+# Shared by every daemon component.
+stats = Stats()
+
+
+class StatsReporter(Thread):
+    """
+    Writes the daemon's histograms to the stats file every interval seconds
+    and, when log is set, to the daemon log as well.
+    """
+
+    def __init__(self, path, interval=30, log=False):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.log = log
+        self.stopped = Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.report()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        try:
+            stats.dump(self.path)
+        except OSError:
+            logging.exception("Failed to write %s", self.path)
+        if self.log:
+            for row in stats.rows():
+                logging.info("%s: count=%s mean=%sms p50=%sms p99=%sms max=%sms", *row)
+            for row in stats.counter_rows():
+                logging.info("%s: %s", *row)
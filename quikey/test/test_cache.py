@@ -0,0 +1,70 @@
+import os
+import unittest
+import tempfile
+from shutil import rmtree
+
+from quikey.cache import MatcherCache
+from quikey.directories import AppDirectories
+from quikey.matcher import SuffixMatcher
+from quikey.models import Database, Phrase
+
+
+class MatcherCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.db = Database(self.appDirs)
+        self.db.put("hi", "hello", options={"output": "paste"})
+        self.matcherCache = MatcherCache(self.appDirs)
+        self.phrases = {x["key"]: Phrase.from_doc(x) for x in self.db.all()}
+        self.matcher = SuffixMatcher((k, None) for k in self.phrases)
+
+    def tearDown(self):
+        rmtree(self.data)
+        rmtree(self.config)
+        rmtree(self.cache)
+
+    def save(self):
+        signature = self.matcherCache.signature(self.db)
+        self.matcherCache.save(signature, self.phrases, self.matcher)
+
+    def testNoCache(self):
+        self.assertIsNone(self.matcherCache.load(self.db))
+
+    def testSaveLoad(self):
+        self.save()
+        phrases, matcher = self.matcherCache.load(self.db)
+        self.assertEqual(self.phrases, phrases)
+        self.assertEqual("paste", phrases["hi"].options["output"])
+        self.assertEqual(("hi", None), matcher.match("oh hi"))
+        self.assertEqual(1, len(matcher))
+
+    def testOnlyUserCanRead(self):
+        umask = os.umask(0)
+        try:
+            self.save()
+        finally:
+            os.umask(umask)
+        self.assertEqual(0o600, os.stat(self.matcherCache.path).st_mode & 0o777)
+
+    def testWritableByOthersIgnored(self):
+        self.save()
+        os.chmod(self.matcherCache.path, 0o666)
+        self.assertIsNone(self.matcherCache.load(self.db))
+
+    def testStale(self):
+        self.save()
+        self.db.put("btw", "by the way")
+        self.assertIsNone(self.matcherCache.load(self.db))
+
+    def testUnreadable(self):
+        with open(self.matcherCache.path, "wb") as f:
+            f.write(b"garbage")
+        with self.assertLogs(level="WARNING"):
+            self.assertIsNone(self.matcherCache.load(self.db))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+from unittest import mock
+import socket
+import tempfile
+from shutil import rmtree
+from os import path, getpid, stat
+
+from quikey.control import ControlServer, ControlClient, ControlError, request
+from quikey.directories import AppDirectories
+from quikey.fakes import FakeController
+from quikey.input import Notifier
+from quikey.models import Database
+from quikey.output import OutputEngine
+from quikey.qkdaemon import DatabaseChangeHandler, control_commands
+
+
+class ControlTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.db = Database(self.appDirs)
+        self.db.put("hi", "hello")
+        self.notifier = Notifier(mock.MagicMock())
+        self.handler = DatabaseChangeHandler(
+            self.notifier, self.db, OutputEngine(FakeController())
+        )
+        self.server = ControlServer(self.appDirs, control_commands(self.handler))
+        self.server.start()
+        self.client = ControlClient(self.appDirs)
+
+    def tearDown(self):
+        self.server.stop()
+        rmtree(self.data)
+        rmtree(self.config)
+        rmtree(self.cache)
+
+    def testStatus(self):
+        result = self.client.request("status")
+        self.assertEqual({"pid": getpid(), "phrases": 1}, result)
+
+    def testSocketIsPrivate(self):
+        self.assertEqual(0o600, stat(self.server.path).st_mode & 0o777)
+
+    def testAdd(self):
+        self.client.request("add", key="ty", value="thank you", tags=["t"])
+        self.assertIn("ty", self.notifier.matcher)
+        self.assertEqual("thank you", self.handler.snapshot.get("ty"))
+        self.assertEqual("thank you", self.db.get("ty"))
+
+    def testAddExisting(self):
+        with self.assertRaises(ControlError):
+            self.client.request("add", key="hi", value="hey")
+        self.assertEqual("hello", self.db.get("hi"))
+
+    def testUpdate(self):
+        self.client.request("update", key="hi", value="hey")
+        self.assertEqual("hey", self.handler.snapshot.get("hi"))
+        with self.assertRaises(ControlError):
+            self.client.request("update", key="nope", value="hey")
+
+    def testDelete(self):
+        self.assertEqual({"deleted": True}, self.client.request("delete", key="hi"))
+        self.assertNotIn("hi", self.notifier.matcher)
+        self.assertEqual({"deleted": False}, self.client.request("delete", key="hi"))
+
+    def testReload(self):
+        self.db.put("ty", "thank you")
+        result = self.client.request("reload")
+        self.assertEqual(1, result["added"])
+        self.assertEqual(2, result["total"])
+
+    def testStats(self):
+        result = self.client.request("stats")
+        self.assertIn("histograms", result)
+
+    def testBadRequest(self):
+        with self.assertRaises(ControlError):
+            self.client.request("nope")
+        with self.assertRaises(ControlError):
+            self.client.request("delete", name="hi")
+
+    def testNoDaemon(self):
+        self.server.stop()
+        self.assertFalse(path.exists(self.server.path))
+        self.assertIsNone(request(self.appDirs, "status"))
+
+    def testStaleSocket(self):
+        # A socket file left behind by a daemon that was killed.
+        self.server.stop()
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.server.path)
+        stale.close()
+        self.assertIsNone(request(self.appDirs, "status"))
+        self.server = ControlServer(self.appDirs, control_commands(self.handler))
+        self.server.start()
+        self.assertEqual(1, request(self.appDirs, "status")["phrases"])
+
+    def testDaemonNotAnswering(self):
+        for error in (socket.timeout("timed out"), PermissionError(13, "Denied")):
+            with mock.patch.object(ControlClient, "request", side_effect=error):
+                with self.assertRaises(ControlError):
+                    request(self.appDirs, "add", key="btw", value="by the way")
+        self.assertIsNone(self.db.get("btw"))
+
+
+if __name__ == "__main__":
+    unittest.main()
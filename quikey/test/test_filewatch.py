@@ -0,0 +1,81 @@
+import unittest
+from unittest import mock
+import tempfile
+import time
+import os
+from shutil import rmtree
+
+from quikey.filewatch import InotifyWatch
+
+
+class InotifyWatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.dir, "phrases.json")
+        with open(self.dbfile, "w") as f:
+            f.write("{}")
+        self.observer = mock.MagicMock()
+        self.watch = InotifyWatch(self.dbfile, debounce=0.1, poll_interval=0.05)
+        self.watch.add_observer(self.observer)
+        self.watch.start()
+
+    def tearDown(self):
+        self.watch.stop()
+        self.watch.join()
+        rmtree(self.dir)
+
+    def waitForNotify(self, count):
+        deadline = time.time() + 2
+        while self.observer.notify.call_count < count and time.time() < deadline:
+            time.sleep(0.01)
+        # Allow any extra (unwanted) notifications to arrive.
+        time.sleep(0.3)
+
+    def testBurstCoalesced(self):
+        for i in range(5):
+            with open(self.dbfile, "w") as f:
+                f.write('{"n": %d}' % i)
+        self.waitForNotify(1)
+        self.assertEqual(1, self.observer.notify.call_count)
+
+    def testAtomicRename(self):
+        for i in range(2):
+            tmp = os.path.join(self.dir, ".phrases.json.tmp")
+            with open(tmp, "w") as f:
+                f.write('{"n": %d}' % i)
+            os.rename(tmp, self.dbfile)
+            self.waitForNotify(i + 1)
+        self.assertEqual(2, self.observer.notify.call_count)
+
+    def testOtherFilesIgnored(self):
+        with open(os.path.join(self.dir, "other.json"), "w") as f:
+            f.write("{}")
+        self.waitForNotify(1)
+        self.observer.notify.assert_not_called()
+
+    def testReadOnlyOpenIgnored(self):
+        # What TinyDB does when a qk command only reads the database.
+        with open(self.dbfile, "r+") as f:
+            f.read()
+        self.waitForNotify(1)
+        self.observer.notify.assert_not_called()
+
+    def testOtherFilesDontDelay(self):
+        with open(self.dbfile, "w") as f:
+            f.write('{"n": 1}')
+        log = os.path.join(self.dir, "qkdaemon.log")
+        deadline = time.time() + 1
+        while self.observer.notify.call_count == 0 and time.time() < deadline:
+            with open(log, "a") as f:
+                f.write("reloading\n")
+            time.sleep(0.02)
+        self.assertEqual(1, self.observer.notify.call_count)
+
+    def testStop(self):
+        self.watch.stop()
+        self.watch.join(1)
+        self.assertFalse(self.watch.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+import unittest
+import tempfile
+import json
+import os
+from shutil import rmtree
+
+from quikey.directories import AppDirectories
+from quikey.models import Database
+
+from quikey.importer import (
+    scan,
+    parse,
+    iter_phrases,
+    choose_keys,
+    batches,
+    PhraseFind,
+    Manifest,
+    sync,
+    FIRST,
+    ALL,
+    SKIP,
+)
+
+
+class AutoKeyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.write("hello", "Hello world", ["hw"])
+        self.write("folder/btw", "by the way", ["btw", "b"])
+        self.write("folder/deeper/hot", "hotkey", ["hk"], modes=[3])
+        self.write("folder/script", "print()", ["sc"], type="script")
+        with open(os.path.join(self.location, "nojson.txt"), "w") as f:
+            f.write("orphan")
+
+    def tearDown(self):
+        rmtree(self.location)
+
+    def write(self, name, value, abbreviations, modes=None, type="phrase"):
+        path = os.path.join(self.location, name + ".txt")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(value)
+        directory, file = os.path.split(path)
+        config = {
+            "type": type,
+            "modes": modes or [1],
+            "abbreviation": {"abbreviations": abbreviations},
+        }
+        with open(os.path.join(directory, "." + file[:-4] + ".json"), "w") as f:
+            json.dump(config, f)
+
+
+class ImporterTestCase(AutoKeyTestCase):
+    def testScan(self):
+        self.assertEqual(5, len(list(scan(self.location))))
+
+    def testParse(self):
+        phrase = parse(os.path.join(self.location, "hello.txt"))
+        self.assertEqual(["hw"], phrase.abbreviations)
+        self.assertEqual("Hello world", phrase.value)
+        self.assertIsNone(parse(os.path.join(self.location, "nojson.txt")))
+        self.assertIsNone(parse(os.path.join(self.location, "folder/script.txt")))
+        self.assertIsNone(parse(os.path.join(self.location, "folder/deeper/hot.txt")))
+
+    def testIterPhrases(self):
+        phrases = list(iter_phrases(self.location, workers=2, window=1))
+        self.assertEqual(
+            ["Hello world", "by the way"], sorted(x.value for x in phrases)
+        )
+
+    def testChooseKeys(self):
+        phrase = parse(os.path.join(self.location, "folder/btw.txt"))
+        self.assertEqual(["btw"], choose_keys(phrase, FIRST))
+        self.assertEqual(["btw", "b"], choose_keys(phrase, ALL))
+        self.assertEqual([], choose_keys(phrase, SKIP))
+
+    def testPhraseFind(self):
+        self.assertEqual(
+            {"hw": "Hello world", "btw": "by the way", "b": "by the way"},
+            PhraseFind(self.location, ALL),
+        )
+
+    def testBatches(self):
+        self.assertEqual([[1, 2], [3, 4], [5]], list(batches(range(1, 6), 2)))
+
+
+class SyncTestCase(AutoKeyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.db = Database(self.appDirs)
+
+    def tearDown(self):
+        super().tearDown()
+        rmtree(self.data)
+        rmtree(self.config)
+        rmtree(self.cache)
+
+    def sync(self, **kwargs):
+        return sync(self.db, self.location, Manifest(self.appDirs), FIRST, **kwargs)
+
+    def testFirstSync(self):
+        result = self.sync()
+        self.assertEqual(["btw", "hw"], result.added)
+        self.assertEqual("Hello world", self.db.get("hw"))
+
+    def testNothingChanged(self):
+        self.sync()
+        self.assertEqual(([], [], [], []), self.sync())
+
+    def testChangedFile(self):
+        self.sync()
+        self.write("hello", "Hello again", ["hw"])
+        result = self.sync()
+        self.assertEqual(["hw"], result.updated)
+        self.assertEqual("Hello again", self.db.get("hw"))
+
+    def testTouchedFile(self):
+        self.sync()
+        path = os.path.join(self.location, "hello.txt")
+        os.utime(path, ns=(0, 0))
+        self.assertEqual(([], [], [], []), self.sync())
+
+    def testRenamedKey(self):
+        self.sync()
+        self.write("hello", "Hello world", ["hello"])
+        result = self.sync()
+        self.assertEqual(["hello"], result.added)
+        self.assertEqual(["hw"], result.removed)
+        self.assertIsNone(self.db.get("hw"))
+
+    def testPrune(self):
+        self.sync()
+        os.remove(os.path.join(self.location, "hello.txt"))
+        self.assertEqual([], self.sync().removed)
+        self.assertEqual(["hw"], self.sync(prune=True).removed)
+        self.assertIsNone(self.db.get("hw"))
+
+    def testConflict(self):
+        self.db.put("hw", "mine")
+        result = self.sync()
+        self.assertEqual(["hw"], result.skipped)
+        self.assertEqual("mine", self.db.get("hw"))
+        os.remove(os.path.join(self.location, "hello.txt"))
+        self.sync(prune=True)
+        self.assertEqual("mine", self.db.get("hw"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,21 @@
 import unittest
 from unittest import mock
 import tempfile
+import time
 from collections import deque
+from threading import Lock
 
 from pynput.keyboard import KeyCode, Key
 
+from quikey.output import OutputEngine
+from quikey.fakes import FakeController, FakeListener
+from quikey.models import Phrase, PhraseSnapshot
+from quikey.matcher import InstantMatcher
+from quikey.output import InjectedKeys
 from quikey.input import (
+    KeyBuffer,
+    InputHandler,
+    InputWorker,
     PhraseHandler,
     Notifier,
     AlphaNumHandler,
@@ -20,11 +30,13 @@ class PhraseHandlerTestCase(unittest.TestCase):
     def setUp(self, controller, db):
         self.controller = controller
         self.db = db
-        self.phraseHandler = PhraseHandler("test", self.db, self.controller)
+        self.phraseHandler = PhraseHandler(
+            "test", self.db, OutputEngine(self.controller)
+        )
 
     def testNotifyMatch(self):
         self.assertTrue(self.phraseHandler.notify("test"))
-        self.phraseHandler.keyboard.type.assert_called()
+        self.controller.press.assert_called()
 
     def testNotifyNoMatch(self):
         self.assertFalse(self.phraseHandler.notify("asdf"))
@@ -51,21 +63,64 @@ class NotifierTestCase(unittest.TestCase):
 
     @mock.patch("quikey.qkdaemon.DatabaseChangeHandler")
     def testNotifyMatch(self, observer):
-        observer.notify = mock.MagicMock(return_value=True)
+        observer.key = "x"
+        observer.expand = mock.MagicMock(return_value=True)
         self.notifier.add(observer)
-        self.notifier.notify("x")
+        self.assertTrue(self.notifier.notify("abcx"))
         self.notifier.lock.acquire.assert_called()
         self.notifier.lock.release.assert_called()
-        self.notifier.observers[0].notify.assert_called()
+        self.notifier.observers[0].expand.assert_called()
 
     @mock.patch("quikey.qkdaemon.DatabaseChangeHandler")
     def testNotifyNoMatch(self, observer):
-        observer.notify = mock.MagicMock(return_value=False)
+        observer.key = "y"
+        observer.expand = mock.MagicMock(return_value=True)
         self.notifier.add(observer)
-        self.notifier.notify("x")
-        self.notifier.lock.acquire.assert_called()
-        self.notifier.lock.release.assert_called()
-        self.notifier.observers[0].notify.assert_called()
+        self.assertFalse(self.notifier.notify("x"))
+        self.notifier.lock.acquire.assert_not_called()
+        self.notifier.observers[0].expand.assert_not_called()
+
+    def testNotifyPattern(self):
+        snapshot = PhraseSnapshot(
+            {
+                r"addr(\d)": Phrase(r"Street \1", {"pattern": True}),
+                "addr1": Phrase("Home", {}),
+            }
+        )
+        output = mock.Mock()
+        notifier = Notifier(Lock())
+        notifier.replace(PhraseHandler(k, snapshot, output) for k in snapshot.keys())
+        self.assertNotIn(r"addr(\d)", notifier.matcher)
+        self.assertTrue(notifier.notify("my addr2"))
+        output.expand.assert_called_with("addr2", "Street 2", None, 1)
+        # Literal keys come first.
+        self.assertTrue(notifier.notify("addr1"))
+        output.expand.assert_called_with("addr1", "Home", None, 1)
+        notifier.remove(r"addr(\d)")
+        self.assertFalse(notifier.notify("addr2"))
+
+    def testNotifyPatternWithFlags(self):
+        key = r"(?i)sig(\d)"
+        snapshot = PhraseSnapshot({key: Phrase(r"Signature \1", {"pattern": True})})
+        output = mock.Mock()
+        handler = PhraseHandler(key, snapshot, output)
+        self.assertTrue(handler.notify("SIG1"))
+        output.expand.assert_called_with("SIG1", "Signature 1", None, 1)
+        notifier = Notifier(Lock())
+        notifier.add(handler)
+        self.assertTrue(notifier.notify("my Sig2"))
+        output.expand.assert_called_with("Sig2", "Signature 2", None, 1)
+
+    def testNotifyLongestMatch(self):
+        short = mock.MagicMock(key="lo")
+        longer = mock.MagicMock(key="hello")
+        self.notifier.add(short)
+        self.notifier.add(longer)
+        self.notifier.notify("well hello")
+        longer.expand.assert_called()
+        short.expand.assert_not_called()
+        self.notifier.notify("yo lo")
+        short.expand.assert_called()
 
 
 class AlphaNumHandlerTestCase(unittest.TestCase):
@@ -141,5 +196,270 @@ class SpaceHandlerTestCase(unittest.TestCase):
         self.assertEqual(2, len(buff))
 
 
+class InstantTestCase(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = PhraseSnapshot(
+            {
+                ";sig": Phrase("Regards", {"instant": True}),
+                "btw": Phrase("by the way", {}),
+            }
+        )
+        self.output = mock.Mock()
+        self.notifier = Notifier(Lock())
+        self.notifier.replace(
+            PhraseHandler(k, self.snapshot, self.output) for k in self.snapshot.keys()
+        )
+        self.handler = InputHandler(self.notifier, 32, ["enter"])
+        self.handler.add_handler(DeleteHandler())
+        self.handler.add_handler(AlphaNumHandler())
+
+    def type(self, text):
+        for c in text:
+            self.handler(KeyCode.from_char(c))
+
+    def testExpandsWithoutTrigger(self):
+        self.type("x;sig")
+        self.output.expand.assert_called_once_with(";sig", "Regards", None, 0)
+        self.assertEqual(0, len(self.handler.keybuff))
+
+    def testOnlyInstantPhrases(self):
+        self.type("btw")
+        self.output.expand.assert_not_called()
+        self.assertIn(";sig", self.notifier.instant)
+        self.assertNotIn("btw", self.notifier.instant)
+
+    def testBackspaceRollsBack(self):
+        self.type(";sx")
+        self.handler(Key.backspace)
+        self.type("ig")
+        self.output.expand.assert_called_once_with(";sig", "Regards", None, 0)
+
+    def testBackspaceBreaksKey(self):
+        self.type(";si")
+        self.handler(Key.backspace)
+        self.type("g")
+        self.output.expand.assert_not_called()
+
+    def testNewMatcher(self):
+        self.type(";si")
+        self.notifier.remove(";sig")
+        self.type("g")
+        self.output.expand.assert_not_called()
+        self.assertEqual(0, len(self.notifier.instant))
+
+    def testBatchBuildsOnce(self):
+        self.snapshot.replace(
+            {k: Phrase(k, {"instant": True}) for k in (";a", ";b", ";c")}
+        )
+        with mock.patch("quikey.input.InstantMatcher", wraps=InstantMatcher) as built:
+            with self.notifier.batch():
+                self.notifier.remove(";sig")
+                for key in (";a", ";b", ";c"):
+                    self.notifier.add(PhraseHandler(key, self.snapshot, self.output))
+                self.notifier.remove(";c")
+                self.assertIn(";sig", self.notifier.instant)
+        self.assertEqual(1, built.call_count)
+        self.assertEqual({";a", ";b"}, self.notifier.instant.keys)
+        self.type(";b")
+        self.output.expand.assert_called_once_with(";b", ";b", None, 0)
+
+
+class KeyBufferTestCase(unittest.TestCase):
+    def setUp(self):
+        self.buff = KeyBuffer(4)
+
+    def testAppendWraps(self):
+        for c in "abcdef":
+            self.buff.append(c)
+        self.assertEqual(4, len(self.buff))
+        self.assertEqual("cdef", str(self.buff))
+        self.assertEqual(["f", "e", "d", "c"], list(reversed(self.buff)))
+
+    def testPop(self):
+        for c in "abcde":
+            self.buff.append(c)
+        self.assertEqual("e", self.buff.pop())
+        self.buff.append("x")
+        self.assertEqual("bcdx", str(self.buff))
+        self.buff.clear()
+        self.assertEqual(0, len(self.buff))
+        with self.assertRaises(IndexError):
+            self.buff.pop()
+
+    def testSuffix(self):
+        for c in "abcdef":
+            self.buff.append(c)
+        self.assertEqual("ef", self.buff.suffix(2))
+        self.assertEqual("cdef", self.buff.suffix(10))
+
+    def testResized(self):
+        for c in "abcd":
+            self.buff.append(c)
+        smaller = self.buff.resized(2)
+        self.assertEqual("cd", str(smaller))
+        larger = self.buff.resized(8)
+        larger.append("e")
+        self.assertEqual("abcde", str(larger))
+
+    def testNotifierMatchesBuffer(self):
+        notifier = Notifier(mock.MagicMock())
+        observer = mock.MagicMock(key="ef")
+        notifier.add(observer)
+        for c in "abcdef":
+            self.buff.append(c)
+        self.assertTrue(notifier.notify(self.buff))
+        observer.expand.assert_called()
+
+    def testHandlers(self):
+        AlphaNumHandler().onkey(KeyCode.from_char("a"), self.buff)
+        AlphaNumHandler().onkey(KeyCode.from_char("b"), self.buff)
+        DeleteHandler().onkey(Key.backspace, self.buff)
+        self.assertEqual("a", str(self.buff))
+
+
+class InputHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.notifier = mock.MagicMock()
+        self.handler = InputHandler(self.notifier, 8, ["enter"])
+        self.handler.add_handler(AlphaNumHandler())
+
+    def testTriggerNotifiesWithBuffer(self):
+        self.notifier.notify.return_value = True
+        for c in "btw":
+            self.handler(KeyCode.from_char(c))
+        self.handler(Key.enter)
+        self.notifier.notify.assert_called_once()
+        self.assertEqual(0, len(self.handler.keybuff))
+
+    def testConfigure(self):
+        for c in "abcdef":
+            self.handler(KeyCode.from_char(c))
+        self.handler.configure(4, ["tab"])
+        self.assertEqual("cdef", str(self.handler.keybuff))
+        self.assertEqual([Key.tab], self.handler.triggerhandler.triggerkeys)
+        self.handler.configure()
+        self.assertEqual(4, self.handler.keybuff.maxlen)
+
+    def testFakeListener(self):
+        with FakeListener(on_press=self.handler) as listener:
+            for c in "abc":
+                listener.press(KeyCode.from_char(c))
+        listener.press(KeyCode.from_char("d"))
+        self.assertEqual("abc", str(self.handler.keybuff))
+
+
+class InputWorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.handler = mock.Mock()
+        self.injected = InjectedKeys()
+        self.worker = InputWorker(self.handler, self.injected, capacity=2)
+
+    def testQueueAndDrain(self):
+        self.worker(KeyCode.from_char("a"))
+        self.worker(KeyCode.from_char("b"))
+        self.handler.assert_not_called()
+        self.worker.drain()
+        self.assertEqual(
+            [mock.call(KeyCode.from_char("a")), mock.call(KeyCode.from_char("b"))],
+            self.handler.call_args_list,
+        )
+
+    def testDropWhenFull(self):
+        for c in "abc":
+            self.worker(KeyCode.from_char(c))
+        self.assertEqual(1, self.worker.dropped)
+        self.worker.drain()
+        self.assertEqual(2, self.handler.call_count)
+
+    def testSkipInjected(self):
+        self.worker(KeyCode.from_char("a"), True)
+        self.worker.drain()
+        self.handler.assert_not_called()
+
+    def testSkipExpected(self):
+        self.injected.expect([(True, "a"), (False, "a")])
+        self.worker(KeyCode.from_char("b"))
+        self.worker(KeyCode.from_char("a"))
+        self.worker.drain()
+        self.handler.assert_called_once_with(KeyCode.from_char("b"))
+
+    def testHandlerErrorKeepsDraining(self):
+        self.handler.side_effect = [ValueError, None]
+        self.worker(KeyCode.from_char("a"))
+        self.worker(KeyCode.from_char("b"))
+        with self.assertLogs(level="ERROR"):
+            self.worker.drain()
+        self.assertEqual(2, self.handler.call_count)
+
+    def testStop(self):
+        handler = InputHandler(mock.Mock(), 10, ["enter"])
+        handler.add_handler(AlphaNumHandler())
+        worker = InputWorker(handler)
+        worker.start()
+        with FakeListener(on_press=worker) as listener:
+            for c in "abc":
+                listener.press(KeyCode.from_char(c))
+        worker.stop()
+        worker.join(1)
+        self.assertFalse(worker.is_alive())
+
+    def testThreadDrains(self):
+        worker = InputWorker(self.handler)
+        worker.start()
+        for c in "abc":
+            worker(KeyCode.from_char(c))
+        for i in range(100):
+            if self.handler.call_count == 3:
+                break
+            time.sleep(0.01)
+        worker.stop()
+        worker.join(1)
+        self.assertEqual(3, self.handler.call_count)
+
+
+class InjectedInputTestCase(unittest.TestCase):
+    """
+    The fake keyboard echoes what the daemon types back into the listener,
+    as a real desktop does.
+    """
+
+    def setUp(self):
+        self.real = []
+        self.listener = FakeListener(on_press=self.echo)
+        controller = FakeController(echo=self.listener.press)
+        output = OutputEngine(controller)
+        snapshot = PhraseSnapshot({"teh": Phrase("the end", {})})
+        notifier = Notifier(Lock())
+        notifier.replace([PhraseHandler("teh", snapshot, output)])
+        self.handler = InputHandler(notifier, 32, ["enter"])
+        self.handler.add_handler(AlphaNumHandler())
+        self.worker = InputWorker(self.handler, output.injected)
+        self.controller = controller
+
+    def echo(self, key, injected):
+        self.worker(key, injected)
+        # The user keeps typing while the phrase is being typed out.
+        if self.real and self.controller.events:
+            self.worker(self.real.pop())
+
+    def type(self, text):
+        with self.listener:
+            for c in text:
+                self.listener.press(KeyCode.from_char(c))
+            self.listener.press(Key.enter)
+            self.worker.drain()
+
+    def testOutputNotHandled(self):
+        self.type("teh")
+        self.assertEqual("he end", self.controller.typed())
+        self.assertEqual(0, len(self.worker.events))
+        self.assertEqual("", str(self.handler.keybuff))
+
+    def testRealKeysDuringExpansionKept(self):
+        self.real = [KeyCode.from_char("x")]
+        self.type("teh")
+        self.assertEqual("x", str(self.handler.keybuff))
+
+
 if __name__ == "__main__":
     unittest.main()
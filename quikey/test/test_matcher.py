@@ -0,0 +1,184 @@
+import unittest
+
+from quikey.matcher import (
+    SuffixMatcher,
+    PatternMatcher,
+    InstantMatcher,
+    literal_prefix,
+    literal_suffix,
+    uncaptured,
+)
+
+
+class SuffixMatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.matcher = SuffixMatcher([("hello", 1), ("lo", 2), ("btw", 3)])
+
+    def testMatch(self):
+        self.assertEqual(("btw", 3), self.matcher.match("oh btw"))
+        self.assertEqual(("btw", 3), self.matcher.match("btw"))
+
+    def testNoMatch(self):
+        self.assertIsNone(self.matcher.match("btw "))
+        self.assertIsNone(self.matcher.match("tw"))
+        self.assertIsNone(self.matcher.match(""))
+
+    def testLongestMatchWins(self):
+        self.assertEqual(("hello", 1), self.matcher.match("well hello"))
+        self.assertEqual(("lo", 2), self.matcher.match("yello"))
+
+    def testMatchReversed(self):
+        self.assertEqual(("lo", 2), self.matcher.match_reversed(iter("oll")))
+
+    def testRemove(self):
+        self.assertTrue(self.matcher.remove("hello"))
+        self.assertFalse(self.matcher.remove("hello"))
+        self.assertEqual(("lo", 2), self.matcher.match("hello"))
+        self.assertNotIn("hello", self.matcher)
+        self.assertIn("lo", self.matcher)
+        self.assertEqual(2, len(self.matcher))
+
+    def testRemovePrunesPrefixOfOtherKey(self):
+        self.assertTrue(self.matcher.remove("lo"))
+        self.assertIsNone(self.matcher.match("yo lo"))
+        self.assertEqual(("hello", 1), self.matcher.match("hello"))
+
+    def testReplaceValue(self):
+        self.matcher.add("btw", 4)
+        self.assertEqual(3, len(self.matcher))
+        self.assertEqual(("btw", 4), self.matcher.match("btw"))
+
+    def testFromTrie(self):
+        matcher = SuffixMatcher.from_trie(self.matcher.root, len(self.matcher))
+        self.assertEqual(3, len(matcher))
+        self.assertEqual(("hello", 1), matcher.match("hello"))
+
+
+class PatternMatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        with self.assertLogs(level="WARNING"):
+            self.matcher = PatternMatcher(
+                [r"addr(\d)", r"x(?P<n>\d+)", r"(\d+)km", r"ad\w+", r"(a)\1", r"a*"]
+            )
+
+    def testMatch(self):
+        key, match = self.matcher.match("go to addr3")
+        self.assertEqual(r"addr(\d)", key)
+        self.assertEqual("Street 3", match.expand(r"Street \1"))
+        key, match = self.matcher.match("zzx12")
+        self.assertEqual("12", match.group("n"))
+        self.assertEqual("x12", match.group(0))
+
+    def testMatchWithoutPrefix(self):
+        key, match = self.matcher.match("ran 12km")
+        self.assertEqual(r"(\d+)km", key)
+        self.assertEqual("12", match.group(1))
+
+    def testNoMatch(self):
+        self.assertIsNone(self.matcher.match("addr3 "))
+        self.assertIsNone(self.matcher.match(""))
+        self.assertIsNone(PatternMatcher().match("addr3"))
+
+    def testLongestMatchWins(self):
+        # "ad\w+" matches more of the text than "addr(\d)".
+        self.assertEqual(r"ad\w+", self.matcher.match("adxaddr3")[0])
+        self.assertEqual(r"ad\w+", self.matcher.match("adzz")[0])
+
+    def testFirstAddedWinsTies(self):
+        self.assertEqual(r"addr(\d)", self.matcher.match("addr3")[0])
+
+    def testUnusablePatternsLeftOut(self):
+        self.assertEqual(5, len(self.matcher))
+        self.assertNotIn("a*", self.matcher)
+        with self.assertLogs(level="WARNING"):
+            self.assertFalse(self.matcher.add("(unclosed"))
+        with self.assertRaises(ValueError):
+            PatternMatcher.validate("x?")
+
+    def testBackreference(self):
+        key, match = self.matcher.match("xaa")
+        self.assertEqual(r"(a)\1", key)
+        self.assertEqual("aa", match.group(0))
+
+    def testInlineFlags(self):
+        self.assertTrue(self.matcher.add(r"(?i)sig(\d)"))
+        key, match = self.matcher.match("see SIG2")
+        self.assertEqual(r"(?i)sig(\d)", key)
+        self.assertEqual("2", match.group(1))
+        # The flag does not leak into the other patterns.
+        self.assertIsNone(self.matcher.match("ADDR3"))
+
+    def testOnlyUnindexedPatternsTriedEveryTime(self):
+        combined, joined, separate = self.matcher.compile()
+        self.assertEqual([], joined)
+        self.assertEqual([r"(a)\1"], separate)
+        self.assertTrue(self.matcher.add(r"\d+"))
+        self.assertEqual([r"\d+"], self.matcher.compile()[1])
+
+    def testRemove(self):
+        self.assertTrue(self.matcher.remove(r"addr(\d)"))
+        self.assertFalse(self.matcher.remove(r"addr(\d)"))
+        self.assertEqual(r"ad\w+", self.matcher.match("addr3")[0])
+        self.assertTrue(self.matcher.remove(r"(\d+)km"))
+        self.assertIsNone(self.matcher.match("12km"))
+
+    def testLiteralPrefix(self):
+        self.assertEqual("addr", literal_prefix(r"addr\d"))
+        self.assertEqual("a", literal_prefix("ab?c"))
+        self.assertEqual("x", literal_prefix("x(a|b)"))
+        self.assertEqual("", literal_prefix("ab|cd"))
+        self.assertEqual("", literal_prefix("(?i)ab"))
+
+    def testLiteralSuffix(self):
+        self.assertEqual("km", literal_suffix(r"\d+km"))
+        self.assertEqual("c", literal_suffix("ab?c"))
+        self.assertEqual("", literal_suffix("ab*"))
+        self.assertEqual("", literal_suffix(r"a\d"))
+        self.assertEqual("", literal_suffix("ab|cd"))
+        self.assertEqual("y", literal_suffix("(a|b)y"))
+
+    def testUncaptured(self):
+        self.assertEqual(r"(?:a)(?:b)[(]\((?:c)", uncaptured(r"(a)(?P<x>b)[(]\((?:c)"))
+
+
+class InstantMatcherTestCase(unittest.TestCase):
+    def setUp(self):
+        self.matcher = InstantMatcher(["hello", "lo", ";sig", "btw"])
+
+    def run_text(self, text):
+        state = self.matcher.ROOT
+        found = []
+        for char in text:
+            state = self.matcher.step(state, char)
+            key = self.matcher.match(state)
+            if key is not None:
+                found.append(key)
+        return found
+
+    def testMatchOnLastCharacter(self):
+        self.assertEqual([";sig"], self.run_text("xx;sig"))
+        self.assertEqual(["btw"], self.run_text("bbtw"))
+
+    def testLongestKeyWins(self):
+        self.assertEqual(["hello"], self.run_text("hello"))
+        self.assertEqual(["lo"], self.run_text("yellow"))
+
+    def testNoMatch(self):
+        self.assertEqual([], self.run_text(";si g bt w"))
+        self.assertEqual([], self.run_text(""))
+        self.assertEqual(0, len(InstantMatcher()))
+
+    def testRollback(self):
+        # Going back to an earlier state is the same as not typing since.
+        states = [self.matcher.ROOT]
+        for char in ";sx":
+            states.append(self.matcher.step(states[-1], char))
+        states.pop()
+        state = states[-1]
+        for char in "ig":
+            state = self.matcher.step(state, char)
+        self.assertEqual(";sig", self.matcher.match(state))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,306 @@
+import unittest
+from unittest import mock
+import tempfile
+from shutil import rmtree
+from os import path
+
+from quikey.directories import AppDirectories
+from quikey.models import (
+    Database,
+    SQLiteDatabase,
+    JournalDatabase,
+    Phrase,
+    PhraseSnapshot,
+    LazyPhraseSnapshot,
+    ValueCache,
+    open_database,
+)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.db = Database(self.appDirs)
+
+    def tearDown(self):
+        rmtree(self.data)
+        rmtree(self.config)
+        rmtree(self.cache)
+
+    def testPutGet(self):
+        self.db.put("hi", "hello there", ["greeting"])
+        self.assertEqual("hello there", self.db.get("hi"))
+        self.assertIsNone(self.db.get("missing"))
+
+    def testUpdateDelete(self):
+        self.db.put("hi", "hello there")
+        self.db.update("hi", "howdy")
+        self.assertEqual("howdy", self.db.get("hi"))
+        self.assertTrue(self.db.delete("hi"))
+        self.assertIsNone(self.db.get("hi"))
+
+    def testPutGetMany(self):
+        self.db.put("hi", "hello")
+        self.db.put_many({"hi": "howdy", "btw": "by the way"}, ["imported"])
+        self.db.put_many({})
+        self.assertEqual(2, len(self.db.all()))
+        self.assertEqual(
+            {"hi": "howdy", "btw": "by the way"},
+            self.db.get_many(["hi", "btw", "missing"]),
+        )
+
+    def testIndex(self):
+        self.db.put("hi", "hello", options={"output": "paste"})
+        (doc,) = self.db.index()
+        self.assertEqual("hi", doc["key"])
+        self.assertEqual({"output": "paste"}, doc["options"])
+        self.assertIn("updated", doc)
+        self.assertNotIn("value", doc)
+
+
+class TinyDatabaseWriteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.db = Database(AppDirectories(self.data, self.data, self.data))
+
+    def tearDown(self):
+        rmtree(self.data)
+
+    def testPutManyWritesOnce(self):
+        self.db.put_many({"hi": "hello", "btw": "by the way"})
+        with mock.patch.object(
+            self.db.db.storage, "write", wraps=self.db.db.storage.write
+        ) as write:
+            self.db.put_many({"hi": "howdy", "ty": "thank you"})
+        self.assertEqual(1, write.call_count)
+        self.assertEqual(
+            {"hi": "howdy", "btw": "by the way", "ty": "thank you"},
+            {x["key"]: x["value"] for x in self.db.all()},
+        )
+        self.db.put("np", "no problem")
+        self.assertEqual(4, len(self.db.all()))
+
+
+class SQLiteDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = SQLiteDatabase(self.appDirs)
+
+    def testAll(self):
+        self.db.put("hi", "hello there", ["greeting"], {"output": "paste"})
+        phrases = self.db.all()
+        self.assertEqual(1, len(phrases))
+        self.assertEqual(["greeting"], phrases[0]["tags"])
+        self.assertEqual({"output": "paste"}, phrases[0]["options"])
+
+    def testMigrate(self):
+        tiny = Database(self.appDirs)
+        tiny.put("hi", "hello there", ["greeting"])
+        tiny.put("btw", "by the way")
+        db = SQLiteDatabase(self.appDirs, "migrated.db")
+        self.assertEqual(2, len(db.all()))
+        self.assertEqual("by the way", db.get("btw"))
+
+    def testOpenDatabase(self):
+        with open(path.join(self.appDirs.config, "config.ini"), "w") as f:
+            f.write("[storage]\nbackend = sqlite\n")
+        self.assertIsInstance(open_database(self.appDirs), SQLiteDatabase)
+        self.assertIsInstance(open_database(self.appDirs, "tinydb"), Database)
+
+
+class JournalDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = JournalDatabase(self.appDirs)
+
+    def testWritesAppend(self):
+        self.db.put("hi", "hello there")
+        size = path.getsize(self.db.dbFile)
+        self.db.put("btw", "by the way")
+        self.assertGreater(path.getsize(self.db.dbFile), size)
+        self.db.refresh()
+        self.assertEqual(2, self.db.records)
+
+    def testSharedBetweenInstances(self):
+        other = JournalDatabase(self.appDirs)
+        self.db.put("hi", "hello there")
+        self.assertEqual("hello there", other.get("hi"))
+        other.delete("hi")
+        self.assertIsNone(self.db.get("hi"))
+
+    def testTail(self):
+        other = JournalDatabase(self.appDirs)
+        self.assertIsNone(other.tail())
+        self.db.put("hi", "hello there")
+        self.db.put("btw", "by the way")
+        self.db.delete("hi")
+        tail = other.tail()
+        self.assertIsNone(tail["hi"])
+        self.assertEqual("by the way", tail["btw"]["value"])
+        self.assertEqual({}, other.tail())
+
+    def testCompact(self):
+        other = JournalDatabase(self.appDirs)
+        other.tail()
+        self.db.put("hi", "hello there")
+        self.db.put("btw", "by the way")
+        self.db.compact()
+        self.assertEqual(0, self.db.records)
+        with open(self.db.dbFile) as f:
+            self.assertEqual(1, len(f.readlines()))
+        # Other readers reload the new snapshot in full.
+        self.assertIsNone(other.tail())
+        self.assertEqual("by the way", other.get("btw"))
+        self.db.put("ty", "thank you")
+        self.assertEqual(["ty"], list(other.tail()))
+        self.assertEqual(3, len(JournalDatabase(self.appDirs).all()))
+
+    def testLoadDuringCompaction(self):
+        self.db.put("hi", "hello there")
+        reader = JournalDatabase(self.appDirs)
+
+        def replace(path, lines):
+            JournalDatabase.replace(path, lines)
+            if path == self.db.snapshotFile:
+                # Load between the new snapshot and the new journal.
+                reader.refresh()
+
+        self.db.replace = replace
+        self.db.compact()
+        self.db.put("btw", "by the way")
+        self.assertEqual(
+            {"hi": "hello there", "btw": "by the way"},
+            reader.get_many(["hi", "btw"]),
+        )
+        self.assertTrue(reader.delete_many(["hi"]))
+        self.assertEqual(["btw"], [x["key"] for x in reader.all()])
+
+    def testPartialRecordIgnored(self):
+        self.db.put("hi", "hello there")
+        with open(self.db.dbFile, "ab") as f:
+            f.write(b'{"key": "btw", "val')
+        self.assertEqual(1, len(self.db.all()))
+
+    def testMigrate(self):
+        tiny = Database(self.appDirs)
+        tiny.put("hi", "hello there")
+        db = JournalDatabase(self.appDirs, "migrated.journal", "migrated.snapshot")
+        self.assertEqual("hello there", db.get("hi"))
+
+
+class LazyJournalDatabaseTestCase(JournalDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = JournalDatabase(self.appDirs, lazy=True)
+
+    def testValuesNotInMemory(self):
+        self.db.put("hi", "hello there")
+        self.db.compact()
+        self.db.put("btw", "by the way")
+        self.db.refresh()
+        self.assertNotIn("value", self.db.phrases["hi"])
+        self.assertNotIn("value", self.db.phrases["btw"])
+        self.assertEqual("hello there", self.db.get("hi"))
+        self.assertEqual("by the way", self.db.get("btw"))
+
+    def testReadAfterOtherCompacted(self):
+        self.db.put("hi", "hello there")
+        self.db.refresh()
+        other = JournalDatabase(self.appDirs)
+        other.put("btw", "by the way")
+        other.compact()
+        self.assertEqual("hello there", self.db.read("hi"))
+        self.assertEqual("by the way", self.db.get("btw"))
+
+
+class ValueCacheTestCase(unittest.TestCase):
+    def testEvictsLeastRecentlyUsed(self):
+        cache = ValueCache(capacity=10)
+        cache.put("a", "aaaa")
+        cache.put("b", "bbbb")
+        self.assertEqual("aaaa", cache.get("a"))
+        cache.put("c", "cccc")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual("aaaa", cache.get("a"))
+        self.assertEqual(8, cache.size)
+        self.assertAlmostEqual(2 / 3, cache.hit_rate)
+
+    def testTooLarge(self):
+        cache = ValueCache(capacity=3)
+        cache.put("a", "aaaa")
+        self.assertEqual(0, len(cache))
+
+
+class LazyPhraseSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.db = JournalDatabase(self.appDirs, lazy=True)
+        self.db.put("hi", "hello there", options={"output": "paste"})
+        self.values = ValueCache()
+        self.snapshot = LazyPhraseSnapshot(self.db, self.values)
+        self.snapshot.load(self.db)
+
+    def tearDown(self):
+        rmtree(self.data)
+        rmtree(self.config)
+        rmtree(self.cache)
+
+    def testGetCaches(self):
+        self.assertEqual("paste", self.snapshot.options("hi").get("output"))
+        self.assertEqual(0, len(self.values))
+        self.assertEqual("hello there", self.snapshot.get("hi"))
+        self.assertEqual("hello there", self.snapshot.get("hi"))
+        self.assertEqual(1, self.values.hits)
+        self.assertIsNone(self.snapshot.get("missing"))
+
+    def testChangedValueNotServedFromCache(self):
+        self.snapshot.get("hi")
+        self.db.update("hi", "howdy")
+        self.snapshot.load(self.db)
+        self.assertEqual("howdy", self.snapshot.get("hi"))
+
+
+class PhraseSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.db = Database(self.appDirs)
+
+    def tearDown(self):
+        rmtree(self.data)
+        rmtree(self.config)
+        rmtree(self.cache)
+
+    def testLoad(self):
+        self.db.put("hi", "hello there")
+        self.db.put("btw", "by the way", options={"output": "paste"})
+        snapshot = PhraseSnapshot()
+        snapshot.load(self.db)
+        self.assertEqual(2, len(snapshot))
+        self.assertEqual("by the way", snapshot.get("btw"))
+        self.assertEqual("paste", snapshot.options("btw").get("output"))
+        self.assertEqual({}, dict(snapshot.options("hi")))
+
+    def testReadOnly(self):
+        snapshot = PhraseSnapshot({"hi": Phrase("hello", {})})
+        with self.assertRaises(TypeError):
+            snapshot.phrases["hi"] = Phrase("changed", {})
+
+    def testReplaceKeepsOldMapping(self):
+        snapshot = PhraseSnapshot({"hi": Phrase("hello", {})})
+        old = snapshot.phrases
+        snapshot.replace({"hi": Phrase("howdy", {})})
+        self.assertEqual("hello", old["hi"].value)
+        self.assertEqual("howdy", snapshot.get("hi"))
+
+
+if __name__ == "__main__":
+    unittest.main()
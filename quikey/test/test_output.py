@@ -0,0 +1,158 @@
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+from quikey.fakes import FakeController, FakeClipboard
+from pynput.keyboard import KeyCode
+
+from quikey.output import OutputEngine, InjectedKeys, Clipboard, plan, TYPE, PASTE
+
+
+class OutputEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.keyboard = FakeController()
+        self.clipboard = FakeClipboard("copied by the user")
+        self.engine = OutputEngine(self.keyboard, self.clipboard, paste_threshold=10)
+        self.engine.strategies[PASTE].restore_delay = 0
+
+    def testShortPhraseTyped(self):
+        self.assertEqual(TYPE, self.engine.emit("hello"))
+        self.assertEqual("hello", self.keyboard.typed())
+        self.assertEqual(0, self.clipboard.writes)
+
+    def testLongPhrasePasted(self):
+        text = "a long boilerplate phrase"
+        self.assertEqual(PASTE, self.engine.emit(text))
+        self.assertEqual(text, self.clipboard.history[0])
+        # Ctrl down, v down, v up, Ctrl up.
+        self.assertEqual(4, len(self.keyboard.events))
+
+    def testClipboardRestored(self):
+        self.engine.emit("a long boilerplate phrase")
+        self.assertEqual("copied by the user", self.clipboard.text)
+        self.assertEqual(2, self.clipboard.writes)
+
+    def testClipboardRestoredAfterDelay(self):
+        paste = self.engine.strategies[PASTE]
+        paste.restore_delay = 0.05
+        self.engine.emit("a long boilerplate phrase")
+        self.engine.emit("another long phrase")
+        # The second paste must not save the first phrase as the user's text.
+        self.assertEqual("another long phrase", self.clipboard.text)
+        time.sleep(0.2)
+        self.assertEqual("copied by the user", self.clipboard.text)
+        self.assertEqual(3, self.clipboard.writes)
+
+    def testClipboardUnreadable(self):
+        self.clipboard.get = mock.MagicMock(side_effect=OSError)
+        self.engine.emit("a long boilerplate phrase")
+        self.assertEqual(["a long boilerplate phrase"], self.clipboard.history)
+
+    def testPhraseOverride(self):
+        self.assertEqual(PASTE, self.engine.emit("short", PASTE))
+        self.assertEqual(TYPE, self.engine.emit("a long boilerplate phrase", TYPE))
+
+    def testThresholdDisabled(self):
+        engine = OutputEngine(self.keyboard, self.clipboard)
+        self.assertEqual(TYPE, engine.emit("a long boilerplate phrase"))
+
+    def testNoClipboard(self):
+        clipboard = mock.MagicMock(available=False)
+        engine = OutputEngine(self.keyboard, clipboard, paste_threshold=1)
+        self.assertEqual(TYPE, engine.emit("hello", PASTE))
+
+    def testPasteFailureFallsBackToTyping(self):
+        self.clipboard.set = mock.MagicMock(side_effect=OSError)
+        self.engine.emit("a long boilerplate phrase")
+        self.assertEqual("a long boilerplate phrase", self.keyboard.typed())
+
+    def testErase(self):
+        self.keyboard.type("abc")
+        self.engine.erase(2)
+        self.assertEqual("a", self.keyboard.typed())
+
+    def testExpandSkipsSharedPrefix(self):
+        self.keyboard.type("btw ")
+        typed = len(self.keyboard.events)
+        OutputEngine(self.keyboard).expand("btw", "by the way")
+        self.assertEqual("by the way", self.keyboard.typed())
+        # 3 backspaces and 9 characters, each a press and a release.
+        self.assertEqual(24, len(self.keyboard.events) - typed)
+
+    def testExpandPasted(self):
+        self.engine.expand("sig", "significantly longer text")
+        self.assertEqual("nificantly longer text", self.clipboard.history[0])
+        self.assertEqual("copied by the user", self.clipboard.text)
+
+
+class ClipboardTestCase(unittest.TestCase):
+    def testGet(self):
+        clipboard = Clipboard()
+        clipboard.paste = [sys.executable, "-c", "print('copied', end='')"]
+        self.assertEqual("copied", clipboard.get())
+
+    def testGetEmpty(self):
+        clipboard = Clipboard()
+        clipboard.paste = [sys.executable, "-c", "import sys; sys.exit('empty')"]
+        self.assertIsNone(clipboard.get())
+
+
+class PlanTestCase(unittest.TestCase):
+    def testPlan(self):
+        self.assertEqual((4, "hello"), plan("abc", "hello"))
+        self.assertEqual((3, "y the way"), plan("btw", "by the way"))
+        self.assertEqual((1, ""), plan("abc", "abc"))
+        self.assertEqual((1, "e"), plan("abc", "abe", trailing=0))
+
+
+class InjectedKeysTestCase(unittest.TestCase):
+    def setUp(self):
+        self.injected = InjectedKeys()
+
+    def testMatchInOrder(self):
+        self.injected.expect([(True, "a"), (False, "a"), (True, "b")])
+        self.assertEqual(2, len(self.injected))
+        self.assertFalse(self.injected.match(KeyCode.from_char("c")))
+        self.assertTrue(self.injected.match(KeyCode.from_char("a")))
+        self.assertTrue(self.injected.match(KeyCode.from_char("b")))
+        self.assertFalse(self.injected.match(KeyCode.from_char("b")))
+
+    def testLookahead(self):
+        self.injected.expect([(True, "a"), (True, "b")])
+        self.assertTrue(self.injected.match(KeyCode.from_char("b")))
+        self.assertEqual(0, len(self.injected))
+
+    def testTimeout(self):
+        self.injected.timeout = 0
+        self.injected.expect([(True, "a")])
+        self.assertFalse(self.injected.match(KeyCode.from_char("a")))
+        self.assertEqual(0, len(self.injected))
+
+    def testConcurrentExpectAndMatch(self):
+        events = [(True, "b")] * 50
+        stop = threading.Event()
+
+        def typing():
+            while not stop.is_set():
+                self.injected.expect(events)
+
+        thread = threading.Thread(target=typing)
+        thread.start()
+        try:
+            key = KeyCode.from_char("a")
+            for _ in range(20000):
+                self.injected.match(key)
+        finally:
+            stop.set()
+            thread.join()
+
+    def testEngineExpects(self):
+        engine = OutputEngine(FakeController())
+        engine.expand("btw", "by the way")
+        self.assertEqual(3 + len("y the way"), len(engine.injected))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import tempfile
+import os
+import signal
+import threading
+import time
+from shutil import rmtree
+from os import path, getpid
+
+from quikey.directories import AppDirectories
+from quikey.process import (
+    write_pid,
+    running_pid,
+    process_info,
+    stop_daemon,
+    signal_ready,
+    wait_ready,
+    describe,
+    StopTimeout,
+    PID_FILE,
+)
+
+
+class ProcessTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+
+    def tearDown(self):
+        rmtree(self.data)
+        rmtree(self.config)
+        rmtree(self.cache)
+
+    def writeStalePid(self):
+        # A pid past the default pid_max is never running.
+        with open(path.join(self.appDirs.cache, PID_FILE), "w") as f:
+            f.write("4194305")
+
+    def testRunningPid(self):
+        self.assertIsNone(running_pid(self.appDirs))
+        write_pid(self.appDirs)
+        self.assertEqual(getpid(), running_pid(self.appDirs))
+
+    def testRunningPidStale(self):
+        self.writeStalePid()
+        self.assertIsNone(running_pid(self.appDirs))
+
+    @unittest.skipUnless(path.exists("/proc/self/stat"), "needs /proc")
+    def testProcessInfo(self):
+        info = process_info(getpid())
+        self.assertGreaterEqual(info.uptime, 0)
+        self.assertGreater(info.rss, 0)
+        self.assertIsNone(process_info(4194305))
+
+    def testStopStale(self):
+        self.writeStalePid()
+        self.assertIsNone(stop_daemon(self.appDirs))
+        self.assertFalse(path.exists(path.join(self.appDirs.cache, PID_FILE)))
+
+    def testStop(self):
+        child = os.fork()
+        if child == 0:
+            time.sleep(10)
+            os._exit(0)
+        with open(path.join(self.appDirs.cache, PID_FILE), "w") as f:
+            f.write(str(child))
+        # Reaps the child so it no longer exists once it exits.
+        reaper = threading.Thread(target=os.waitpid, args=(child, 0))
+        reaper.start()
+        self.assertEqual(child, stop_daemon(self.appDirs))
+        reaper.join()
+
+    def testStopTimeout(self):
+        child = os.fork()
+        if child == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            time.sleep(10)
+            os._exit(0)
+        try:
+            with open(path.join(self.appDirs.cache, PID_FILE), "w") as f:
+                f.write(str(child))
+            time.sleep(0.2)  # Until the child ignores SIGTERM
+            with self.assertRaises(StopTimeout):
+                stop_daemon(self.appDirs, timeout=0.2)
+        finally:
+            os.kill(child, signal.SIGKILL)
+            os.waitpid(child, 0)
+
+    def testWaitReady(self):
+        r, w = os.pipe()
+        child = os.fork()
+        if child == 0:
+            os.close(r)
+            signal_ready(w)
+            os._exit(0)
+        os.close(w)
+        self.assertEqual(child, wait_ready(r))
+        os.waitpid(child, 0)
+
+    def testWaitReadyExited(self):
+        r, w = os.pipe()
+        os.close(w)
+        self.assertIsNone(wait_ready(r))
+
+    def testWaitReadyTimeout(self):
+        r, w = os.pipe()
+        self.assertIsNone(wait_ready(r, timeout=0.01))
+        os.close(w)
+
+    def testDescribe(self):
+        lines = describe(getpid(), 12)
+        self.assertEqual("Quikey daemon running (PID: %d)" % getpid(), lines[0])
+        self.assertIn("Phrases: 12", lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
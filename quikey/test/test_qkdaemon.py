@@ -4,12 +4,20 @@ import tempfile
 from shutil import rmtree
 from os import path, getpid
 
+from quikey.cache import MatcherCache
 from quikey.directories import AppDirectories
+from quikey.input import Notifier
+from quikey.models import Database, JournalDatabase, LazyPhraseSnapshot, ValueCache
+from quikey.output import OutputEngine
+from quikey.fakes import FakeController
+from quikey.filewatch import InotifyWatch
+from quikey.input import InputHandler
 from quikey.qkdaemon import (
     write_pid,
     read_pid,
     delete_pid,
     ShutdownHook,
+    ReloadHook,
     DatabaseChangeHandler,
 )
 
@@ -63,5 +71,208 @@ class ShutdownHookTestCase(unittest.TestCase):
         inotify.stop.assert_called_with()
 
 
+class DatabaseChangeHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.db = Database(self.appDirs)
+        self.db.put("hi", "hello")
+        self.db.put("btw", "by the way")
+        self.notifier = Notifier(mock.MagicMock())
+        self.output = OutputEngine(FakeController())
+        self.handler = DatabaseChangeHandler(self.notifier, self.db, self.output)
+
+    def snapshot(self):
+        return None
+
+    def tearDown(self):
+        rmtree(self.data)
+        rmtree(self.config)
+        rmtree(self.cache)
+
+    def testInitialLoad(self):
+        self.assertEqual(2, len(self.notifier.observers))
+        self.assertEqual("hello", self.handler.snapshot.get("hi"))
+        self.assertEqual(2, self.handler.last_reload.total)
+
+    def testIncrementalReload(self):
+        kept = self.notifier.handlers["btw"]
+        self.db.put("ty", "thank you")
+        self.db.delete("hi")
+        self.db.update("btw", "by the way,")
+        stats = self.handler.reload()
+        self.assertEqual((1, 1, 1, 2), stats[1:])
+        self.assertIs(kept, self.notifier.handlers["btw"])
+        self.assertNotIn("hi", self.notifier.matcher)
+        self.assertIn("ty", self.notifier.matcher)
+        self.assertEqual("by the way,", self.handler.snapshot.get("btw"))
+
+    def testReloadWithoutChanges(self):
+        stats = self.handler.reload()
+        self.assertEqual((0, 0, 0, 2), stats[1:])
+
+    def testPatternOption(self):
+        self.handler.put(r"n(\d)", r"number \1", options={"pattern": True})
+        self.assertIn(r"n(\d)", self.notifier.patterns)
+        self.handler.update(r"n(\d)", "n", options={})
+        self.assertNotIn(r"n(\d)", self.notifier.patterns)
+        self.assertIn(r"n(\d)", self.notifier.matcher)
+
+    def testInstantOption(self):
+        self.handler.update("btw", "by the way", options={"instant": True})
+        self.assertIn("btw", self.notifier.instant)
+        self.handler.update("btw", "by the way", options={})
+        self.assertNotIn("btw", self.notifier.instant)
+
+    def testPut(self):
+        stats = self.handler.put("ty", "thank you", options={"output": "paste"})
+        self.assertEqual((1, 0, 0, 3), stats[1:])
+        self.assertIn("ty", self.notifier.matcher)
+        self.assertEqual("thank you", self.handler.snapshot.get("ty"))
+        self.assertEqual("paste", self.handler.snapshot.options("ty")["output"])
+        self.assertEqual("thank you", self.db.get("ty"))
+        # The write was already applied.
+        self.assertEqual((0, 0), self.handler.reload()[1:3])
+
+    def testUpdate(self):
+        self.handler.update("btw", "by the way,")
+        self.assertEqual("by the way,", self.handler.snapshot.get("btw"))
+        self.assertEqual("by the way,", self.db.get("btw"))
+
+    def testDelete(self):
+        self.assertTrue(self.handler.delete("hi"))
+        self.assertNotIn("hi", self.notifier.matcher)
+        self.assertIsNone(self.db.get("hi"))
+        self.assertFalse(self.handler.delete("hi"))
+
+
+class JournalChangeHandlerTestCase(DatabaseChangeHandlerTestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.db = JournalDatabase(self.appDirs)
+        self.db.put("hi", "hello")
+        self.db.put("btw", "by the way")
+        self.notifier = Notifier(mock.MagicMock())
+        self.output = OutputEngine(FakeController())
+        self.handler = DatabaseChangeHandler(self.notifier, self.db, self.output)
+
+
+class CachedChangeHandlerTestCase(DatabaseChangeHandlerTestCase):
+    """
+    Same tests, with the phrases loaded from the matcher cache written by a
+    previous daemon.
+    """
+
+    def setUp(self):
+        super().setUp()
+        cache = MatcherCache(self.appDirs)
+        DatabaseChangeHandler(
+            Notifier(mock.MagicMock()), self.db, self.output, cache, self.snapshot()
+        )
+        self.notifier = Notifier(mock.MagicMock())
+        with mock.patch.object(cache, "save") as save:
+            self.handler = DatabaseChangeHandler(
+                self.notifier, self.db, self.output, cache, self.snapshot()
+            )
+        save.assert_not_called()
+
+
+class CachedJournalChangeHandlerTestCase(
+    CachedChangeHandlerTestCase, JournalChangeHandlerTestCase
+):
+    pass
+
+
+class LazyChangeHandlerTestCase(DatabaseChangeHandlerTestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.db = JournalDatabase(self.appDirs, lazy=True)
+        self.db.put("hi", "hello")
+        self.db.put("btw", "by the way")
+        self.notifier = Notifier(mock.MagicMock())
+        self.output = OutputEngine(FakeController())
+        self.handler = DatabaseChangeHandler(
+            self.notifier, self.db, self.output, snapshot=self.snapshot()
+        )
+
+    def snapshot(self):
+        return LazyPhraseSnapshot(self.db, ValueCache())
+
+
+class CachedLazyChangeHandlerTestCase(
+    CachedChangeHandlerTestCase, LazyChangeHandlerTestCase
+):
+    pass
+
+
+class ReloadHookTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.db = Database(self.appDirs)
+        self.db.put("hi", "hello")
+        self.notifier = Notifier(mock.MagicMock())
+        self.dbchange = DatabaseChangeHandler(
+            self.notifier, self.db, OutputEngine(FakeController())
+        )
+        self.handler = InputHandler(self.notifier, 32, ["enter"])
+        self.watch = InotifyWatch(self.db.watchFiles, poll_interval=0.05)
+        self.watch.add_observer(self.dbchange)
+        self.watch.start()
+        self.shutdown = mock.Mock(watch=self.watch)
+        self.hook = ReloadHook(
+            self.appDirs, self.handler, self.dbchange, self.watch, self.shutdown
+        )
+
+    def tearDown(self):
+        self.hook.watch.stop()
+        self.hook.watch.join()
+        self.watch.join()
+        rmtree(self.data)
+        rmtree(self.config)
+        rmtree(self.cache)
+
+    def writeConfig(self, text):
+        with open(path.join(self.appDirs.config, "config.ini"), "w") as f:
+            f.write(text)
+
+    def testReloadConfig(self):
+        self.writeConfig("[daemon]\nbuffer_size = 4\ntrigger_keys = tab, enter\n")
+        self.hook(1, None)
+        self.assertEqual(4, self.handler.keybuff.maxlen)
+        self.assertEqual(2, len(self.handler.triggerhandler.triggerkeys))
+
+    def testSwapsMatcher(self):
+        matcher = self.notifier.matcher
+        self.db.put("btw", "by the way")
+        self.hook(1, None)
+        self.assertIsNot(matcher, self.notifier.matcher)
+        self.assertIn("btw", self.notifier.matcher)
+
+    def testRestartsWatch(self):
+        self.hook(1, None)
+        self.watch.join(1)
+        self.assertFalse(self.watch.is_alive())
+        self.assertIsNot(self.watch, self.hook.watch)
+        self.assertTrue(self.hook.watch.is_alive())
+        self.assertIs(self.hook.watch, self.shutdown.watch)
+        self.assertEqual([self.dbchange], self.hook.watch.observers)
+
+    def testBadConfigKeepsSettings(self):
+        self.writeConfig("[daemon]\nbuffer_size = lots\n")
+        self.hook(1, None)
+        self.assertEqual(32, self.handler.keybuff.maxlen)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,92 @@
+import json
+import unittest
+import subprocess
+import sys
+import tempfile
+from shutil import rmtree
+from os import environ, makedirs, path
+
+
+class CliTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.env = {
+            "XDG_DATA_HOME": path.join(self.dir, "data"),
+            "XDG_CONFIG_HOME": path.join(self.dir, "config"),
+            "XDG_CACHE_HOME": path.join(self.dir, "cache"),
+        }
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testVersionSkipsDatabase(self):
+        code = (
+            "import sys; sys.argv = ['qk', 'version']\n"
+            "from quikey.quikey import cli\n"
+            "try:\n"
+            "    cli()\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print('tinydb' in sys.modules, 'terminaltables' in sys.modules,\n"
+            "      'quikey.importer' in sys.modules)"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            env=dict(environ, **self.env),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+        self.assertEqual("False False False", result.stdout.decode().splitlines()[-1])
+        self.assertFalse(path.exists(path.join(self.dir, "data")))
+
+    def keyimport(self, *args):
+        location = path.join(self.dir, "autokey")
+        makedirs(location)
+        with open(path.join(location, "btw.txt"), "w") as f:
+            f.write("by the way")
+        with open(path.join(location, ".btw.json"), "w") as f:
+            config = {
+                "type": "phrase",
+                "modes": [1],
+                "abbreviation": {"abbreviations": ["btw", "b"]},
+            }
+            json.dump(config, f)
+        return subprocess.run(
+            [sys.executable, "-c", "from quikey.quikey import cli; cli()"]
+            + ["keyimport", "-l", location]
+            + list(args),
+            env=dict(environ, **self.env),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=30,
+        )
+
+    def testAddRejectsUnusablePattern(self):
+        result = subprocess.run(
+            [sys.executable, "-c", "from quikey.quikey import cli; cli()"]
+            + ["add", "-n", "addr(", "-p", "x", "--pattern"],
+            env=dict(environ, **self.env),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=30,
+        )
+        self.assertIn(
+            b"is not a usable pattern: missing ), unterminated", result.stdout
+        )
+
+    def testImportUsesFirstAbbreviation(self):
+        result = self.keyimport()
+        self.assertEqual(0, result.returncode, result.stderr)
+        self.assertIn(b"key of btw added", result.stdout)
+        self.assertNotIn(b"key of b added", result.stdout)
+
+    def testImportAskNeedsTerminal(self):
+        result = self.keyimport("--multiple", "ask")
+        self.assertEqual(2, result.returncode)
+        self.assertIn(b"needs a terminal", result.stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import tempfile
+from shutil import rmtree
+from os import path
+
+from quikey.stats import Histogram, Stats
+
+
+class HistogramTestCase(unittest.TestCase):
+    def setUp(self):
+        self.histogram = Histogram((10, 100, 1000))
+
+    def testRecord(self):
+        self.histogram.record(0.000005)
+        self.histogram.record(0.00005)
+        self.histogram.record(0.00005)
+        self.histogram.record(0.5)
+        self.assertEqual([1, 2, 0, 1], self.histogram.counts)
+        self.assertEqual(4, self.histogram.count)
+        self.assertAlmostEqual(500000, self.histogram.max)
+
+    def testPercentile(self):
+        self.assertEqual(0, self.histogram.percentile(50))
+        for i in range(98):
+            self.histogram.record(0.000005)
+        self.histogram.record(0.0005)
+        self.histogram.record(2)
+        self.assertEqual(10, self.histogram.percentile(50))
+        self.assertEqual(1000, self.histogram.percentile(99))
+        self.assertAlmostEqual(2000000, self.histogram.percentile(100))
+
+
+class StatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testDisabled(self):
+        stats = Stats(enabled=False)
+        stats.record("keystroke", 0.001)
+        self.assertEqual({}, stats.histograms)
+
+    def testDumpLoad(self):
+        stats = Stats()
+        stats.record("keystroke", 0.00002)
+        stats.record("match", 0.001)
+        stats.dump(path.join(self.dir, "stats.json"))
+        loaded = Stats.load(path.join(self.dir, "stats.json"))
+        self.assertEqual(stats.to_dict(), loaded.to_dict())
+        self.assertEqual(["keystroke", "match"], [x[0] for x in loaded.rows()])
+
+    def testCounters(self):
+        stats = Stats()
+        stats.increment("queue_dropped")
+        stats.increment("queue_dropped", 2)
+        stats.maximum("queue_depth_max", 5)
+        stats.maximum("queue_depth_max", 3)
+        self.assertEqual(
+            [["queue_depth_max", 5], ["queue_dropped", 3]], stats.counter_rows()
+        )
+        stats.dump(path.join(self.dir, "stats.json"))
+        loaded = Stats.load(path.join(self.dir, "stats.json"))
+        self.assertEqual(stats.counters, loaded.counters)
+
+    def testCountersDisabled(self):
+        stats = Stats(enabled=False)
+        stats.increment("queue_dropped")
+        stats.maximum("queue_depth_max", 5)
+        self.assertEqual({}, stats.counters)
+
+
+if __name__ == "__main__":
+    unittest.main()
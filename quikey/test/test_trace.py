@@ -0,0 +1,117 @@
+import unittest
+from unittest import mock
+import os
+import tempfile
+from shutil import rmtree
+from os import path
+from threading import Lock
+
+from pynput.keyboard import Key, KeyCode
+
+from quikey.directories import AppDirectories
+from quikey.fakes import FakeController
+from quikey.input import (
+    Notifier,
+    InputHandler,
+    AlphaNumHandler,
+    DeleteHandler,
+    SpaceHandler,
+)
+from quikey.models import Database
+from quikey.output import OutputEngine
+from quikey.qkdaemon import DatabaseChangeHandler
+from quikey.trace import TraceRecorder, RecordingOutput, read_trace, replay
+
+
+class TraceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = tempfile.mkdtemp()
+        self.config = tempfile.mkdtemp()
+        self.cache = tempfile.mkdtemp()
+        self.appDirs = AppDirectories(self.data, self.config, self.cache)
+        self.trace = path.join(self.data, "trace.jsonl")
+        self.db = Database(self.appDirs)
+        self.db.put("teh", "the")
+
+    def tearDown(self):
+        rmtree(self.data)
+        rmtree(self.config)
+        rmtree(self.cache)
+
+    def record(self, *keys):
+        output = RecordingOutput(OutputEngine(FakeController()))
+        notifier = Notifier(Lock())
+        DatabaseChangeHandler(notifier, self.db, output)
+        i = InputHandler(notifier, 32, ["enter"])
+        i.add_handler(DeleteHandler())
+        i.add_handler(AlphaNumHandler())
+        i.add_handler(SpaceHandler())
+        handler = mock.Mock(side_effect=i)
+        recorder = TraceRecorder(self.trace, handler, output, 32, ["enter"])
+        for key in keys:
+            for c in key if isinstance(key, str) else [key]:
+                recorder(KeyCode.from_char(c) if isinstance(c, str) else c)
+        recorder(Key.enter)
+        recorder.close()
+        return handler
+
+    def testRecordPassesKeysOn(self):
+        handler = self.record("teh")
+        self.assertEqual(handler.call_count, 4)
+
+    def testRecordMasksCharacters(self):
+        self.record("xteh")
+        header, events = read_trace(self.trace)
+        self.assertEqual(header["buffer_size"], 32)
+        self.assertEqual(header["trigger_keys"], ["enter"])
+        self.assertEqual(events[0]["m"], 1)
+        self.assertNotIn("c", events[0])
+        self.assertEqual([e.get("c") for e in events[1:4]], ["t", "e", "h"])
+        self.assertIn("k", events[4])
+        self.assertTrue(all("t" in e for e in events))
+
+    def testRecordMasksUnexpanded(self):
+        self.record("hunter2")
+        _, events = read_trace(self.trace)
+        self.assertEqual(8, len(events))
+        self.assertFalse(any("c" in e for e in events))
+        self.assertEqual([1] * 7, [e["m"] for e in events[:7]])
+
+    def testRecordMasksDeleted(self):
+        self.record("tex", Key.backspace, "h")
+        _, events = read_trace(self.trace)
+        self.assertEqual(
+            ["t", "e", None, None, "h", None], [e.get("c") for e in events]
+        )
+        self.assertEqual(1, events[2]["m"])
+
+    def testRecordInstant(self):
+        self.db.put("tm", "(TM)", options={"instant": True})
+        self.record("xtm")
+        _, events = read_trace(self.trace)
+        self.assertEqual([None, "t", "m", None], [e.get("c") for e in events])
+
+    def testTraceOnlyReadableByUser(self):
+        self.record("teh")
+        self.assertEqual(0o600, os.stat(self.trace).st_mode & 0o777)
+
+    def testReplay(self):
+        self.record("xx teh")
+        expansions, histogram = replay(
+            self.trace,
+            lambda notifier, output: DatabaseChangeHandler(notifier, self.db, output),
+        )
+        self.assertEqual(len(expansions), 1)
+        self.assertEqual(expansions[0]["key"], "teh")
+        self.assertEqual(expansions[0]["event"], 6)
+        self.assertEqual(expansions[0]["strategy"], "type")
+        self.assertEqual(histogram.count, 7)
+
+    def testReplayMasked(self):
+        # Masked characters expand the same as the ones that were typed.
+        self.record("x" * 40 + "teh")
+        expansions, _ = replay(
+            self.trace,
+            lambda notifier, output: DatabaseChangeHandler(notifier, self.db, output),
+        )
+        self.assertEqual([e["key"] for e in expansions], ["teh"])
@@ -0,0 +1,211 @@
+from pynput.keyboard import Key, KeyCode
+from collections import deque
+from threading import Lock
+import json
+import os
+import time
+
+from quikey.fakes import FakeController, FakeClipboard
+from quikey.output import OutputEngine
+from quikey.input import (
+    Notifier,
+    InputHandler,
+    AlphaNumHandler,
+    DeleteHandler,
+    SpaceHandler,
+)
+from quikey.stats import Histogram
+
+TRACE_VERSION = 1
+
+# Stands in for masked characters on replay. It can't be typed, so it is
+# never part of a phrase-key.
+MASK = "\x00"
+
+
+def encode(key):
+    if isinstance(key, Key):
+        return {"k": key.name}
+    if isinstance(key, KeyCode) and key.char is not None:
+        return {"c": key.char}
+    return {"v": getattr(key, "vk", None)}
+
+
+def decode(event):
+    if "k" in event:
+        return Key[event["k"]]
+    if "c" in event:
+        return KeyCode.from_char(event["c"])
+    if "m" in event:
+        return KeyCode.from_char(MASK)
+    return KeyCode.from_vk(event["v"])
+
+
+class TraceRecorder:
+    """
+    Wraps the daemon's key press callback and appends every key event, with
+    its time in milliseconds since recording started, to a JSON lines trace
+    file that only the user can read.
+
+    Only characters that turn out to be part of an expanded phrase-key are
+    written as typed; every other character is written as a mask. output is
+    the daemon's OutputEngine wrapped in a RecordingOutput, which tells the
+    recorder what each key expanded. Characters are held back while they are
+    in the key buffer and could still become part of a match, so events can
+    reach the file a few keys late. A replayed trace expands exactly the
+    same phrases while what the user typed otherwise stays out of the file.
+    """
+
+    def __init__(self, path, handler, output, buffer_size, trigger_keys):
+        self.handler = handler
+        self.output = output
+        # [event, pending] pairs not written yet, oldest first. The pending
+        # ones are the characters still in the mirrored key buffer.
+        self.held = deque()
+        self.buffer = deque(maxlen=buffer_size)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # An existing file keeps its mode when it is opened.
+        os.fchmod(fd, 0o600)
+        self.file = os.fdopen(fd, "w", buffering=1)
+        self.start = time.perf_counter()
+        header = {
+            "version": TRACE_VERSION,
+            "buffer_size": buffer_size,
+            "trigger_keys": list(trigger_keys),
+        }
+        self.file.write(json.dumps(header) + "\n")
+
+    def __call__(self, key):
+        event = encode(key)
+        event["t"] = round((time.perf_counter() - self.start) * 1000, 1)
+        result = self.handler(key)
+        self.hold(key, event)
+        self.flush()
+        return result
+
+    def hold(self, key, event):
+        """
+        Follow the key buffer the way InputHandler changed it for key, and
+        settle the characters whose fate that decided.
+        """
+        expansions = self.output.expansions
+        expansion = expansions[-1] if expansions else None
+        del expansions[:]
+        entry = [event, False]
+        self.held.append(entry)
+        if expansion is not None and expansion["trailing"] > 0:
+            # A trigger expanded a phrase, the key never reached the buffer.
+            pass
+        elif key == Key.backspace:
+            if self.buffer:
+                self.mask(self.buffer.pop())
+        elif isinstance(key, KeyCode):
+            if key.char is not None:
+                self.append(entry)
+        elif key == Key.space:
+            self.append(entry)
+        if expansion is not None:
+            # The end of the buffer was the key that expanded, and the
+            # buffer was cleared.
+            typed = len(expansion["key"])
+            for i, pending in enumerate(reversed(self.buffer)):
+                if i < typed:
+                    pending[1] = False
+                else:
+                    self.mask(pending)
+            self.buffer.clear()
+
+    def append(self, entry):
+        entry[1] = True
+        if len(self.buffer) == self.buffer.maxlen:
+            # The oldest character falls out of the buffer.
+            self.mask(self.buffer[0] if self.buffer else entry)
+        if entry[1]:
+            self.buffer.append(entry)
+
+    @staticmethod
+    def mask(entry):
+        event = entry[0]
+        if "c" in event:
+            entry[0] = {"m": 1, "t": event["t"]}
+        entry[1] = False
+
+    def flush(self):
+        while self.held and not self.held[0][1]:
+            event = self.held.popleft()[0]
+            self.file.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+    def close(self):
+        for entry in self.buffer:
+            self.mask(entry)
+        self.buffer.clear()
+        self.flush()
+        self.file.close()
+
+
+def read_trace(path):
+    with open(path) as f:
+        header = json.loads(f.readline())
+        events = [json.loads(line) for line in f if line.strip()]
+    return header, events
+
+
+class RecordingOutput:
+    """
+    Wraps an OutputEngine and keeps a record of every expansion it makes.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.expansions = []
+        self.event = None
+
+    def __getattr__(self, name):
+        return getattr(self.output, name)
+
+    def expand(self, key, phrase, mode=None, trailing=1):
+        start = time.perf_counter()
+        strategy = self.output.expand(key, phrase, mode, trailing)
+        self.expansions.append(
+            {
+                "event": self.event,
+                "key": key,
+                "trailing": trailing,
+                "strategy": strategy,
+                "ms": (time.perf_counter() - start) * 1000,
+            }
+        )
+        return strategy
+
+
+def replay(path, dbchange_factory, realtime=False, paste_threshold=0):
+    """
+    Push a recorded trace through the daemon's input handling against a fake
+    keyboard. dbchange_factory(notifier, output) must return a
+    DatabaseChangeHandler for the phrase database to replay against.
+
+    Returns the expansions made and the keystroke latency histogram.
+    """
+    header, events = read_trace(path)
+    output = RecordingOutput(
+        OutputEngine(FakeController(), FakeClipboard(), paste_threshold)
+    )
+    notifier = Notifier(Lock())
+    dbchange_factory(notifier, output)
+    handler = InputHandler(notifier, header["buffer_size"], header["trigger_keys"])
+    handler.add_handler(DeleteHandler())
+    handler.add_handler(AlphaNumHandler())
+    handler.add_handler(SpaceHandler())
+    histogram = Histogram()
+    start = time.perf_counter()
+    for i, event in enumerate(events):
+        if realtime:
+            delay = event["t"] / 1000 - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        output.event = i
+        key = decode(event)
+        t = time.perf_counter()
+        handler(key)
+        histogram.record(time.perf_counter() - t)
+    return output.expansions, histogram